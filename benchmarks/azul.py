@@ -0,0 +1,131 @@
+# A local stand-in for the Azul service: the index/projects listing and project endpoints over a catalog JSON file,
+# and range-capable file downloads from a directory. Every request waits --latency seconds. --error-rate is the
+# share of index requests answered with a 503 and Retry-After: 0, which the metadata fetch retries. File downloads
+# are never failed on purpose, a single GET is not retried by the download functions.
+#
+#   python benchmarks/azul.py --catalog /tmp/catalog/hca.json --files /tmp/files --latency 0.01
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+from aiohttp import web
+
+
+class AzulServer:
+    def __init__(self, projects, files_directory=None, latency=0, error_rate=0, seed=0):
+        self.projects = projects
+        self.project_keys = list(projects)
+        self.files_directory = files_directory
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+        self.bodies = {}
+
+    async def delay(self, fail=True):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if fail and self.error_rate and self.rng.random() < self.error_rate:
+            raise web.HTTPServiceUnavailable(headers={'Retry-After': '0'})
+
+    def body(self, project_key):
+        if project_key not in self.bodies:
+            body = json.dumps(self.projects[project_key]).encode('utf-8')
+            self.bodies[project_key] = body, '"' + hashlib.md5(body).hexdigest() + '"'
+        return self.bodies[project_key]
+
+    async def listing(self, request):
+        await self.delay()
+        size, offset = int(request.query.get('size', 100)), int(request.query.get('offset', 0))
+        hits = [{'entryId': project_key, 'projects': [{'projectTitle': self.projects[project_key]['projects'][0]
+                 ['projectTitle']}]} for project_key in self.project_keys[offset:offset + size]]
+        next_url = f'{request.url.with_query(dict(request.query, size=size, offset=offset + size))}' \
+            if offset + size < len(self.project_keys) else None
+        return web.json_response({'hits': hits, 'pagination': {'next': next_url, 'total': len(self.project_keys)}})
+
+    async def project(self, request):
+        await self.delay()
+        project_key = request.match_info['project_key']
+        if project_key not in self.projects:
+            raise web.HTTPNotFound()
+        body, etag = self.body(project_key)
+        if request.headers.get('If-None-Match') == etag:
+            return web.Response(status=304, headers={'ETag': etag})
+        return web.Response(body=body, content_type='application/json', headers={'ETag': etag})
+
+    async def file(self, request):
+        await self.delay(fail=False)
+        name = os.path.basename(request.match_info['name'])
+        path = os.path.join(self.files_directory or '', name)
+        if not self.files_directory or not os.path.isfile(path):
+            raise web.HTTPNotFound()
+        # FileResponse answers Range requests with a 206 and sends the file with sendfile
+        return web.FileResponse(path)
+
+    def application(self):
+        app = web.Application()
+        app.router.add_get('/index/projects/', self.listing)
+        app.router.add_get('/index/projects/{project_key}', self.project)
+        app.router.add_get('/repository/files/{name}', self.file)
+        return app
+
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+class AzulProcess:
+    # runs the stand-in in its own process, so that it neither competes with the client for the GIL nor shows up
+    # in the client's CPU time
+    def __init__(self, catalog_path, files_directory=None, latency=0, error_rate=0, port=None):
+        self.port = port if port is not None else free_port()
+        self.arguments = [sys.executable, os.path.abspath(__file__), '--catalog', catalog_path, '--port',
+                          str(self.port), '--latency', str(latency), '--error-rate', str(error_rate)]
+        if files_directory is not None:
+            self.arguments += ['--files', files_directory]
+        self.process = None
+
+    def __enter__(self):
+        self.process = subprocess.Popen(self.arguments, stdout=subprocess.PIPE, text=True)
+        if self.process.stdout.readline().strip() != 'ready':
+            raise RuntimeError("The Azul stand-in did not start.")
+        return self
+
+    def __exit__(self, *args):
+        self.process.terminate()
+        self.process.wait()
+
+    @property
+    def base_url(self):
+        return f'http://127.0.0.1:{self.port}'
+
+    @property
+    def directory(self):
+        return f'{self.base_url}/index/projects/'
+
+
+async def serve(server, port):
+    runner = web.AppRunner(server.application(), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', port).start()
+    print('ready', flush=True)
+    await asyncio.Event().wait()
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--catalog', required=True)
+    arg_parser.add_argument('--files')
+    arg_parser.add_argument('--port', type=int, default=8000)
+    arg_parser.add_argument('--latency', type=float, default=0)
+    arg_parser.add_argument('--error-rate', type=float, default=0)
+    args = arg_parser.parse_args()
+    with open(args.catalog) as catalog_json:
+        projects = json.load(catalog_json)
+    asyncio.run(serve(AzulServer(projects, args.files, args.latency, args.error_rate), args.port))
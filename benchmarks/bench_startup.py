@@ -0,0 +1,56 @@
+# Cold HCAParser() construction time and resident memory, JSON file vs SQLite store.
+#
+# Target: constructing a parser over the store takes under 50 ms and adds under 5 MB of resident memory
+# regardless of catalog size, while the JSON path grows linearly with the catalog.
+#
+#   PYTHONPATH=. python benchmarks/bench_startup.py --projects 3000
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from benchmarks.catalog import write_catalog
+
+# /proc/self/statm is Linux only. elsewhere the growth of the peak resident size is reported, ru_maxrss is in bytes
+# on macOS and in kilobytes on the other platforms, and without the resource module (Windows) there is no memory figure
+MEASURE = '''
+import json, os, sys, time
+from pascrd.api.human_cell_atlas import HCAParser
+try:
+    import resource
+except ImportError:
+    resource = None
+def rss_mb():
+    if os.path.isfile("/proc/self/statm"):
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize() / 2 ** 20
+    if resource is not None:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024) / 2 ** 20
+    return None
+before = rss_mb()
+start = time.perf_counter()
+parser = HCAParser(metadata_path=sys.argv[1])
+elapsed = time.perf_counter() - start
+after = rss_mb()
+print(json.dumps({"seconds": elapsed, "rss_mb": after - before if after is not None else None}))
+'''
+
+
+def measure(path, repeats):
+    runs = [json.loads(subprocess.check_output([sys.executable, '-c', MEASURE, path])) for _ in range(repeats)]
+    rss = [run["rss_mb"] for run in runs if run["rss_mb"] is not None]
+    return {"seconds": min(run["seconds"] for run in runs), "rss_mb": min(rss) if rss else None}
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--projects', type=int, default=3000)
+    arg_parser.add_argument('--repeats', type=int, default=3)
+    args = arg_parser.parse_args()
+    with tempfile.TemporaryDirectory() as directory:
+        json_path, store_path = write_catalog(directory, args.projects)
+        results = {"projects": args.projects,
+                   "json": dict(measure(json_path, args.repeats), size_mb=os.path.getsize(json_path) / 2 ** 20),
+                   "sqlite": dict(measure(store_path, args.repeats), size_mb=os.path.getsize(store_path) / 2 ** 20)}
+    print(json.dumps(results, indent=1))
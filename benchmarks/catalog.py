@@ -0,0 +1,174 @@
+# Synthetic HCA catalogs shaped like the project records of the Azul index/projects endpoint, for benchmarks at
+# catalog sizes larger than the live one.
+#
+#   PYTHONPATH=. python benchmarks/catalog.py --projects 20000 --output /tmp/catalog
+import argparse
+import json
+import os
+import random
+import uuid
+
+GENUS_SPECIES = ["Homo sapiens", "Mus musculus"]
+DEVELOPMENT_STAGES = ["adult", "child", "fetal", "human adult stage", "embryonic", "elderly", "neonatal"]
+ORGANS = ["blood", "brain", "heart", "lung", "kidney", "liver", "pancreas", "skin", "bone marrow", "esophagus",
+          "nose", "breast", "eye", "spleen", "thymus", "colon", "stomach", "muscle organ", "adipose tissue",
+          "lymph node", "prostate gland", "testis", "ovary", "placenta", "embryo", "retina", "tonsil", "trachea"]
+ORGAN_PARTS = ["venous blood", "cortex", "left ventricle", "alveolus", "renal medulla", "hepatic lobule",
+               "islet of Langerhans", "dermis", "lower esophagus", "nasal cavity epithelium", "mammary gland",
+               "retinal pigment epithelium", "white pulp", "colonic mucosa", "gastric mucosa"]
+DISEASES = ["normal", "COVID-19", "type 2 diabetes mellitus", "asthma", "breast cancer", "Alzheimer disease",
+            "chronic obstructive pulmonary disease", "hepatocellular carcinoma", "multiple sclerosis",
+            "ulcerative colitis", "melanoma", "glioblastoma"]
+LIBRARY_APPROACHES = ["10x 3' v2", "10x 3' v3", "10x 5' v1", "10x 5' v2", "Smart-seq2", "Drop-seq", "inDrop",
+                      "CEL-seq2", "sci-RNA-seq", "10x multiome"]
+NUCLEIC_ACID_SOURCES = ["single cell", "single nucleus", "bulk cell"]
+INSTRUMENTS = ["Illumina NovaSeq 6000", "Illumina HiSeq 2500", "Illumina HiSeq 4000", "Illumina NextSeq 500",
+               "Illumina HiSeq X"]
+CELL_TYPES = ["CD4 T-Cell", "B cell", "neuron", "hepatocyte", "cardiomyocyte", "keratinocyte", "macrophage",
+              "endothelial cell", "fibroblast", "epithelial cell", "natural killer cell", "monocyte",
+              "astrocyte", "pancreatic beta cell", "alveolar type II cell", "T cell", "dendritic cell"]
+PRESERVATION = [None, "fresh", "cryopreservation, other", "cryopreservation in liquid nitrogen (dead tissue)"]
+INSTITUTIONS = ["Broad Institute", "Wellcome Sanger Institute", "Stanford University", "University of Cambridge",
+                "Karolinska Institutet", "Chan Zuckerberg Biohub", "University of Toronto", "Harvard Medical School",
+                "Lunenfeld-Tanenbaum Research Institute", "RIKEN", "Max Delbrueck Center", "UCSF"]
+ROLES = ["principal investigator", "experimental scientist", "computational scientist", "data curator",
+         "co-investigator"]
+FORMATS = ["h5ad", "loom", "mtx", "rds", "csv", "tsv"]
+CONTENT = ["Count Matrix", "Normalized Matrix", "Cell Annotations", "Gene Annotations"]
+WORDS = ["atlas", "single-cell", "transcriptomic", "profiling", "of", "the", "human", "developing", "adult",
+         "landscape", "immune", "response", "reveals", "heterogeneity", "spatial", "multi-omic", "cell", "types",
+         "in", "healthy", "diseased", "tissue", "lineage", "states", "across", "donors"]
+
+
+def pick(rng, values, low=1, high=3):
+    return sorted(set(rng.choice(values) for _ in range(rng.randint(low, high))), key=str)
+
+
+def generate_file(rng, identifier, catalog, file_base_url, max_file_size):
+    file_format = rng.choice(FORMATS)
+    file_uuid = str(uuid.UUID(int=rng.getrandbits(128)))
+    size = rng.randint(1024, max_file_size)
+    return {"name": f"{identifier[:8]}_{file_uuid[:8]}.{file_format}",
+            "url": f"{file_base_url}/{file_uuid}?catalog={catalog}",
+            "size": size, "sha256": "%064x" % rng.getrandbits(256), "uuid": file_uuid,
+            "version": f"20{rng.randint(18, 24)}-0{rng.randint(1, 9)}-1{rng.randint(0, 9)}T16:56:40.419579Z",
+            "format": file_format, "contentDescription": pick(rng, CONTENT, 1, 2),
+            "isIntermediate": rng.random() < 0.2}
+
+
+def generate_matrices(rng, identifier, species, stages, organs, approaches, catalog, file_base_url, max_file_size):
+    # genusSpecies -> developmentStage -> organ -> libraryConstructionApproach -> files, as Azul nests them
+    tree = {"genusSpecies": {}}
+    for genus in species:
+        stage_tree = tree["genusSpecies"].setdefault(genus, {"developmentStage": {}})["developmentStage"]
+        for stage in stages:
+            organ_tree = stage_tree.setdefault(stage, {"organ": {}})["organ"]
+            for organ in organs:
+                organ_tree[organ] = {"libraryConstructionApproach": {
+                    approach: [generate_file(rng, identifier, catalog, file_base_url, max_file_size)
+                               for _ in range(rng.randint(1, 3))] for approach in approaches}}
+    return tree
+
+
+def generate_project(rng, identifier, catalog="dcp24", file_base_url="https://service.azul.data.humancellatlas.org"
+                     "/repository/files", max_file_size=2 * 1024 ** 3):
+    species = pick(rng, GENUS_SPECIES, 1, 1)
+    stages = pick(rng, DEVELOPMENT_STAGES, 1, 2)
+    organs = pick(rng, ORGANS, 1, 3)
+    organ_parts = pick(rng, ORGAN_PARTS, 1, 3)
+    diseases = pick(rng, DISEASES, 1, 2)
+    approaches = pick(rng, LIBRARY_APPROACHES, 1, 2)
+    cell_types = pick(rng, CELL_TYPES, 1, 4)
+    title_words = [rng.choice(WORDS) for _ in range(rng.randint(4, 10))]
+    title = " ".join(title_words).capitalize() + f" {identifier[:4]}"
+    total_cells = rng.randint(500, 2000000)
+    contributors = [{"contactName": f"{rng.choice(['Jane', 'John', 'Ana', 'Wei', 'Sam'])},,"
+                                    f"{rng.choice(['Doe', 'Smith', 'Chen', 'Garcia', 'Khan'])}",
+                     "correspondingContributor": rng.random() < 0.3,
+                     "email": f"contributor{rng.randint(0, 10 ** 6)}@example.org",
+                     "institution": rng.choice(INSTITUTIONS), "laboratory": f"{rng.choice(WORDS).title()} Lab",
+                     "projectRole": rng.choice(ROLES)} for _ in range(rng.randint(1, 8))]
+    matrices = generate_matrices(rng, identifier, species, stages, organs, approaches, catalog, file_base_url,
+                                 max_file_size)
+    contributed = generate_matrices(rng, identifier, species, stages, organs[:1], approaches[:1], catalog,
+                                    file_base_url, max_file_size) if rng.random() < 0.5 else {}
+    files = [file_info for organ_tree in [matrices, contributed] for file_info in iterate_files(organ_tree)]
+    summaries = {}
+    for file_info in files:
+        summary = summaries.setdefault(file_info["format"], {"format": file_info["format"], "count": 0,
+                                                             "totalSize": 0, "contentDescription": []})
+        summary["count"] += 1
+        summary["totalSize"] += file_info["size"]
+        summary["contentDescription"] = sorted(set(summary["contentDescription"] + file_info["contentDescription"]))
+    return {
+        "protocols": [{"libraryConstructionApproach": approaches, "nucleicAcidSource": pick(rng, NUCLEIC_ACID_SOURCES,
+                                                                                           1, 1)},
+                      {"instrumentManufacturerModel": pick(rng, INSTRUMENTS, 1, 2)}],
+        "entryId": identifier,
+        "projects": [{"projectId": identifier, "projectTitle": title,
+                      "projectShortname": "".join(word.title() for word in title_words[:3]) + identifier[:4],
+                      "laboratory": sorted(set(contributor["laboratory"] for contributor in contributors)),
+                      "estimatedCellCount": total_cells, "contributors": contributors,
+                      "publications": [{"publicationTitle": title + " atlas",
+                                        "doi": f"10.{rng.randint(1000, 9999)}/{identifier[:8]}"
+                                        if rng.random() < 0.7 else None}],
+                      "supplementaryLinks": [None],
+                      "matrices": matrices, "contributedAnalyses": contributed,
+                      "accessions": [{"namespace": "geo_series", "accession": f"GSE{rng.randint(10000, 250000)}"}]
+                      if rng.random() < 0.6 else []}],
+        "samples": [{"sampleEntityType": ["specimens"], "organ": organs, "effectiveOrgan": organs,
+                     "disease": diseases, "preservationMethod": pick(rng, PRESERVATION, 1, 1)}],
+        "specimens": [{"organ": organs, "organPart": organ_parts, "disease": diseases,
+                       "preservationMethod": pick(rng, PRESERVATION, 1, 1), "source": ["specimen_from_organism"]}],
+        "cellLines": [],
+        "donorOrganisms": [{"genusSpecies": species, "biologicalSex": pick(rng, ["female", "male", "unknown"], 1, 2),
+                            "disease": diseases, "donorCount": rng.randint(1, 300), "developmentStage": stages}],
+        "organoids": [],
+        "cellSuspensions": [{"organ": organs, "organPart": organ_parts, "selectedCellType": cell_types,
+                             "totalCells": total_cells}],
+        "fileTypeSummaries": list(summaries.values()),
+        "dates": [{"lastModifiedDate": f"20{rng.randint(19, 24)}-0{rng.randint(1, 9)}-01T11:24:16.137000Z"}]
+    }
+
+
+def iterate_files(tree):
+    if isinstance(tree, list):
+        yield from tree
+    elif isinstance(tree, dict):
+        for value in tree.values():
+            yield from iterate_files(value)
+
+
+def generate_catalog(projects, seed=0, **kwargs):
+    # the same seed always gives the same catalog, so results of different versions can be compared
+    rng = random.Random(seed)
+    catalog = {}
+    for _ in range(projects):
+        identifier = str(uuid.UUID(int=rng.getrandbits(128), version=4))
+        catalog[identifier] = generate_project(rng, identifier, **kwargs)
+    return catalog
+
+
+def write_catalog(directory, projects, seed=0, search_options=False, **kwargs):
+    # collecting the search options for the store is left out by default, it is benchmarked on its own
+    from pascrd.index import HCASearchOptions
+    from pascrd.store import HCAMetadataStore
+    catalog = generate_catalog(projects, seed, **kwargs)
+    json_path = os.path.join(directory, 'hca.json')
+    with open(json_path, 'w') as metadata_json:
+        json.dump(catalog, metadata_json)
+    store_path = os.path.join(directory, 'hca.sqlite')
+    store = HCAMetadataStore(store_path)
+    store.replace(catalog, HCASearchOptions(catalog) if search_options else None)
+    store.close()
+    return json_path, store_path
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--projects', type=int, default=1000)
+    arg_parser.add_argument('--seed', type=int, default=0)
+    arg_parser.add_argument('--output', required=True)
+    args = arg_parser.parse_args()
+    os.makedirs(args.output, exist_ok=True)
+    print(write_catalog(args.output, args.projects, args.seed))
@@ -0,0 +1,224 @@
+# Offline benchmark suite over synthetic catalogs and the local Azul stand-in:
+#
+#   construction   cold HCAParser() time and resident memory, JSON file vs SQLite store
+#   search         index build, full, partial, intersection and range queries against the store
+#   search options _collect_search_options over the JSON catalog
+#   fetch          collect_project_metadata with discovery, then an incremental refresh answered with 304s
+#   downloads      download_to_path with one and several connections, bulk_download_files over one project
+#
+# Results are written as JSON together with the version they were measured on, --compare prints the ratio of every
+# measurement to an earlier results file.
+#
+#   PYTHONPATH=. python benchmarks/run_benchmarks.py --projects 500 5000 20000 --output results.json
+import argparse
+import hashlib
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import tempfile
+import time
+from datetime import datetime, timezone
+from tqdm import tqdm
+from benchmarks.azul import AzulProcess, free_port
+from benchmarks.bench_startup import measure as measure_construction
+from benchmarks.catalog import generate_catalog, write_catalog
+from pascrd.api.human_cell_atlas import HCAParser
+from pascrd.query import Range
+from pascrd.download import create_download_session, download_to_path
+from pascrd.utils import bulk_download_files
+
+
+def timed(function, *args, **kwargs):
+    wall, cpu = time.perf_counter(), time.process_time()
+    result = function(*args, **kwargs)
+    return time.perf_counter() - wall, time.process_time() - cpu, result
+
+
+def median_seconds(function, arguments):
+    return statistics.median(timed(function, *elem)[0] for elem in arguments) if arguments else None
+
+
+def sample_queries(search_index, queries, rng):
+    # string values only, the values of the other types are a handful of numbers and booleans
+    options = {key: sorted(value for value in values if isinstance(value, str) and len(value) >= 3)
+               for key, values in search_index.fields.items()}
+    keys = [key for key, values in options.items() if values]
+    full = [(key, rng.choice(options[key])) for key in rng.choices(keys, k=queries)]
+    partial = []
+    for key, value in full:
+        start = rng.randint(0, len(value) - 3)
+        partial.append((key, value[start:start + rng.randint(3, max(3, min(12, len(value) - start)))]))
+    return full, partial
+
+
+def bench_search(store_path, queries, rng):
+    parser = HCAParser(metadata_path=store_path)
+    build, _, _ = timed(lambda: parser.search_index)
+    full, partial = sample_queries(parser.search_index, queries, rng)
+    pairs = [{full[i][0]: full[i][1], full[-i - 1][0]: full[-i - 1][1]} for i in range(len(full) // 2)]
+    # the trigram postings of a field are built on its first partial query
+    partial_cold, _, _ = timed(lambda: [parser.search({key: value}, match_type="partial") for key, value in partial])
+    return {"index_build_seconds": build,
+            "full_query_seconds": median_seconds(lambda key, value: parser.search({key: value}), full),
+            "partial_cold_seconds": partial_cold,
+            "partial_query_seconds": median_seconds(
+                lambda key, value: parser.search({key: value}, match_type="partial"), partial),
+            "union_query_seconds": median_seconds(lambda query: parser.search(query), [[elem] for elem in pairs]),
+            "intersection_query_seconds": median_seconds(
+                lambda query: parser.search(query, search_type="intersection"), [[elem] for elem in pairs]),
+            "range_query_seconds": median_seconds(lambda query: parser.search(query), [
+                [Range("estimatedCellCount", minimum=rng.randint(0, 200000))] for _ in range(queries)] + [
+                [Range("donorCount", low, low + rng.randint(0, 50))] for low in rng.choices(range(300), k=queries)]),
+            "queries": len(full)}
+
+
+def bench_search_options(json_path):
+    parser = HCAParser(metadata_path=json_path)
+    seconds, cpu, search_options = timed(parser._collect_search_options)
+    return {"seconds": seconds, "fields": len(search_options),
+            "values": sum(len(values) for values in search_options.values())}
+
+
+def bench_fetch(catalog, directory, latency, error_rate, max_concurrency):
+    catalog_path = os.path.join(directory, 'served.json')
+    with open(catalog_path, 'w') as catalog_json:
+        json.dump(catalog, catalog_json)
+    with AzulProcess(catalog_path, latency=latency, error_rate=error_rate) as server:
+        parser = HCAParser(repo_directory=server.directory, cache_directory=os.path.join(directory, 'cache'),
+                           metadata_path=os.path.join(directory, 'cache', 'hca.sqlite'),
+                           max_concurrency=max_concurrency, session_backoff=0)
+        seconds, cpu, report = timed(parser.collect_project_metadata, verbose=False, incremental=True, discover=True)
+        refresh_seconds, refresh_cpu, refresh = timed(parser.collect_project_metadata, verbose=False,
+                                                      incremental=True, discover=True)
+    return {"projects": len(catalog), "seconds": seconds, "cpu_seconds": cpu,
+            "projects_per_second": len(catalog) / seconds, "failed": len(report.failed),
+            "refresh_seconds": refresh_seconds, "refresh_not_modified": len(refresh.not_modified)}
+
+
+def write_random_file(path, size):
+    sha256 = hashlib.sha256()
+    with open(path, 'wb') as f:
+        for start in range(0, size, 2 ** 20):
+            block = os.urandom(min(2 ** 20, size - start))
+            f.write(block)
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def bench_downloads(directory, size_mb, connections, bulk_files, latency):
+    files_directory = os.path.join(directory, 'files')
+    os.makedirs(files_directory)
+    size = size_mb * 2 ** 20
+    write_random_file(os.path.join(files_directory, 'matrix.h5ad'), size)
+    port = free_port()
+    base_url = f'http://127.0.0.1:{port}/repository/files'
+    bulk = [{'name': f'part_{i}.h5ad', 'url': f'{base_url}/part_{i}.h5ad', 'size': size // bulk_files,
+             'sha256': write_random_file(os.path.join(files_directory, f'part_{i}.h5ad'), size // bulk_files)}
+            for i in range(bulk_files)]
+    project = {'entryId': 'downloads', 'projects': [{'projectTitle': 'downloads',
+                                                     'matrices': {'organ': {'blood': bulk}},
+                                                     'contributedAnalyses': {}}]}
+    catalog_path = os.path.join(directory, 'downloads.json')
+    with open(catalog_path, 'w') as catalog_json:
+        json.dump({'downloads': project}, catalog_json)
+
+    results = {"size_mb": size_mb}
+    with AzulProcess(catalog_path, files_directory, latency=latency, port=port) as server:
+        for label, parts in [("single_connection", 1), (f"{connections}_connections", connections)]:
+            output_path = os.path.join(directory, 'matrix.h5ad')
+            with tqdm(unit='B', unit_scale=True, unit_divisor=1024, disable=True) as bar:
+                seconds, cpu, _ = timed(download_to_path, f'{base_url}/matrix.h5ad', output_path,
+                                        connections=parts, session=create_download_session(pool_size=parts),
+                                        progress=bar, min_part_size=16 * 2 ** 20)
+            os.remove(output_path)
+            results[label] = {"mb_per_second": size_mb / seconds, "cpu_seconds_per_gb": cpu / (size / 2 ** 30)}
+        seconds, cpu, failures = timed(bulk_download_files, f'{server.directory}downloads',
+                                       os.path.join(directory, 'bulk'), workers=min(bulk_files, 4))
+        results["bulk_download_files"] = {"files": bulk_files, "mb_per_second": size_mb / seconds,
+                                          "cpu_seconds_per_gb": cpu / (size / 2 ** 30), "failed": len(failures)}
+    return results
+
+
+def version():
+    try:
+        from importlib.metadata import version as package_version
+        installed = package_version('pascrd')
+    except Exception:
+        installed = None
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                         cwd=os.path.dirname(os.path.abspath(__file__)), text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {"pascrd": installed, "commit": commit, "python": platform.python_version(),
+            "platform": platform.platform(), "created": datetime.now(timezone.utc).isoformat()}
+
+
+def run(projects, queries=200, construction_repeats=3, fetch_projects=2000, latency=0.005, error_rate=0.0,
+        max_concurrency=16, download_mb=256, connections=4, bulk_files=8, seed=0):
+    results = {"version": version(), "catalogs": {}}
+    rng = random.Random(seed)
+    for size in projects:
+        with tempfile.TemporaryDirectory() as directory:
+            json_path, store_path = write_catalog(directory, size, seed)
+            results["catalogs"][str(size)] = {
+                "json_mb": os.path.getsize(json_path) / 2 ** 20, "sqlite_mb": os.path.getsize(store_path) / 2 ** 20,
+                "construction": {"json": measure_construction(json_path, construction_repeats),
+                                 "sqlite": measure_construction(store_path, construction_repeats)},
+                "search": bench_search(store_path, queries, rng),
+                "search_options": bench_search_options(json_path)}
+    if fetch_projects:
+        with tempfile.TemporaryDirectory() as directory:
+            results["fetch"] = dict(bench_fetch(generate_catalog(fetch_projects, seed), directory, latency,
+                                                error_rate, max_concurrency), latency=latency, error_rate=error_rate)
+    if download_mb:
+        with tempfile.TemporaryDirectory() as directory:
+            results["downloads"] = bench_downloads(directory, download_mb, connections, bulk_files, latency)
+    return results
+
+
+def flatten(results, prefix=''):
+    for key, value in results.items():
+        if isinstance(value, dict):
+            yield from flatten(value, f'{prefix}{key}.')
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield f'{prefix}{key}', value
+
+
+def compare(previous, current):
+    # the ratio current / previous of every measurement both results share, for seconds lower is better and for
+    # rates higher is better
+    previous_values = dict(flatten(previous))
+    return {key: value / previous_values[key] for key, value in flatten(current)
+            if previous_values.get(key) and not key.startswith('version.')}
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--projects', type=int, nargs='+', default=[500, 5000, 20000])
+    arg_parser.add_argument('--queries', type=int, default=200)
+    arg_parser.add_argument('--construction-repeats', type=int, default=3)
+    arg_parser.add_argument('--fetch-projects', type=int, default=2000)
+    arg_parser.add_argument('--latency', type=float, default=0.005)
+    arg_parser.add_argument('--error-rate', type=float, default=0.0)
+    arg_parser.add_argument('--max-concurrency', type=int, default=16)
+    arg_parser.add_argument('--download-mb', type=int, default=256)
+    arg_parser.add_argument('--connections', type=int, default=4)
+    arg_parser.add_argument('--bulk-files', type=int, default=8)
+    arg_parser.add_argument('--seed', type=int, default=0)
+    arg_parser.add_argument('--output', default='benchmark_results.json')
+    arg_parser.add_argument('--compare')
+    args = arg_parser.parse_args()
+    results = run(args.projects, args.queries, args.construction_repeats, args.fetch_projects, args.latency,
+                  args.error_rate, args.max_concurrency, args.download_mb, args.connections, args.bulk_files, args.seed)
+    results["arguments"] = {key: value for key, value in vars(args).items() if key not in ['output', 'compare']}
+    with open(args.output, 'w') as results_json:
+        json.dump(results, results_json, indent=1)
+    print(json.dumps(results, indent=1))
+    if args.compare:
+        with open(args.compare) as previous_json:
+            for key, ratio in compare(json.load(previous_json), results).items():
+                print(f'{key}: {ratio:.2f}x')
@@ -0,0 +1,73 @@
+import asyncio
+import json
+import re
+from urllib.parse import urlparse
+import aiohttp
+from pascrd.fetch import request_with_retries
+
+FIGSHARE_API = 'https://api.figshare.com/v2'
+
+
+def figshare_article_version(url):
+    # https://figshare.com/articles/dataset/<title>/<id> with an optional /<version> at the end, returns the id and
+    # the version, None for the latest one
+    parts = urlparse(url).path.rstrip('/').split('/')
+    if len(parts) >= 2 and parts[-1].isdigit() and parts[-2].isdigit():
+        return parts[-2], parts[-1]
+    if parts[-1].isdigit():
+        return parts[-1], None
+    raise ValueError(f"Unable to find a figshare article id in {url}.")
+
+
+def figshare_article_id(url):
+    return figshare_article_version(url)[0]
+
+
+def tabula_sapiens_dataset_key(file_name):
+    return re.sub(r'^.*?TS_', '', file_name).split('.h5ad')[0].title()
+
+
+async def list_article_files(article_id, api_url=FIGSHARE_API, page_size=100, concurrency=4, retries=3,
+                             backoff=0.5, timeout=60, version=None):
+    # figshare does not report the number of files of an article, so pages are requested in concurrent batches
+    # until one of them comes back short. a given version is read from the version record instead, which lists
+    # its files
+    url = f"{api_url.rstrip('/')}/articles/{article_id}/files"
+    client_timeout = aiohttp.ClientTimeout(total=timeout)
+    files = []
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=concurrency)) as session:
+        if version is not None:
+            status, headers, body = await request_with_retries(
+                session, f"{api_url.rstrip('/')}/articles/{article_id}/versions/{version}", retries=retries,
+                backoff=backoff, timeout=client_timeout)
+            return json.loads(body)['files']
+
+        async def get_page(page):
+            status, headers, body = await request_with_retries(session, url, retries=retries, backoff=backoff,
+                                                               timeout=client_timeout,
+                                                               params={'page': page, 'page_size': page_size})
+            return json.loads(body)
+
+        page = 1
+        while True:
+            pages = await asyncio.gather(*[get_page(page + i) for i in range(concurrency)])
+            for found in pages:
+                files.extend(found)
+            if any(len(found) < page_size for found in pages):
+                return files
+            page += concurrency
+
+
+def collect_figshare_download_links(url, api_url=FIGSHARE_API, page_size=100, concurrency=4):
+    # returns the same organ -> download url mapping as scraping the article page, together with the file records
+    # of the listed archives and the number of files of the article
+    article_id, version = figshare_article_version(url)
+    files = asyncio.run(list_article_files(article_id, api_url, page_size, concurrency, version=version))
+    download_links = {}
+    dataset_files = {}
+    for file_record in files:
+        if "zip" in file_record['name']:
+            key = tabula_sapiens_dataset_key(file_record['name'])
+            download_links[key] = file_record['download_url']
+            dataset_files[key] = file_record
+    return download_links, dataset_files, len(files)
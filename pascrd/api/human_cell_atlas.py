@@ -5,37 +5,89 @@ from urllib3.util.retry import Retry
 import requests
 import logging
 import json
-from pascrd.utils import search_through_hca_metadata_for_value, collect_unique_hca_metadata_fields
+import hashlib
+import time
+from pascrd.index import HCAMetadataIndex, HCASearchOptions
+from pascrd.download import DownloadJob, DownloadScheduler
+from pascrd.utils import default_cache_directory, file_output_path, iterate_matrices_tree
+from pascrd.store import HCAMetadataStore
+from pascrd.metrics import NULL_INSTRUMENTATION
+from pascrd.query import HCAQuery, compile_search
+from pascrd.fetch import HCAFetchError, HCAFetchReport, iterate_project_identifiers, request_with_retries
 import asyncio
 import aiohttp
 
 
+def default_metadata_path(cache_directory):
+    # a store refreshed into the cache directory takes precedence over the one shipped with the package, a hca.json
+    # from an older release is still read if it is the only one present
+    data_directory = os.path.abspath(os.path.join(os.path.dirname(__file__), 'data'))
+    for path in [os.path.join(cache_directory, 'hca.sqlite'), os.path.join(data_directory, 'hca.sqlite'),
+                 os.path.join(data_directory, 'hca.json')]:
+        if os.path.isfile(path):
+            return path
+    return os.path.join(data_directory, 'hca.sqlite')
+
+
 class HCAParser:
     def __init__(self, repo_directory="https://service.azul.data.humancellatlas.org/index/projects/",
-                 session_retries=3, session_backoff=0.5):
+                 session_retries=3, session_backoff=0.5, metadata_path=None, cache_directory=None,
+                 max_concurrency=16, per_host_limit=None, request_timeout=60, instrumentation=None):
         self.process_count = None
         self.directory = repo_directory
+        self.session_retries = session_retries
+        self.session_backoff = session_backoff
+        self.max_concurrency = max_concurrency
+        # every project is on the same host, more workers than connections to it would only wait for one
+        self.per_host_limit = per_host_limit if per_host_limit is not None else max_concurrency
+        self.request_timeout = request_timeout
+        self.fetch_report = HCAFetchReport()
         self.session = requests.Session()
         session_retry = Retry(connect=session_retries, backoff_factor=session_backoff)
         session_adapter = HTTPAdapter(max_retries=session_retry)
         self.session.mount('http://', session_adapter)
         self.session.mount('https://', session_adapter)
         self.project_identifiers = {}
-        logging.basicConfig(level=logging.INFO)
-        self.logger = logging.getLogger()
+        self.logger = logging.getLogger(__name__)
+        # receives the fetch, search and cache events described in pascrd.metrics
+        self.instrumentation = instrumentation if instrumentation is not None else NULL_INSTRUMENTATION
         self.catalog = None
-        if os.path.isfile(str(os.path.abspath(os.path.join(os.path.dirname(__file__),
-                                                           'data', 'hca.json')))):
-            with open(str(os.path.abspath(os.path.join(os.path.dirname(__file__),
-                                                       'data', 'hca.json')))) as metadata_json:
+        self.cache_directory = cache_directory if cache_directory is not None else default_cache_directory()
+        self.metadata_path = metadata_path if metadata_path is not None else \
+            default_metadata_path(self.cache_directory)
+        # refreshed metadata is written here rather than into the installed package
+        self.local_path = metadata_path if metadata_path is not None else \
+            os.path.join(self.cache_directory, 'hca.sqlite')
+        self.project_fingerprints = {}
+        self.changed_projects = set()
+        if not os.path.isfile(self.metadata_path):
+            self.project_metadata = None
+        elif self.metadata_path.endswith('.json'):
+            with open(self.metadata_path) as metadata_json:
                 self.project_metadata = json.load(metadata_json)
         else:
-            self.project_metadata = None
+            self.project_metadata = HCAMetadataStore(self.metadata_path, readonly=True,
+                                                     instrumentation=self.instrumentation)
 
         self.search_results = None
-        self.search_options = None
-        if self.project_metadata is not None:
-            self._collect_search_options()
+        # both are built on first access, see the properties below
+        self._search_options = None
+        self._search_index = None
+
+    @property
+    def search_options(self):
+        if self._search_options is None and self.project_metadata is not None:
+            if isinstance(self.project_metadata, HCAMetadataStore):
+                self._search_options = self.project_metadata.search_options()
+            if self._search_options is None:
+                self._collect_search_options()
+        return self._search_options
+
+    @property
+    def search_index(self):
+        if self._search_index is None and self.project_metadata is not None:
+            self._build_search_index()
+        return self._search_index
 
     def collect_project_identifiers(self):
         with urllib.request.urlopen(self.directory) as project_url:
@@ -49,85 +101,303 @@ class HCAParser:
         return f'{self.directory}/{project}' if not self.directory.endswith('/') else f'{self.directory}{project}'
 
     async def get_hca_url(self, identifier, session, verbose=True):
+        url = self.get_project_json_url(identifier)
+        fingerprint = self.project_fingerprints.get(identifier, {})
+        headers = {}
+        if fingerprint.get('etag'):
+            headers['If-None-Match'] = fingerprint['etag']
+        if fingerprint.get('last_modified'):
+            headers['If-Modified-Since'] = fingerprint['last_modified']
+        start = time.perf_counter() if self.instrumentation.enabled else None
         try:
-            url = self.get_project_json_url(identifier)
-            async with session.get(url=url, params={'catalog': self.catalog}) as response:
-                finding = await response.json()
-                self.project_metadata[identifier] = finding
-                self.process_count += 1
-                if verbose and self.process_count % 10 == 0:
-                    self.logger.info(f"Processing dataset {self.process_count} of {len(self.project_identifiers)}")
-        except Exception as e:
-            self.logger.info("Unable to get url {} due to {}.".format(url, e.__class__))
-    
-    async def main(self, query_dict, verbose=True):
-        async with aiohttp.ClientSession() as session:
-            await asyncio.gather(*[self.get_hca_url(query_value, session, verbose) for query_key, query_value in
-                                   query_dict.items()])
-
-    def collect_project_metadata(self, verbose=True, catalog="dcp24", write_local=True):
+            status, response_headers, body = await request_with_retries(
+                session, url, retries=self.session_retries, backoff=self.session_backoff,
+                timeout=self._client_timeout(), instrumentation=self.instrumentation,
+                params={'catalog': self.catalog}, headers=headers)
+        except HCAFetchError as e:
+            self.fetch_report.add_failure(identifier, e)
+            self.logger.warning(str(e))
+            return False
+        cache = 'not_modified'
+        if status == 304:
+            self.fetch_report.not_modified.append(identifier)
+        else:
+            cache = 'unchanged'
+            digest = hashlib.sha256(body).hexdigest()
+            # unchanged bodies are not rewritten either, whether the server ignored the conditional
+            # headers or no fingerprint exists yet for this catalog
+            if digest != fingerprint.get('digest') or identifier not in self.project_metadata:
+                try:
+                    finding = json.loads(body)
+                except ValueError as e:
+                    self.fetch_report.add_failure(identifier, HCAFetchError(url, e.__class__.__name__, status))
+                    self.logger.warning(f"Unable to decode the metadata of {identifier} from {url}.")
+                    return False
+                if identifier not in self.project_metadata or self.project_metadata[identifier] != finding:
+                    if self._search_options is not None:
+                        self._update_search_options(identifier, finding)
+                    self.project_metadata[identifier] = finding
+                    self.changed_projects.add(identifier)
+                    cache = 'changed'
+            self.project_fingerprints[identifier] = {'etag': response_headers.get('ETag'),
+                                                     'last_modified': response_headers.get('Last-Modified'),
+                                                     'digest': digest}
+            self.fetch_report.fetched.append(identifier)
+        if self.instrumentation.enabled:
+            self.instrumentation.event('fetch.project', seconds=time.perf_counter() - start, bytes=len(body),
+                                       cache=cache)
+        self.process_count += 1
+        if verbose and self.process_count % 10 == 0:
+            self.logger.info(f"Processing dataset {self.process_count} of {len(self.project_identifiers)}")
+        return True
+
+    async def _stream(self, query_dict, verbose=True, discover=False):
+        # identifiers are queued as soon as they are known, so the metadata workers start on the first page of a
+        # discovery while the following pages are still being requested
+        connector = aiohttp.TCPConnector(limit=self.max_concurrency, limit_per_host=self.per_host_limit)
+        timeout = self._client_timeout()
+        worker_count = min(self.max_concurrency, self.per_host_limit)
+        identifiers = asyncio.Queue()
+        results = asyncio.Queue()
+
+        async with aiohttp.ClientSession(connector=connector) as session:
+            async def discover_identifiers():
+                try:
+                    queued = set()
+                    for query_value in (query_dict or {}).values():
+                        queued.add(query_value)
+                        await identifiers.put(query_value)
+                    if discover:
+                        async for term, project_id in iterate_project_identifiers(
+                                session, self.directory, self.catalog, retries=self.session_retries,
+                                backoff=self.session_backoff, timeout=timeout,
+                                instrumentation=self.instrumentation):
+                            self.project_identifiers[term] = project_id
+                            if project_id not in queued:
+                                queued.add(project_id)
+                                await identifiers.put(project_id)
+                finally:
+                    for _ in range(worker_count):
+                        await identifiers.put(None)
+
+            async def fetch_metadata():
+                try:
+                    while (identifier := await identifiers.get()) is not None:
+                        if await self.get_hca_url(identifier, session, verbose):
+                            await results.put((identifier, self.project_metadata[identifier]))
+                finally:
+                    await results.put(None)
+
+            discovery = asyncio.create_task(discover_identifiers())
+            workers = [asyncio.create_task(fetch_metadata()) for _ in range(worker_count)]
+            try:
+                finished = 0
+                while finished < len(workers):
+                    result = await results.get()
+                    if result is None:
+                        finished += 1
+                    else:
+                        yield result
+                # surfaces a failed discovery once the identifiers found before it have been fetched
+                await discovery
+                for worker in workers:
+                    await worker
+            finally:
+                for task in [discovery, *workers]:
+                    task.cancel()
+                await asyncio.gather(discovery, *workers, return_exceptions=True)
+
+    def _client_timeout(self):
+        # request_timeout bounds connecting and each read of a request, not its total time, which would include the
+        # wait for a free connection in the pool
+        return aiohttp.ClientTimeout(total=None, sock_connect=self.request_timeout, sock_read=self.request_timeout)
+
+    async def main(self, query_dict, verbose=True, discover=False):
+        async for _ in self._stream(query_dict, verbose, discover):
+            pass
+
+    async def stream_project_metadata(self, catalog="dcp24", verbose=True, discover=True, query_dict=None):
+        # yields (project id, metadata) as each project arrives, identifiers in query_dict are fetched in addition
+        # to the discovered ones. the results are kept in project_metadata but are not written to the local store
+        self._prepare_collection(catalog)
         self.project_metadata = {}
+        self.project_fingerprints = {}
+        async for result in self._stream(query_dict, verbose, discover):
+            yield result
+
+    def _prepare_collection(self, catalog):
         self.catalog = catalog
         self.process_count = 0
+        self.changed_projects = set()
+        self.fetch_report = HCAFetchReport()
+        self._search_options = None
+        self._search_index = None
+
+    def collect_project_metadata(self, verbose=True, catalog="dcp24", write_local=True, incremental=False,
+                                 discover=False):
+        if incremental and (not write_local or self.local_path.endswith('.json')):
+            raise ValueError("An incremental refresh keeps its state in a local SQLite store, write_local must be "
+                             "True and the metadata path must not be a json file.")
+        search_index, search_options = self._search_index, self._search_options
+        self._prepare_collection(catalog)
+
+        if incremental:
+            os.makedirs(os.path.dirname(os.path.abspath(self.local_path)), exist_ok=True)
+            if not isinstance(self.project_metadata, HCAMetadataStore) or self.project_metadata.readonly or \
+                    os.path.abspath(self.project_metadata.path) != os.path.abspath(self.local_path):
+                self.project_metadata = HCAMetadataStore(self.local_path, instrumentation=self.instrumentation)
+                search_options = None
+            else:
+                # an index over the same store is updated in place below rather than rebuilt
+                self._search_index = search_index
+            # the search options are updated as each changed project arrives
+            self._search_options = self._counted_search_options(search_options)
+            self.metadata_path = self.local_path
+            # fingerprints are only valid for the catalog they were recorded against
+            self.project_fingerprints = self.project_metadata.fingerprints(catalog)
+        else:
+            self.project_metadata = {}
+            self.project_fingerprints = {}
 
-        asyncio.run(self.main(self.project_identifiers, verbose))
+        asyncio.run(self.main(self.project_identifiers, verbose, discover))
+        if self.fetch_report.failed:
+            self.logger.warning(f"{len(self.fetch_report.failed)} of {len(self.project_identifiers)} projects could "
+                                f"not be fetched, see the fetch report for details.")
+
+        if incremental:
+            identifiers = set(self.project_identifiers.values())
+            removed = [project_key for project_key in self.project_metadata if identifiers and
+                       project_key not in identifiers]
+            for project_key in removed:
+                if self._search_options is not None:
+                    self._search_options.remove_project(self.project_metadata[project_key])
+                del self.project_metadata[project_key]
+            self.project_metadata.update_fingerprints(catalog, self.project_fingerprints)
+            if self.changed_projects or removed:
+                if self._search_index is not None:
+                    for project_key in removed:
+                        self._search_index.remove_project(project_key)
+                    for project_key in self.changed_projects:
+                        self._search_index.add_project(project_key, self.project_metadata[project_key])
+                if self._search_options is None:
+                    self._collect_search_options()
+                self.project_metadata.replace_search_options(self._search_options)
+            return self.fetch_report
 
         if write_local:
-            with open(str(os.path.abspath(os.path.join(os.path.dirname(__file__),
-                                                       'data', 'hca.json'))), 'w') as metadata_json:
-                json.dump(self.project_metadata, metadata_json)
+            os.makedirs(os.path.dirname(os.path.abspath(self.local_path)), exist_ok=True)
+            if self.local_path.endswith('.json'):
+                with open(self.local_path, 'w') as metadata_json:
+                    json.dump(self.project_metadata, metadata_json)
+            else:
+                store = HCAMetadataStore(self.local_path)
+                store.replace(self.project_metadata, self.search_options)
+                store.update_fingerprints(catalog, self.project_fingerprints)
+                store.close()
+            self.metadata_path = self.local_path
+        return self.fetch_report
 
     def search(self, search_dict=None, search_type="union", match_type="full"):
+        # search_dict maps keys to a value or a list of values, combined with search_type, and a value can be a
+        # numeric Range. it can also be a query composed of Match, Range, And, Or and Not from pascrd.query, which
+        # search_type and match_type do not apply to
         if search_type not in ["intersection", "union"]:
             raise ValueError("The argument search_type must be either of intersection or union.")
         if match_type not in ["full", "partial"]:
             raise ValueError("The argument match_type must be either of partial or full.")
 
-        search_results = []
-        for key, value in search_dict.items():
-            originally_list = isinstance(value, list)
-            value = [value] if not originally_list else value
-            if not originally_list:
-                one_search_results = []
-            for sub_search in value:
-                if originally_list:
-                    one_search_results = []
-                for project_key, project_values in self.project_metadata.items():
-                    for searched_elem in search_through_hca_metadata_for_value(project_values, key=key,
-                                                                               value=sub_search,
-                                                                           project_key=project_key,
-                                                                           search_type=match_type):
-                        if searched_elem not in one_search_results:
-                            one_search_results.append(searched_elem)
-                    if originally_list:
-                        search_results.append(one_search_results)
-            if not originally_list:
-                search_results.append(one_search_results)
-        if search_type == "union":
+        start = time.perf_counter() if self.instrumentation.enabled else None
+        query = search_dict if isinstance(search_dict, HCAQuery) else \
+            compile_search(search_dict or {}, search_type, match_type)
+        if query is None:
             found = []
-            for sub_list in search_results:
-                for elem in sub_list:
-                    if elem not in found:
-                        found.append(elem)
-            return found
-        elif search_type == "intersection":
-            counts = {}
-            for sub_list in search_results:
-                for elem in sub_list:
-                    if elem not in counts.keys():
-                        counts[elem] = 1
-                    else:
-                        counts[elem] += 1
-            return list({k: v for (k, v) in counts.items() if v == len(search_dict)}.keys())
+        elif isinstance(search_dict, HCAQuery) or search_type == "intersection":
+            found = self.search_index.ordered(self.search_index.evaluate(query))
+        else:
+            # keep the order of first appearance across the individual searches
+            found = {}
+            for sub_results in self.search_index.evaluate_terms(query.terms):
+                for elem in self.search_index.ordered({elem for elem in sub_results if elem not in found}):
+                    found[elem] = None
+            found = list(found)
+        if self.instrumentation.enabled:
+            self.instrumentation.event('search.query', seconds=time.perf_counter() - start, results=len(found),
+                                       search_type=search_type, match_type=match_type)
+        return found
+
+    def plan_downloads(self, projects, save_location, file_formats=None, min_size=None, max_size=None):
+        # an iterator of a DownloadJob for every file in the matrices and contributedAnalyses of projects (search
+        # results or project ids), read from the cached metadata. a file listed by several projects is planned once,
+        # under the directory of the first project, and files already downloaded are left out
+        projects = [projects] if isinstance(projects, str) else list(projects)
+        missing = [project_key for project_key in projects if self.project_metadata is None or
+                   project_key not in self.project_metadata]
+        if missing:
+            raise ValueError(f"The projects {', '.join(missing)} are not in the cached metadata, collect them with "
+                             f"collect_project_metadata first.")
+        file_formats = {elem.lstrip('.').casefold() for elem in file_formats} if file_formats is not None else None
+        return self._iterate_downloads(projects, save_location, file_formats, min_size, max_size)
+
+    def _iterate_downloads(self, projects, save_location, file_formats, min_size, max_size):
+        planned, output_paths = set(), set()
+        for project_key in projects:
+            for project in self.project_metadata[project_key].get('projects', []):
+                for key in ('matrices', 'contributedAnalyses'):
+                    for path, file_info in iterate_matrices_tree(project.get(key) or {}):
+                        # identical files are recognised by their checksum, by their url when there is none
+                        identity = file_info.get('sha256') or file_info['url']
+                        file_format = file_info.get('format') or os.path.splitext(file_info['name'])[1]
+                        size = file_info.get('size')
+                        if identity in planned or (file_formats is not None and
+                                                   file_format.lstrip('.').casefold() not in file_formats) or \
+                                (min_size is not None and (size is None or size < min_size)) or \
+                                (max_size is not None and (size is None or size > max_size)):
+                            continue
+                        planned.add(identity)
+                        output_path = file_output_path(os.path.join(save_location, project_key), file_info,
+                                                       output_paths)
+                        if not os.path.isfile(output_path):
+                            # Work around https://github.com/DataBiosphere/azul/issues/2908
+                            yield DownloadJob(file_info['url'].replace('/fetch', ''), output_path, size,
+                                              file_info.get('sha256'))
+
+    def download_projects(self, projects, save_location, file_formats=None, min_size=None, max_size=None,
+                          workers=4, max_bytes_per_second=None, connections=1):
+        # downloads the files planned by plan_downloads, each one starting while the rest of the plan is still
+        # being read. returns the failed jobs with their exception, like bulk_download_files
+        scheduler = DownloadScheduler(workers=workers, max_bytes_per_second=max_bytes_per_second, order=None,
+                                      connections=connections, instrumentation=self.instrumentation)
+        jobs = self.plan_downloads(projects, save_location, file_formats, min_size, max_size)
+        scheduler.start()
+        try:
+            for job in jobs:
+                os.makedirs(os.path.dirname(job.output_path), exist_ok=True)
+                scheduler.submit(job)
+        finally:
+            failures = scheduler.finish()
+        for job, error in failures.items():
+            self.logger.warning(f'Unable to download {job.url} to {job.output_path}: {error}')
+        return failures
+
+    def _build_search_index(self):
+        self._search_index = HCAMetadataIndex(self.project_metadata, self.instrumentation)
+        return self._search_index
 
     def _collect_search_options(self):
-        self.search_options = {}
-        for key, value in self.project_metadata.items():
-            for project_elem in collect_unique_hca_metadata_fields(value):
-                for sub_key, sub_value in project_elem.items():
-                    if sub_key not in self.search_options.keys():
-                        self.search_options[sub_key] = [sub_value]
-                    else:
-                        if sub_value not in self.search_options[sub_key]:
-                            self.search_options[sub_key].append(sub_value)
-        return self.search_options
+        self._search_options = HCASearchOptions(self.project_metadata)
+        return self._search_options
+
+    def _counted_search_options(self, search_options):
+        # options that can be updated project by project: the ones already in memory, else the counts kept in the
+        # store. None when neither exists, the options are then collected again after the refresh
+        if isinstance(search_options, HCASearchOptions):
+            return search_options
+        stored = self.project_metadata.search_options()
+        if stored is not None and stored.counted:
+            return HCASearchOptions.from_counts(stored)
+        return None
+
+    def _update_search_options(self, identifier, project_values):
+        if identifier in self.project_metadata:
+            self._search_options.remove_project(self.project_metadata[identifier])
+        self._search_options.add_project(project_values)
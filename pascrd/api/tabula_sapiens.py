@@ -1,27 +1,87 @@
 import logging
 import time
-import re
+import json
+import hashlib
 from selenium.webdriver.common.by import By
 from selenium import webdriver
 from selenium.webdriver.chrome.options import Options as ChromeOptions
 from selenium.webdriver.firefox.options import Options as FirefoxOptions
 from selenium.common.exceptions import StaleElementReferenceException, NoSuchElementException
-import requests
 import os
-from tqdm import *
 import zipfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from pascrd.download import download_to_path, stream_url
+from pascrd.extract import StreamingZipExtractor, extract_archive, is_h5ad_member
+from pascrd.api.figshare import FIGSHARE_API, collect_figshare_download_links, tabula_sapiens_dataset_key
+from pascrd.utils import default_cache_directory
+from pascrd.metrics import NULL_INSTRUMENTATION
+
+# bumped whenever the layout of the manifest changes, older manifests are then collected again
+MANIFEST_VERSION = 1
 
 
 class TabulaSapiensParser:
     def __init__(self, url='https://figshare.com/articles/dataset/Tabula_Sapiens_release_1_0/14267219',
-                 time_delay=0.1, browser="chrome"):
+                 time_delay=0.1, browser="chrome", backend="browser", api_url=FIGSHARE_API, cache_directory=None,
+                 manifest_ttl=7 * 24 * 3600, force_refresh=False, instrumentation=None):
 
         if browser not in ["chrome", "firefox"]:
             raise ValueError("the browser value must be one of: chrome, firefox")
+        if backend not in ["browser", "api"]:
+            raise ValueError("the backend value must be one of: browser, api")
 
         self.url = url
         self.time_delay = time_delay
         self.browser = browser
+        self.backend = backend
+        self.api_url = api_url
+        self.download_links = {}
+        # organ -> figshare file record (name, size, md5, download_url), only filled by the api backend
+        self.dataset_files = {}
+        self.file_number = None
+        self.driver = None
+        self.seen_links = set()
+        self.logger = logging.getLogger(__name__)
+        # the links of a release rarely change, so they are kept in a manifest in the cache directory and the page
+        # is only rendered again once the manifest is older than manifest_ttl seconds (None keeps it forever)
+        self.cache_directory = cache_directory if cache_directory is not None else default_cache_directory()
+        self.manifest_ttl = manifest_ttl
+        self.force_refresh = force_refresh
+        self.manifest_path = os.path.join(self.cache_directory, 'tabula_sapiens',
+                                          hashlib.sha256(url.encode('utf-8')).hexdigest()[:16] + '.json')
+        self.instrumentation = instrumentation if instrumentation is not None else NULL_INSTRUMENTATION
+        self.from_manifest = not force_refresh and self._load_manifest()
+        if self.instrumentation.enabled:
+            self.instrumentation.event('manifest.lookup', cache='hit' if self.from_manifest else 'miss')
+
+    def _load_manifest(self):
+        if not os.path.isfile(self.manifest_path):
+            return False
+        try:
+            with open(self.manifest_path) as manifest_json:
+                manifest = json.load(manifest_json)
+        except ValueError:
+            return False
+        if manifest.get('version') != MANIFEST_VERSION or manifest.get('url') != self.url:
+            return False
+        if self.manifest_ttl is not None and time.time() - manifest['created'] > self.manifest_ttl:
+            return False
+        self.download_links = manifest['download_links']
+        self.dataset_files = manifest['dataset_files']
+        self.file_number = manifest['file_number']
+        self.seen_links = set(self.download_links.values())
+        return True
+
+    def _write_manifest(self):
+        os.makedirs(os.path.dirname(self.manifest_path), exist_ok=True)
+        manifest = {'version': MANIFEST_VERSION, 'url': self.url, 'backend': self.backend, 'created': time.time(),
+                    'file_number': self.file_number, 'download_links': self.download_links,
+                    'dataset_files': self.dataset_files}
+        with open(self.manifest_path + '.tmp', 'w') as manifest_json:
+            json.dump(manifest, manifest_json)
+        os.replace(self.manifest_path + '.tmp', self.manifest_path)
+
+    def _start_driver(self):
         self.options = ChromeOptions() if self.browser == "chrome" else FirefoxOptions()
         self.options.add_argument('--headless')
         self.options.add_argument('--disable-gpu')
@@ -29,56 +89,114 @@ class TabulaSapiensParser:
             webdriver.Firefox(options=self.options)
 
         self.driver.get(self.url)
-        self.download_links = {}
 
         try:
             file_counter = self.driver.find_element(By.CLASS_NAME, "_1Xdzb").text
             assert "files" in str(file_counter)
             self.file_number = int(file_counter.split(" files")[0])
         except NoSuchElementException:
-            logging.info(f"Verify that the url {url} is a valid link for Tabula Sapiens download links.")
+            self.logger.info(f"Verify that the url {self.url} is a valid link for Tabula Sapiens download links.")
 
     def _get_links(self):
         time.sleep(self.time_delay)
         try:
             links = self.driver.find_elements(by=By.TAG_NAME, value='a')
             for link in links:
-                if "ndownloader" in link.get_attribute('href') and link.get_attribute('href') not in \
-                        self.download_links.values():
+                href = link.get_attribute('href')
+                if "ndownloader" in href and href not in self.seen_links:
                     parent_of_parent = link.find_element(By.XPATH, '../..')
                     for elem in parent_of_parent.find_elements(by=By.TAG_NAME, value='span'):
                         if "zip" in elem.get_attribute('title'):
-                            self.download_links[re.sub(r'^.*?TS_', '',
-                                                       elem.get_attribute('title')).split('.h5ad')[0].title()] = \
-                                link.get_attribute('href')
+                            self.download_links[tabula_sapiens_dataset_key(elem.get_attribute('title'))] = href
+                            self.seen_links.add(href)
         except StaleElementReferenceException:
             self.time_delay = 1.1 * self.time_delay
-            logging.info(f"increasing the rendering delay: {self.time_delay}")
+            self.logger.info(f"increasing the rendering delay: {self.time_delay}")
             self._get_links()
 
     def collect_datasets(self):
-        while len(self.download_links) != self.file_number:
-            time.sleep(self.time_delay)
-            self.driver.find_element(By.XPATH, "//button[.='Next page']").click()
-            self._get_links()
-        assert len(self.download_links) == self.file_number
+        if self.from_manifest:
+            return self.download_links
+        if self.backend == "api":
+            # the public figshare API lists the files of the article directly, no page has to be rendered
+            self.download_links, self.dataset_files, self.file_number = \
+                collect_figshare_download_links(self.url, self.api_url)
+        else:
+            if self.driver is None:
+                self._start_driver()
+            while len(self.download_links) != self.file_number:
+                time.sleep(self.time_delay)
+                self.driver.find_element(By.XPATH, "//button[.='Next page']").click()
+                self._get_links()
+            assert len(self.download_links) == self.file_number
+        self._write_manifest()
+        self.from_manifest = True
+        return self.download_links
 
 
-def download_tabula_sapiens_dataset(dataset_key: str, dataset_url: str, destination_path: str, chunk_size=8192,
-                                    use_unzip=True):
+def download_tabula_sapiens_dataset(dataset_key: str, dataset_url: str, destination_path: str, chunk_size=None,
+                                    use_unzip=True, connections=1, stream_extract=False, keep_archive=True,
+                                    instrumentation=None):
 
     dest_path = os.path.join(destination_path, dataset_key + ".h5ad.zip")
+    # without keep_archive, the members extracted from a streamed archive are listed here so that a later call
+    # does not download the archive again
+    extracted_path = dest_path + ".extracted"
+
+    if use_unzip and stream_extract and not keep_archive and os.path.isfile(extracted_path):
+        with open(extracted_path) as extracted_json:
+            extracted = [os.path.join(destination_path, name) for name in json.load(extracted_json)]
+        if all(os.path.isfile(path) for path in extracted):
+            return extracted
+
+    if use_unzip and stream_extract and not os.path.isfile(dest_path):
+        # the .h5ad member is inflated while the archive is downloading, without keep_archive the archive itself
+        # is never written
+        extractor = StreamingZipExtractor(destination_path, select=is_h5ad_member)
+        try:
+            if keep_archive:
+                download_to_path(dataset_url, dest_path, chunk_size=chunk_size, on_chunk=extractor.feed,
+                                 instrumentation=instrumentation)
+            else:
+                stream_url(dataset_url, extractor.feed, chunk_size=chunk_size)
+        except Exception:
+            extractor.abort()
+            raise
+        extracted = extractor.close()
+        if not keep_archive:
+            with open(extracted_path, 'w') as extracted_json:
+                json.dump([os.path.relpath(path, destination_path) for path in extracted], extracted_json)
+        return extracted
 
-    with requests.get(dataset_url, stream=True) as r:
-        r.raise_for_status()
-        if not os.path.isfile(dest_path):
-            with open(dest_path, 'wb') as f:
-                pbar = tqdm(total=int(r.headers['Content-Length']))
-                for chunk in r.iter_content(chunk_size=chunk_size):
-                    if chunk:  # filter out keep-alive new chunks
-                        f.write(chunk)
-                        pbar.update(len(chunk))
+    if not os.path.isfile(dest_path):
+        download_to_path(dataset_url, dest_path, connections=connections, chunk_size=chunk_size,
+                         instrumentation=instrumentation)
 
     if use_unzip:
         with zipfile.ZipFile(dest_path, 'r') as zip_ref:
             zip_ref.extractall(destination_path)
+        if not keep_archive:
+            os.remove(dest_path)
+
+
+def download_tabula_sapiens_datasets(datasets: dict, destination_path: str, workers=2, processes=None,
+                                     chunk_size=None, use_unzip=True, connections=1, keep_archive=True):
+    # downloads several datasets concurrently and hands each archive to a process pool for extraction as soon as it
+    # is complete, so that inflating one organ overlaps with downloading the next
+    archive_paths = {}
+    with ProcessPoolExecutor(max_workers=processes) as extraction_pool, \
+            ThreadPoolExecutor(max_workers=workers) as download_pool:
+        downloads = {download_pool.submit(download_tabula_sapiens_dataset, dataset_key, dataset_url,
+                                          destination_path, chunk_size, False, connections): dataset_key
+                     for dataset_key, dataset_url in datasets.items()}
+        extractions = []
+        for download in as_completed(downloads):
+            download.result()
+            archive_path = os.path.join(destination_path, downloads[download] + ".h5ad.zip")
+            archive_paths[downloads[download]] = archive_path
+            if use_unzip:
+                extractions.append(extraction_pool.submit(extract_archive, archive_path, destination_path,
+                                                          not keep_archive))
+        for extraction in extractions:
+            extraction.result()
+    return archive_paths
@@ -0,0 +1,529 @@
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import http.client
+import json
+import os
+import re
+import socket
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import DecodeError, ProtocolError, ReadTimeoutError
+from urllib3.util.retry import Retry
+from tqdm import tqdm
+from pascrd.metrics import NULL_INSTRUMENTATION
+
+
+# a progress bar can be shared by several downloads running in their own threads
+progress_lock = threading.Lock()
+
+# without a fixed chunk_size, a response is read into a buffer that starts at MIN_BUFFER_SIZE and doubles up to
+# MAX_BUFFER_SIZE for as long as it fills within BUFFER_FILL_SECONDS. fast links end up with few large reads, slow
+# ones still report progress and feed the rate limiter several times a second
+MIN_BUFFER_SIZE = 64 * 1024
+MAX_BUFFER_SIZE = 8 * 1024 * 1024
+BUFFER_FILL_SECONDS = 0.05
+PROGRESS_INTERVAL = 0.1
+
+
+class DownloadIntegrityError(Exception):
+    pass
+
+
+def create_download_session(retries=3, backoff=0.5, pool_size=10):
+    session = requests.Session()
+    retry = Retry(connect=retries, backoff_factor=backoff)
+    adapter = HTTPAdapter(max_retries=retry, pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def probe_ranges(session, url):
+    # asks for the first byte only. a 206 answer tells both that ranges are supported and the full size, anything
+    # else is an ordinary response that is returned so that it can be streamed without a second request
+    response = session.get(url, headers={'Range': 'bytes=0-0'}, stream=True)
+    response.raise_for_status()
+    content_range = re.match(r'bytes 0-0/(\d+)', response.headers.get('Content-Range', ''))
+    if response.status_code == 206 and content_range:
+        response.close()
+        return response.url, int(content_range.group(1)), None
+    return response.url, int(response.headers.get('Content-Length', 0)), response
+
+
+def split_ranges(total, parts, min_part_size=8 * 1024 * 1024):
+    if total <= 0:
+        return []
+    parts = max(1, min(parts, total // min_part_size if min_part_size else parts))
+    part_size = -(-total // parts)
+    return [(start, min(start + part_size, total) - 1) for start in range(0, total, part_size)]
+
+
+def iterate_file_chunks(path, size=None, chunk_size=1024 * 1024, offset=0):
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        remaining = size
+        while remaining is None or remaining > 0:
+            chunk = f.read(chunk_size if remaining is None else min(chunk_size, remaining))
+            if not chunk:
+                break
+            yield chunk
+            if remaining is not None:
+                remaining -= len(chunk)
+
+
+def hash_file(path, hasher, size=None, chunk_size=1024 * 1024, offset=0):
+    for chunk in iterate_file_chunks(path, size, chunk_size, offset):
+        hasher.update(chunk)
+    return hasher
+
+
+def _response_readinto(response):
+    # an identity body is read straight into the caller's buffer by the http.client response under urllib3, a body
+    # shorter than its Content-Length is an error and the connection is handed back to the pool once the body has
+    # been read to the end. an encoded body is decoded by urllib3, which returns new bytes per read.
+    # the errors are raised as the requests ones, as iter_content does
+    raw = response.raw
+    if response.headers.get('Content-Encoding', 'identity').strip().lower() == 'identity' and \
+            hasattr(getattr(raw, '_fp', None), 'readinto'):
+        fp = raw._fp
+
+        def readinto(buffer):
+            try:
+                read = fp.readinto(buffer)
+            except socket.timeout as e:
+                raise requests.exceptions.ConnectionError(e)
+            except (http.client.IncompleteRead, OSError) as e:
+                raise requests.exceptions.ChunkedEncodingError(e)
+            if not read and buffer:
+                # http.client ends a body shorter than its Content-Length without an error
+                if getattr(fp, 'length', None):
+                    raise requests.exceptions.ChunkedEncodingError(http.client.IncompleteRead(b'', fp.length))
+                raw.release_conn()
+            return read
+
+        return readinto
+
+    def readinto(buffer):
+        try:
+            data = raw.read(len(buffer), decode_content=True)
+        except ProtocolError as e:
+            raise requests.exceptions.ChunkedEncodingError(e)
+        except DecodeError as e:
+            raise requests.exceptions.ContentDecodingError(e)
+        except ReadTimeoutError as e:
+            raise requests.exceptions.ConnectionError(e)
+        buffer[:len(data)] = data
+        return len(data)
+
+    return readinto
+
+
+def _check_length(url, received, expected):
+    if expected is not None and received != expected:
+        raise DownloadIntegrityError(f"Received {received} bytes of {url}, the response announced {expected}.")
+
+
+def copy_response(response, update, write=None, hasher=None, on_chunk=None, chunk_size=None):
+    # reads the body into one reused buffer, in place for an identity body, and hands out memoryviews of it. on_chunk
+    # must copy what it keeps, the view is overwritten by the next read. returns the number of bytes read
+    size = chunk_size or MIN_BUFFER_SIZE
+    buffer = memoryview(bytearray(size))
+    readinto = _response_readinto(response)
+    received = 0
+    while True:
+        start = time.monotonic()
+        read = readinto(buffer[:size])
+        if not read:
+            break
+        received += read
+        data = buffer[:read]
+        if write is not None:
+            write(data)
+        if hasher is not None:
+            hasher.update(data)
+        if on_chunk is not None:
+            on_chunk(data)
+        update(read)
+        if chunk_size is None and read == size and size < MAX_BUFFER_SIZE and \
+                time.monotonic() - start < BUFFER_FILL_SECONDS:
+            size *= 2
+            buffer = memoryview(bytearray(size))
+    return received
+
+
+class ThrottledProgress:
+    # collects the updates of one download and passes them on to its tqdm bar at most every interval seconds
+    def __init__(self, bar, interval=PROGRESS_INTERVAL):
+        self.bar = bar
+        self.interval = interval
+        self.pending = 0
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def update(self, size):
+        with self.lock:
+            self.pending += size
+            now = time.monotonic()
+            if now - self.last < self.interval:
+                return
+            size, self.pending, self.last = self.pending, 0, now
+        with progress_lock:
+            self.bar.update(size)
+
+    def flush(self):
+        with self.lock:
+            size, self.pending = self.pending, 0
+        if size:
+            with progress_lock:
+                self.bar.update(size)
+
+
+def _replay_part(part_path, size, hasher=None, on_chunk=None):
+    # the bytes from an earlier attempt are the only ones read back
+    if hasher is None and on_chunk is None:
+        return
+    for chunk in iterate_file_chunks(part_path, size):
+        if hasher is not None:
+            hasher.update(chunk)
+        if on_chunk is not None:
+            on_chunk(chunk)
+
+
+def _stream_to_part(session, url, part_path, chunk_size, update, set_total, hasher=None, response=None,
+                    on_chunk=None):
+    # continues a partial download from the bytes already on disk when the server honours the range, returns the
+    # size of the complete file when it is known
+    offset = os.path.getsize(part_path) if os.path.isfile(part_path) else 0
+    if response is None:
+        response = session.get(url, headers={'Range': f'bytes={offset}-'} if offset else {}, stream=True)
+        if response.status_code == 416:
+            # nothing left to fetch. the part is only taken as the whole file when its checksum can be verified,
+            # otherwise it is fetched again from the start
+            response.close()
+            complete = re.match(r'bytes \*/(\d+)', response.headers.get('Content-Range', ''))
+            if hasher is not None and complete and int(complete.group(1)) == offset:
+                _replay_part(part_path, None, hasher, on_chunk)
+                update(offset, transferred=False)
+                return offset
+            offset = 0
+            response = session.get(url, stream=True)
+        response.raise_for_status()
+    if response.status_code != 206:
+        offset = 0
+    length = response.headers.get('Content-Length')
+    total = offset + int(length) if length is not None else None
+    set_total(total)
+    if offset:
+        _replay_part(part_path, offset, hasher, on_chunk)
+        update(offset, transferred=False)
+    with response, open(part_path, 'ab' if offset else 'wb') as f:
+        f.truncate(offset)
+        received = copy_response(response, update, f.write, hasher, on_chunk, chunk_size)
+    # the Content-Length of an encoded body counts the encoded bytes
+    if response.headers.get('Content-Encoding', 'identity').lower() == 'identity':
+        _check_length(url, received, int(length) if length is not None else None)
+    return total
+
+
+class OrderedRangeHasher:
+    # hashes the ranges of a part file in file order while they are downloaded out of order. bytes written at the
+    # position hashed so far are hashed as they arrive, the ones a range wrote ahead of that position are read back
+    # once it completes, while the file is likely still in the page cache
+    def __init__(self, hasher, part_path, ranges, completed=()):
+        self.hasher = hasher
+        self.part_path = part_path
+        self.ranges = sorted(ranges)
+        self.completed = set(completed)
+        self.written = {start: 0 for start, end in self.ranges}
+        self.position = 0
+        self.lock = threading.Lock()
+        with self.lock:
+            self._catch_up()
+
+    def wrote(self, start, data):
+        with self.lock:
+            offset = start + self.written[start]
+            self.written[start] += len(data)
+            if offset == self.position:
+                self.hasher.update(data)
+                self.position += len(data)
+
+    def complete(self, start, end):
+        with self.lock:
+            self.completed.add((start, end))
+            self._catch_up()
+
+    def _catch_up(self):
+        for start, end in self.ranges:
+            if end < self.position:
+                continue
+            if (start, end) not in self.completed:
+                return
+            hash_file(self.part_path, self.hasher, end - self.position + 1, offset=self.position)
+            self.position = end + 1
+
+
+def _download_range(session, url, part_path, start, end, chunk_size, update, lock, state, instrumentation,
+                    range_hasher=None):
+    started = time.perf_counter() if instrumentation.enabled else None
+    with session.get(url, headers={'Range': f'bytes={start}-{end}'}, stream=True) as response:
+        response.raise_for_status()
+        if response.status_code != 206:
+            raise requests.HTTPError(f"Expected a partial response for bytes {start}-{end} of {url}, got "
+                                     f"{response.status_code}.", response=response)
+        with open(part_path, 'r+b') as f:
+            f.seek(start)
+            if range_hasher is None:
+                write = f.write
+            else:
+                def write(data):
+                    f.write(data)
+                    range_hasher.wrote(start, data)
+            received = copy_response(response, update, write, chunk_size=chunk_size)
+        _check_length(url, received, end - start + 1)
+    with lock:
+        state['completed'].append([start, end])
+        _write_range_state(part_path, state)
+    if range_hasher is not None:
+        range_hasher.complete(start, end)
+    if instrumentation.enabled:
+        instrumentation.event('download.range', seconds=time.perf_counter() - started, bytes=end - start + 1)
+
+
+def _write_range_state(part_path, state):
+    with open(part_path + '.ranges.tmp', 'w') as state_json:
+        json.dump(state, state_json)
+    os.replace(part_path + '.ranges.tmp', part_path + '.ranges')
+
+
+def _download_ranges(session, url, part_path, total, connections, chunk_size, update, lock, min_part_size,
+                     instrumentation, hasher=None):
+    # the ranges and the ones finished by an earlier attempt are recorded next to the part file, a later attempt
+    # continues with the same ranges whatever its number of connections
+    state = {'total': total, 'ranges': split_ranges(total, connections, min_part_size), 'completed': []}
+    if os.path.isfile(part_path) and os.path.isfile(part_path + '.ranges'):
+        with open(part_path + '.ranges') as state_json:
+            previous = json.load(state_json)
+        if previous.get('total') == total and os.path.getsize(part_path) == total:
+            # states written before the ranges were recorded used the split of the same number of connections
+            state = dict(previous, ranges=previous.get('ranges') or state['ranges'])
+    if not state['completed']:
+        with open(part_path, 'wb') as f:
+            f.truncate(total)
+    _write_range_state(part_path, state)
+    completed = {tuple(elem) for elem in state['completed']}
+    ranges = [tuple(elem) for elem in state['ranges'] if tuple(elem) not in completed]
+    range_hasher = OrderedRangeHasher(hasher, part_path, [tuple(elem) for elem in state['ranges']], completed) \
+        if hasher is not None else None
+    update(total - sum(end - start + 1 for start, end in ranges), transferred=False)
+    with ThreadPoolExecutor(max_workers=max(len(ranges), 1)) as executor:
+        for future in [executor.submit(_download_range, session, url, part_path, start, end, chunk_size, update,
+                                       lock, state, instrumentation, range_hasher) for start, end in ranges]:
+            future.result()
+
+
+def _verify_part(part_path, url, expected_size, hasher, sha256):
+    size = os.path.getsize(part_path)
+    if expected_size is not None and size != expected_size:
+        # a short part file is kept so that the next attempt can continue it
+        if size > expected_size:
+            os.remove(part_path)
+        raise DownloadIntegrityError(f"Downloaded {size} bytes of {url}, expected {expected_size}.")
+    if hasher is not None and hasher.hexdigest() != sha256.lower():
+        os.remove(part_path)
+        raise DownloadIntegrityError(f"The sha256 checksum of {url} is {hasher.hexdigest()}, expected {sha256}.")
+    return size
+
+
+def download_to_path(url, output_path, connections=1, chunk_size=None, session=None,
+                     min_part_size=8 * 1024 * 1024, expected_size=None, sha256=None, progress=None, limiter=None,
+                     on_chunk=None, instrumentation=None):
+    # the data is written to output_path + '.part' and only renamed to output_path once its size, and the sha256
+    # checksum when one is given, match. an interrupted download is continued from the part file on the next call.
+    # with more than one connection and a server that advertises byte ranges, the part file is preallocated and its
+    # ranges are fetched concurrently over pooled connections, otherwise it is streamed in one request.
+    # progress is a shared tqdm bar to report to instead of a bar per file, limiter a RateLimiter for the transfer
+    # and on_chunk is called with every byte of the file in order, which needs a single stream. chunk_size fixes the
+    # read size, by default it adapts to the speed of the transfer
+    if on_chunk is not None and connections > 1:
+        raise ValueError("on_chunk receives the file in order, it cannot be combined with more than one "
+                         "connection.")
+    instrumentation = instrumentation if instrumentation is not None else NULL_INSTRUMENTATION
+    start = time.perf_counter() if instrumentation.enabled else None
+    session = session if session is not None else create_download_session(pool_size=max(connections, 1))
+    part_path = output_path + '.part'
+    lock = threading.Lock()
+    hasher = hashlib.sha256() if sha256 else None
+    bar = progress if progress is not None else tqdm(total=expected_size, unit='B', unit_scale=True,
+                                                    unit_divisor=1024)
+    throttled = ThrottledProgress(bar)
+    # bytes received over the network by this call, as opposed to those continued from an earlier attempt
+    transferred_bytes = [0]
+
+    def update(size, transferred=True):
+        throttled.update(size)
+        if transferred and limiter is not None:
+            limiter.consume(size)
+        if transferred and instrumentation.enabled:
+            with lock:
+                transferred_bytes[0] += size
+
+    def set_total(total):
+        if progress is None and total is not None and bar.total != total:
+            bar.reset(total=total)
+
+    try:
+        response = None
+        # a part file preallocated by a ranged attempt is continued in ranges, it has holes a stream cannot fill
+        ranged = connections > 1 or (on_chunk is None and os.path.isfile(part_path + '.ranges'))
+        if ranged:
+            url, total, response = probe_ranges(session, url)
+        if ranged and response is None:
+            set_total(total)
+            _download_ranges(session, url, part_path, total, connections, chunk_size, update, lock, min_part_size,
+                             instrumentation, hasher)
+        else:
+            if os.path.isfile(part_path + '.ranges'):
+                os.remove(part_path + '.ranges')
+                if os.path.isfile(part_path):
+                    os.remove(part_path)
+            total = _stream_to_part(session, url, part_path, chunk_size, update, set_total, hasher, response,
+                                    on_chunk)
+        size = _verify_part(part_path, url, expected_size if expected_size is not None else total, hasher, sha256)
+    except Exception as e:
+        if instrumentation.enabled:
+            instrumentation.event('download.failure', cause=e.__class__.__name__)
+        raise
+    finally:
+        throttled.flush()
+        if progress is None:
+            bar.close()
+
+    if os.path.isfile(part_path + '.ranges'):
+        os.remove(part_path + '.ranges')
+    os.replace(part_path, output_path)
+    if instrumentation.enabled:
+        seconds = time.perf_counter() - start
+        instrumentation.event('download.file', seconds=seconds, bytes=transferred_bytes[0],
+                              resumed_bytes=size - transferred_bytes[0],
+                              bytes_per_second=transferred_bytes[0] / seconds if seconds else 0.0)
+    return output_path
+
+
+def stream_url(url, on_chunk, chunk_size=None, session=None):
+    # hands every chunk to on_chunk without writing the response anywhere
+    session = session if session is not None else create_download_session()
+    with session.get(url, stream=True) as response:
+        response.raise_for_status()
+        with tqdm(total=int(response.headers.get('Content-Length', 0)) or None, unit='B', unit_scale=True,
+                  unit_divisor=1024) as bar:
+            throttled = ThrottledProgress(bar)
+            copy_response(response, throttled.update, on_chunk=on_chunk, chunk_size=chunk_size)
+            throttled.flush()
+
+
+class RateLimiter:
+    # a token bucket shared by all threads of a download, consume blocks once the transfer is ahead of the rate
+    def __init__(self, bytes_per_second):
+        self.rate = float(bytes_per_second)
+        self.allowance = 0.0
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, size):
+        with self.lock:
+            now = time.monotonic()
+            self.allowance = min(self.rate, self.allowance + (now - self.last) * self.rate) - size
+            self.last = now
+            wait = -self.allowance / self.rate if self.allowance < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+class DownloadJob:
+    def __init__(self, url, output_path, expected_size=None, sha256=None):
+        self.url = url
+        self.output_path = output_path
+        self.expected_size = expected_size
+        self.sha256 = sha256
+
+    def __repr__(self):
+        return f"DownloadJob({self.url!r}, {self.output_path!r}, expected_size={self.expected_size})"
+
+
+class DownloadScheduler:
+    # runs download jobs on a pool of workers sharing one pooled session, an optional global rate cap and a single
+    # progress bar. order is "largest" (longest jobs first, which keeps the pool busy until the end), "smallest"
+    # (many files land early) or None to keep the order the jobs were added in. a job with the output path of a job
+    # already submitted fails without running
+    def __init__(self, workers=4, max_bytes_per_second=None, order="largest", connections=1, session=None,
+                 chunk_size=None, instrumentation=None):
+        if order not in ["largest", "smallest", None]:
+            raise ValueError("The argument order must be either of largest, smallest or None.")
+        self.workers = workers
+        self.connections = connections
+        self.order = order
+        self.chunk_size = chunk_size
+        self.session = session if session is not None else \
+            create_download_session(pool_size=max(workers * connections, 1))
+        self.limiter = RateLimiter(max_bytes_per_second) if max_bytes_per_second else None
+        self.instrumentation = instrumentation
+        self.jobs = []
+
+    def add(self, url, output_path, expected_size=None, sha256=None):
+        job = DownloadJob(url, output_path, expected_size, sha256)
+        self.jobs.append(job)
+        return job
+
+    def ordered_jobs(self):
+        if self.order is None:
+            return list(self.jobs)
+        return sorted(self.jobs, key=lambda job: job.expected_size or 0, reverse=self.order == "largest")
+
+    def run(self):
+        # returns the failed jobs with their exception, the other jobs keep going when one of them fails
+        jobs, self.jobs = self.ordered_jobs(), []
+        self.start()
+        for job in jobs:
+            self.submit(job)
+        return self.finish()
+
+    def start(self):
+        # jobs handed to submit between start and finish begin downloading as soon as a worker is free, in the
+        # order they are submitted
+        self.bar = tqdm(total=0, unit='B', unit_scale=True, unit_divisor=1024)
+        self.executor = ThreadPoolExecutor(max_workers=max(self.workers, 1))
+        self.futures = {}
+        # output paths of the jobs submitted since start, two jobs must never write the same part file
+        self.output_paths = set()
+        self.rejected = {}
+
+    def submit(self, job):
+        output_path = os.path.abspath(job.output_path)
+        if output_path in self.output_paths:
+            self.rejected[job] = ValueError(f"Another job already downloads to {job.output_path}.")
+            return job
+        self.output_paths.add(output_path)
+        if job.expected_size:
+            self.bar.total += job.expected_size
+            self.bar.refresh()
+        self.futures[self.executor.submit(download_to_path, job.url, job.output_path, self.connections,
+                                          self.chunk_size, self.session, expected_size=job.expected_size,
+                                          sha256=job.sha256, progress=self.bar, limiter=self.limiter,
+                                          instrumentation=self.instrumentation)] = job
+        return job
+
+    def finish(self):
+        failures = dict(self.rejected)
+        try:
+            for future, job in self.futures.items():
+                try:
+                    future.result()
+                except Exception as e:
+                    failures[job] = e
+        finally:
+            self.executor.shutdown()
+            self.bar.close()
+        return failures
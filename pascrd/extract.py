@@ -0,0 +1,196 @@
+from concurrent.futures import ProcessPoolExecutor
+import os
+import struct
+import zipfile
+import zlib
+
+LOCAL_FILE_HEADER = b'PK\x03\x04'
+DATA_DESCRIPTOR = b'PK\x07\x08'
+# the central directory follows the last member, nothing after it is needed to extract the members
+CENTRAL_DIRECTORY = (b'PK\x01\x02', b'PK\x05\x06', b'PK\x06\x06')
+LOCAL_FILE_HEADER_FORMAT = '<4sHHHHHIIIHH'
+
+
+def is_h5ad_member(name):
+    return name.endswith('.h5ad')
+
+
+def member_destination(destination_path, name):
+    # the same sanitising as zipfile.extractall: no drive, no absolute path and no parent directory components
+    parts = [part for part in os.path.splitdrive(name.replace('\\', '/'))[1].split('/') if part not in
+             ('', '.', '..')]
+    return os.path.join(destination_path, *parts) if parts else None
+
+
+class StreamingZipExtractor:
+    # extracts members from the local file headers of a zip archive while its bytes are still arriving, so an
+    # archive never has to be on disk in full before its members are. each member is written to a .part file and
+    # renamed once its CRC-32 matches
+    def __init__(self, destination_path, select=None):
+        self.destination_path = destination_path
+        self.select = select if select is not None else (lambda name: True)
+        self.buffer = bytearray()
+        self.state = 'header'
+        self.member = None
+        self.extracted = []
+        self.finished = False
+
+    def feed(self, data):
+        self.buffer += data
+        while self._step():
+            pass
+
+    def close(self):
+        if not self.finished:
+            self.abort()
+            raise zipfile.BadZipFile("The archive ended before its central directory, it is truncated.")
+        return self.extracted
+
+    def abort(self):
+        # drops the member being written, the members already extracted are complete and kept
+        if self.member is not None and self.member['file'] is not None:
+            self.member['file'].close()
+            if os.path.isfile(self.member['part_path']):
+                os.remove(self.member['part_path'])
+        self.member = None
+
+    def _step(self):
+        if self.finished:
+            self.buffer.clear()
+            return False
+        if self.state == 'header':
+            return self._read_header()
+        if self.state == 'data':
+            return self._read_data()
+        return self._read_descriptor()
+
+    def _read_header(self):
+        if len(self.buffer) < 4:
+            return False
+        if bytes(self.buffer[:4]) in CENTRAL_DIRECTORY:
+            self.finished = True
+            self.buffer.clear()
+            return False
+        if bytes(self.buffer[:4]) != LOCAL_FILE_HEADER:
+            raise zipfile.BadZipFile("Expected a local file header in the archive stream.")
+        if len(self.buffer) < 30:
+            return False
+        _, _, flags, method, _, _, crc, compressed_size, size, name_length, extra_length = \
+            struct.unpack(LOCAL_FILE_HEADER_FORMAT, self.buffer[:30])
+        if len(self.buffer) < 30 + name_length + extra_length:
+            return False
+        name = bytes(self.buffer[30:30 + name_length]).decode('utf-8' if flags & 0x800 else 'cp437')
+        extra = bytes(self.buffer[30 + name_length:30 + name_length + extra_length])
+        del self.buffer[:30 + name_length + extra_length]
+        if flags & 0x1:
+            raise zipfile.BadZipFile(f"The member {name} is encrypted.")
+        if method not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+            raise NotImplementedError(f"The member {name} uses compression method {method}, only stored and "
+                                      f"deflated members can be extracted while streaming.")
+        zip64 = False
+        while len(extra) >= 4:
+            field, field_length = struct.unpack('<HH', extra[:4])
+            if field == 0x0001:
+                zip64 = True
+                values = extra[4:4 + field_length]
+                if size == 0xFFFFFFFF:
+                    size, values = struct.unpack('<Q', values[:8])[0], values[8:]
+                if compressed_size == 0xFFFFFFFF:
+                    compressed_size = struct.unpack('<Q', values[:8])[0]
+            extra = extra[4 + field_length:]
+        has_descriptor = bool(flags & 0x8)
+        if has_descriptor and method == zipfile.ZIP_STORED:
+            raise NotImplementedError(f"The stored member {name} has no size in its local header, it cannot be "
+                                      f"extracted while streaming.")
+
+        destination = member_destination(self.destination_path, name)
+        selected = destination is not None and not name.endswith('/') and self.select(name)
+        self.member = {'name': name, 'destination': destination, 'crc': crc, 'zip64': zip64,
+                       'remaining': None if has_descriptor else compressed_size, 'computed_crc': 0,
+                       'decompressor': zlib.decompressobj(-15) if method == zipfile.ZIP_DEFLATED and
+                       (selected or has_descriptor) else None,
+                       'selected': selected, 'file': None, 'part_path': None}
+        if selected:
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            self.member['part_path'] = destination + '.part'
+            self.member['file'] = open(self.member['part_path'], 'wb')
+        self.state = 'data'
+        return True
+
+    def _write(self, data):
+        member = self.member
+        if member['decompressor'] is not None:
+            data = member['decompressor'].decompress(data)
+        if member['selected']:
+            member['computed_crc'] = zlib.crc32(data, member['computed_crc'])
+            member['file'].write(data)
+
+    def _read_data(self):
+        member = self.member
+        if member['remaining'] is not None:
+            if member['remaining']:
+                if not self.buffer:
+                    return False
+                data = bytes(self.buffer[:member['remaining']])
+                del self.buffer[:len(data)]
+                member['remaining'] -= len(data)
+                if member['selected'] or member['decompressor'] is not None:
+                    self._write(data)
+            if member['remaining']:
+                return True
+            if member['selected'] and member['decompressor'] is not None:
+                tail = member['decompressor'].flush()
+                member['computed_crc'] = zlib.crc32(tail, member['computed_crc'])
+                member['file'].write(tail)
+            self._finish_member(member['crc'])
+            return True
+        # without sizes in the local header the end of the member is where its deflate stream ends
+        if not self.buffer:
+            return False
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        self._write(data)
+        if member['decompressor'].eof:
+            self.buffer[:0] = member['decompressor'].unused_data
+            self.state = 'descriptor'
+        return True
+
+    def _read_descriptor(self):
+        if len(self.buffer) < 4:
+            return False
+        signature = 4 if bytes(self.buffer[:4]) == DATA_DESCRIPTOR else 0
+        length = signature + (20 if self.member['zip64'] else 12)
+        if len(self.buffer) < length:
+            return False
+        crc = struct.unpack('<I', self.buffer[signature:signature + 4])[0]
+        del self.buffer[:length]
+        self._finish_member(crc)
+        return True
+
+    def _finish_member(self, crc):
+        member = self.member
+        self.member = None
+        self.state = 'header'
+        if not member['selected']:
+            return
+        member['file'].close()
+        if member['computed_crc'] != crc:
+            os.remove(member['part_path'])
+            raise zipfile.BadZipFile(f"Bad CRC-32 for the member {member['name']}.")
+        os.replace(member['part_path'], member['destination'])
+        self.extracted.append(member['destination'])
+
+
+def extract_archive(archive_path, destination_path, remove_archive=False):
+    with zipfile.ZipFile(archive_path, 'r') as zip_ref:
+        zip_ref.extractall(destination_path)
+    if remove_archive:
+        os.remove(archive_path)
+    return archive_path
+
+
+def extract_archives(archive_paths, destination_path, processes=None, remove_archives=False):
+    # inflating is CPU bound, so several archives are extracted in separate processes
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        return list(executor.map(extract_archive, archive_paths, [destination_path] * len(archive_paths),
+                                 [remove_archives] * len(archive_paths)))
@@ -0,0 +1,126 @@
+import asyncio
+import json
+import time
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+import aiohttp
+from pascrd.metrics import NULL_INSTRUMENTATION
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class HCAFetchError(Exception):
+    def __init__(self, url, cause, status=None, attempts=1):
+        super().__init__(f"Unable to get url {url} due to {cause} after {attempts} attempt(s).")
+        self.url = url
+        self.cause = cause
+        self.status = status
+        self.attempts = attempts
+
+
+class HCAFetchReport:
+    def __init__(self):
+        self.fetched = []
+        self.not_modified = []
+        # identifier -> {'url', 'cause', 'status', 'attempts'}
+        self.failed = {}
+
+    def add_failure(self, identifier, error):
+        self.failed[identifier] = {'url': error.url, 'cause': error.cause, 'status': error.status,
+                                   'attempts': error.attempts}
+
+    @property
+    def complete(self):
+        return not self.failed
+
+    def __repr__(self):
+        return f"HCAFetchReport(fetched={len(self.fetched)}, not_modified={len(self.not_modified)}, " \
+               f"failed={sorted(self.failed)})"
+
+
+def parse_retry_after(value):
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max((parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def retry_delay(attempt, backoff, max_backoff, retry_after=None):
+    if retry_after is not None:
+        return min(retry_after, max_backoff)
+    return min(backoff * 2 ** attempt, max_backoff)
+
+
+async def request_with_retries(session, url, retries=3, backoff=0.5, max_backoff=60, timeout=None,
+                              instrumentation=None, **kwargs):
+    # returns (status, headers, body) for any response that is not retried, 304 included
+    instrumentation = instrumentation if instrumentation is not None else NULL_INSTRUMENTATION
+    attempt = 0
+    while True:
+        retry_after = None
+        start = time.perf_counter() if instrumentation.enabled else None
+        try:
+            async with session.get(url, timeout=timeout, **kwargs) as response:
+                if response.status not in RETRY_STATUSES:
+                    if response.status >= 400:
+                        raise HCAFetchError(url, f"HTTP {response.status}", response.status, attempt + 1)
+                    body = await response.read()
+                    if instrumentation.enabled:
+                        instrumentation.event('fetch.request', seconds=time.perf_counter() - start,
+                                              bytes=len(body), status=str(response.status))
+                    return response.status, response.headers, body
+                cause, status = f"HTTP {response.status}", response.status
+                if response.status in (429, 503):
+                    retry_after = parse_retry_after(response.headers.get('Retry-After'))
+        except HCAFetchError as e:
+            if instrumentation.enabled:
+                instrumentation.event('fetch.request', seconds=time.perf_counter() - start, bytes=0,
+                                      status=str(e.status))
+                instrumentation.event('fetch.failure', attempts=e.attempts, cause=e.cause)
+            raise
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            cause, status = e.__class__.__name__, None
+        if instrumentation.enabled:
+            instrumentation.event('fetch.request', seconds=time.perf_counter() - start, bytes=0,
+                                  status=str(status) if status is not None else cause)
+        if attempt >= retries:
+            if instrumentation.enabled:
+                instrumentation.event('fetch.failure', attempts=attempt + 1, cause=cause)
+            raise HCAFetchError(url, cause, status, attempt + 1)
+        delay = retry_delay(attempt, backoff, max_backoff, retry_after)
+        if instrumentation.enabled:
+            instrumentation.event('fetch.retry', delay=delay, cause=cause)
+        await asyncio.sleep(delay)
+        attempt += 1
+
+
+async def iterate_project_identifiers(session, directory, catalog=None, page_size=100, retries=3, backoff=0.5,
+                                      timeout=None, instrumentation=None):
+    # yields (project title, project id) while following the Azul pagination, a response without hits falls
+    # back to the project term facets of that response
+    url, params = directory, {'size': page_size}
+    if catalog is not None:
+        params['catalog'] = catalog
+    seen = set()
+    while url:
+        status, headers, body = await request_with_retries(session, url, retries=retries, backoff=backoff,
+                                                           timeout=timeout, instrumentation=instrumentation,
+                                                           params=params)
+        data = json.loads(body)
+        if 'hits' in data:
+            found = [(hit['projects'][0]['projectTitle'], hit['entryId']) for hit in data['hits']]
+        else:
+            found = [(elem['term'], elem['projectId'][0] if isinstance(elem['projectId'], list) else
+                      elem['projectId']) for elem in data['termFacets']['project']['terms']]
+        for term, project_id in found:
+            if project_id not in seen:
+                seen.add(project_id)
+                yield term, project_id
+        # the next link already carries the catalog and page size
+        url, params = data.get('pagination', {}).get('next'), None
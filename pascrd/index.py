@@ -0,0 +1,265 @@
+import time
+from array import array
+from collections.abc import Mapping
+from bisect import bisect_left, bisect_right
+from pascrd.metrics import NULL_INSTRUMENTATION
+from pascrd.query import And, HCAQueryMatcher, Match, Not, Or, Range, is_number
+from pascrd.utils import iterate_hca_metadata_leaves, iterate_hca_search_options, \
+    search_through_hca_metadata_for_value
+
+
+class HCAPartialMatchIndex:
+    def __init__(self, values, gram_size=3):
+        self.gram_size = gram_size
+        self.values = [value for value in values if isinstance(value, str)]
+        self.folded = [value.casefold() for value in self.values]
+        # n-gram -> positions of the casefolded values that contain it
+        self.grams = {}
+        for position, folded in enumerate(self.folded):
+            for gram in self._grams(folded):
+                self.grams.setdefault(gram, set()).add(position)
+
+    def _grams(self, folded):
+        return {folded[i:i + self.gram_size] for i in range(len(folded) - self.gram_size + 1)}
+
+    def find(self, value):
+        folded = value.casefold()
+        if len(folded) < self.gram_size:
+            candidates = range(len(self.folded))
+        else:
+            candidates = None
+            # intersect the smallest postings first so that misses exit early
+            for postings in sorted((self.grams.get(gram, set()) for gram in self._grams(folded)), key=len):
+                candidates = postings if candidates is None else candidates & postings
+                if not candidates:
+                    return []
+        # the n-grams only narrow down the candidates, the substring check is what decides the match
+        return [self.values[position] for position in candidates if folded in self.folded[position]]
+
+
+class HCANumericColumn:
+    def __init__(self, field):
+        # one entry per (value, project) pair of the numeric leaves of a field, sorted by value, so that a range
+        # is a slice found with two binary searches
+        pairs = sorted((value, project_key) for value, projects in field.items() if is_number(value)
+                       for project_key in projects)
+        self.values = array('d', (value for value, _ in pairs))
+        self.projects = [project_key for _, project_key in pairs]
+
+    def find(self, minimum=None, maximum=None, min_inclusive=True, max_inclusive=True):
+        start = 0 if minimum is None else \
+            (bisect_left if min_inclusive else bisect_right)(self.values, minimum)
+        stop = len(self.values) if maximum is None else \
+            (bisect_right if max_inclusive else bisect_left)(self.values, maximum)
+        return set(self.projects[start:stop])
+
+
+class HCAMetadataIndex:
+    def __init__(self, project_metadata=None, instrumentation=None):
+        self.instrumentation = instrumentation if instrumentation is not None else NULL_INSTRUMENTATION
+        # field key -> leaf value -> set of project ids
+        self.fields = {}
+        # project id -> set of (field key, leaf value) pairs, kept so that a project can be replaced in place
+        self.project_postings = {}
+        # project id -> position in the metadata, used to return results in the same order as a full scan
+        self.project_order = {}
+        self.next_position = 0
+        # field key -> HCAPartialMatchIndex, built on the first partial search of the field
+        self.partial_indexes = {}
+        # field key -> HCANumericColumn, built on the first range search of the field
+        self.numeric_columns = {}
+        self.project_metadata = project_metadata
+        if project_metadata is not None:
+            for project_key, project_values in project_metadata.items():
+                self.add_project(project_key, project_values)
+
+    def add_project(self, project_key, project_values):
+        position = self.project_order.get(project_key, self.next_position)
+        if project_key in self.project_postings:
+            self.remove_project(project_key)
+        postings = set(iterate_hca_metadata_leaves(project_values))
+        for key, value in postings:
+            self.fields.setdefault(key, {}).setdefault(value, set()).add(project_key)
+            self.partial_indexes.pop(key, None)
+            self.numeric_columns.pop(key, None)
+        self.project_postings[project_key] = postings
+        self.project_order[project_key] = position
+        self.next_position = max(self.next_position, position + 1)
+
+    def remove_project(self, project_key):
+        for key, value in self.project_postings.pop(project_key, ()):
+            projects = self.fields[key][value]
+            projects.discard(project_key)
+            self.partial_indexes.pop(key, None)
+            self.numeric_columns.pop(key, None)
+            if not projects:
+                del self.fields[key][value]
+                if not self.fields[key]:
+                    del self.fields[key]
+        self.project_order.pop(project_key, None)
+
+    def lookup(self, key, value, match_type="full"):
+        if match_type not in ["full", "partial"]:
+            raise ValueError("The argument match_type must be either of partial or full.")
+        start = time.perf_counter() if self.instrumentation.enabled else None
+        field = self.fields.get(key, {})
+        if match_type == "full":
+            try:
+                found = set(field.get(value, ()))
+            except TypeError:
+                # unhashable query values cannot be looked up, fall back to walking the project trees
+                found = self._scan(key, value, match_type)
+                if self.instrumentation.enabled:
+                    self.instrumentation.event('search.scan', seconds=time.perf_counter() - start,
+                                               match_type=match_type)
+                return found
+        else:
+            if key not in self.partial_indexes:
+                self.partial_indexes[key] = HCAPartialMatchIndex(field)
+                if self.instrumentation.enabled:
+                    self.instrumentation.event('search.partial_build', seconds=time.perf_counter() - start,
+                                               values=len(field))
+                    start = time.perf_counter()
+            found = set()
+            for leaf in self.partial_indexes[key].find(value):
+                found.update(field[leaf])
+        if self.instrumentation.enabled:
+            self.instrumentation.event('search.index', seconds=time.perf_counter() - start, match_type=match_type)
+        return found
+
+    def range(self, key, minimum=None, maximum=None, min_inclusive=True, max_inclusive=True):
+        start = time.perf_counter() if self.instrumentation.enabled else None
+        if key not in self.numeric_columns:
+            self.numeric_columns[key] = HCANumericColumn(self.fields.get(key, {}))
+            if self.instrumentation.enabled:
+                self.instrumentation.event('search.column_build', seconds=time.perf_counter() - start,
+                                           values=len(self.numeric_columns[key].values))
+                start = time.perf_counter()
+        found = self.numeric_columns[key].find(minimum, maximum, min_inclusive, max_inclusive)
+        if self.instrumentation.enabled:
+            self.instrumentation.event('search.index', seconds=time.perf_counter() - start, match_type='range')
+        return found
+
+    def evaluate(self, query, candidates=None):
+        # the projects matching a query, restricted to candidates when given. indexable terms are answered from the
+        # postings, the terms that are not are grouped and answered by one traversal per project
+        if query.indexable:
+            return self._evaluate_indexed(query, candidates)
+        if isinstance(query, (Match, Range, Not)):
+            return self.scan(query, candidates)
+        indexed = [term for term in query.terms if term.indexable]
+        scanned = [term for term in query.terms if not term.indexable]
+        rest = scanned[0] if len(scanned) == 1 else query.__class__(*scanned)
+        if isinstance(query, And):
+            # the postings narrow down the projects that have to be walked, an empty intersection ends the search
+            if indexed:
+                candidates = self._evaluate_indexed(And(*indexed), candidates)
+                if not candidates:
+                    return set()
+            return self.scan(rest, candidates)
+        found = self._evaluate_indexed(Or(*indexed), candidates) if indexed else set()
+        return found | self.scan(rest, candidates)
+
+    def _evaluate_indexed(self, query, candidates=None):
+        if isinstance(query, Match):
+            found = set()
+            for value in query.values:
+                found |= self.lookup(query.key, value, query.match_type)
+            return found if candidates is None else found & candidates
+        if isinstance(query, Range):
+            found = self.range(query.key, query.minimum, query.maximum, query.min_inclusive, query.max_inclusive)
+            return found if candidates is None else found & candidates
+        if isinstance(query, Not):
+            universe = set(self.project_order) if candidates is None else candidates
+            return universe - self._evaluate_indexed(query.term, candidates)
+        if isinstance(query, Or):
+            found = set()
+            for term in query.terms:
+                found |= self._evaluate_indexed(term, candidates)
+            return found
+        # intersect the narrowest terms first and stop as soon as nothing is left
+        found = candidates
+        for term in sorted(query.terms, key=lambda elem: isinstance(elem, Not)):
+            found = self._evaluate_indexed(term, found)
+            if not found:
+                return set()
+        return found
+
+    def evaluate_terms(self, terms):
+        # the projects matching each term separately, the terms the postings cannot answer share one traversal
+        found = [self._evaluate_indexed(term) if term.indexable else None for term in terms]
+        scanned = [term for term, projects in zip(terms, found) if projects is None]
+        if scanned:
+            start = time.perf_counter() if self.instrumentation.enabled else None
+            matcher = HCAQueryMatcher(Or(*scanned))
+            by_term = {term: set() for term in scanned}
+            for project_key in self.project_order:
+                for term in matcher.satisfied(self.project_metadata[project_key], decide=False)[0]:
+                    by_term[term].add(project_key)
+            found = [by_term[term] if projects is None else projects for term, projects in zip(terms, found)]
+            if self.instrumentation.enabled:
+                self.instrumentation.event('search.scan', seconds=time.perf_counter() - start, match_type='compound')
+        return found
+
+    def scan(self, query, candidates=None):
+        start = time.perf_counter() if self.instrumentation.enabled else None
+        matcher = HCAQueryMatcher(query)
+        project_keys = self.project_order if candidates is None else candidates
+        found = {project_key for project_key in project_keys if matcher.matches(self.project_metadata[project_key])}
+        if self.instrumentation.enabled:
+            self.instrumentation.event('search.scan', seconds=time.perf_counter() - start,
+                                       match_type=query.match_type if isinstance(query, Match) else 'compound')
+        return found
+
+    def ordered(self, project_keys):
+        return sorted(project_keys, key=self.project_order.__getitem__)
+
+    def _scan(self, key, value, match_type):
+        found = set()
+        for project_key, project_values in self.project_metadata.items():
+            found.update(search_through_hca_metadata_for_value(project_values, key=key, value=value,
+                                                               project_key=project_key, search_type=match_type))
+        return found
+
+
+class HCASearchOptions(Mapping):
+    # field key -> {value: number of projects carrying it}, fields and values in order of first appearance. the
+    # counts are updated project by project, so a refresh does not collect the options again
+    def __init__(self, project_metadata=None):
+        self.options = {}
+        if project_metadata is not None:
+            for project_values in project_metadata.values():
+                self.add_project(project_values)
+
+    @classmethod
+    def from_counts(cls, search_options):
+        options = cls()
+        options.options = {field: dict(values) for field, values in search_options.items()}
+        return options
+
+    def add_project(self, project_values):
+        for key, value in iterate_hca_search_options(project_values):
+            counts = self.options.setdefault(key, {})
+            counts[value] = counts.get(value, 0) + 1
+
+    def remove_project(self, project_values):
+        for key, value in iterate_hca_search_options(project_values):
+            counts = self.options.get(key, {})
+            if value in counts:
+                counts[value] -= 1
+                if not counts[value]:
+                    del counts[value]
+                    if not counts:
+                        del self.options[key]
+
+    def most_common(self, field, number=None):
+        return sorted(self[field].items(), key=lambda elem: -elem[1])[:number]
+
+    def __getitem__(self, field):
+        return self.options[field]
+
+    def __iter__(self):
+        return iter(self.options)
+
+    def __len__(self):
+        return len(self.options)
@@ -0,0 +1,113 @@
+import math
+import threading
+
+# events are a name and keyword fields. numeric fields are measurements (seconds, bytes, ...), string fields are
+# labels (cause, cache outcome, ...). the events emitted by pascrd:
+#
+#   fetch.request        one HTTP attempt of the metadata fetch: seconds, bytes, status
+#   fetch.retry          an attempt that is retried: delay, cause
+#   fetch.failure        a request given up on: attempts, cause
+#   fetch.project        one project fetched: seconds, bytes, cache (not_modified, unchanged or changed)
+#   download.file        one completed download: seconds, bytes, resumed_bytes, bytes_per_second
+#   download.range       one range of a multi-connection download: seconds, bytes
+#   download.failure     a download that raised: cause
+#   search.query         one call of HCAParser.search: seconds, results, search_type, match_type
+#   search.index         one lookup answered from the index: seconds, match_type (full, partial or range)
+#   search.scan          one lookup or query that walked the project trees: seconds, match_type (or compound)
+#   search.partial_build the partial match index of a field being built: seconds, values
+#   search.column_build  the sorted numeric column of a field being built: seconds, values
+#   store.record         a project read from the metadata store: cache (hit or miss)
+#   manifest.lookup      the Tabula Sapiens link manifest: cache (hit or miss)
+
+
+class Instrumentation:
+    # the default instrumentation does nothing. call sites check enabled before taking timings or building the
+    # fields of an event, so leaving instrumentation off costs an attribute lookup
+    enabled = False
+
+    def event(self, name, **fields):
+        pass
+
+
+NULL_INSTRUMENTATION = Instrumentation()
+
+
+class CallbackInstrumentation(Instrumentation):
+    # hands every event to callback(name, fields), e.g. to forward it to a metrics client
+    enabled = True
+
+    def __init__(self, callback):
+        self.callback = callback
+
+    def event(self, name, **fields):
+        self.callback(name, fields)
+
+
+class Histogram:
+    # counts observations in logarithmic buckets of a quarter power of two, enough for percentiles within 19%
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.minimum = math.inf
+        self.maximum = -math.inf
+        self.buckets = {}
+
+    def observe(self, value):
+        self.count += 1
+        self.total += value
+        self.minimum = min(self.minimum, value)
+        self.maximum = max(self.maximum, value)
+        bucket = math.floor(math.log2(value) * 4) if value > 0 else None
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    def percentile(self, fraction):
+        if not self.count:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for bucket in sorted(self.buckets, key=lambda elem: -math.inf if elem is None else elem):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return 0.0 if bucket is None else min(2 ** ((bucket + 1) / 4), self.maximum)
+        return self.maximum
+
+    def summary(self):
+        if not self.count:
+            return {'count': 0}
+        return {'count': self.count, 'sum': self.total, 'min': self.minimum, 'max': self.maximum,
+                'mean': self.total / self.count, 'p50': self.percentile(0.5), 'p90': self.percentile(0.9),
+                'p99': self.percentile(0.99)}
+
+
+class MetricsCollector(Instrumentation):
+    # counts every event, every label value as name.field=value, and keeps a histogram per numeric field. safe to
+    # share between the download threads
+    enabled = True
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def event(self, name, **fields):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + 1
+            for field, value in fields.items():
+                if isinstance(value, str):
+                    label = f'{name}.{field}={value}'
+                    self.counters[label] = self.counters.get(label, 0) + 1
+                elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                    key = f'{name}.{field}'
+                    if key not in self.histograms:
+                        self.histograms[key] = Histogram()
+                    self.histograms[key].observe(value)
+
+    def summary(self):
+        with self.lock:
+            return {'counters': dict(self.counters),
+                    'histograms': {key: histogram.summary() for key, histogram in self.histograms.items()}}
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.histograms = {}
@@ -0,0 +1,245 @@
+def is_hashable(value):
+    try:
+        hash(value)
+    except TypeError:
+        return False
+    return True
+
+
+class HCAQuery:
+    # the terms of a query compose with & (and), | (or) and ~ (not)
+    def __and__(self, other):
+        return And(self, other)
+
+    def __or__(self, other):
+        return Or(self, other)
+
+    def __invert__(self):
+        return Not(self)
+
+    def predicates(self):
+        raise NotImplementedError
+
+    def decide(self, satisfied, final=False):
+        # True or False once the predicates satisfied so far settle the outcome, None while they do not. with final
+        # every predicate that is not satisfied is known to be unsatisfied
+        raise NotImplementedError
+
+
+class Match(HCAQuery):
+    # true for a project with a leaf under key equal to any of the values, or containing any of them ignoring case
+    # with match_type="partial"
+    def __init__(self, key, value, match_type="full"):
+        if match_type not in ["full", "partial"]:
+            raise ValueError("The argument match_type must be either of partial or full.")
+        self.key = key
+        self.values = list(value) if isinstance(value, (list, tuple, set)) else [value]
+        self.match_type = match_type
+        if match_type == "partial":
+            self.folded = [elem.casefold() for elem in self.values]
+        else:
+            self.hashable = {elem for elem in self.values if is_hashable(elem)}
+            self.unhashable = [elem for elem in self.values if not is_hashable(elem)]
+
+    @property
+    def indexable(self):
+        return self.match_type == "partial" or not self.unhashable
+
+    def predicates(self):
+        return [self]
+
+    def decide(self, satisfied, final=False):
+        if self in satisfied:
+            return True
+        return False if final else None
+
+    def matches_leaf(self, leaf):
+        if self.match_type == "partial":
+            if not isinstance(leaf, str):
+                return False
+            folded = leaf.casefold()
+            return any(elem in folded for elem in self.folded)
+        try:
+            if leaf in self.hashable:
+                return True
+        except TypeError:
+            pass
+        return any(leaf == elem for elem in self.unhashable)
+
+    def __repr__(self):
+        return f"Match({self.key!r}, {self.values!r}, match_type={self.match_type!r})"
+
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and value == value
+
+
+class Range(HCAQuery):
+    # true for a project with a numeric leaf under key between minimum and maximum, either bound can be left open.
+    # in the dictionary form of HCAParser.search the key can be left out, it is taken from the dictionary
+    def __init__(self, key=None, minimum=None, maximum=None, min_inclusive=True, max_inclusive=True):
+        if minimum is None and maximum is None:
+            raise ValueError("Range needs a minimum, a maximum or both.")
+        if any(bound is not None and not is_number(bound) for bound in (minimum, maximum)):
+            raise ValueError("The bounds of a Range must be numbers.")
+        self.key = key
+        self.minimum = minimum
+        self.maximum = maximum
+        self.min_inclusive = min_inclusive
+        self.max_inclusive = max_inclusive
+
+    indexable = True
+
+    def with_key(self, key):
+        if self.key is not None and self.key != key:
+            raise ValueError(f"The Range on {self.key} cannot be used to search {key}.")
+        return Range(key, self.minimum, self.maximum, self.min_inclusive, self.max_inclusive)
+
+    def predicates(self):
+        return [self]
+
+    def decide(self, satisfied, final=False):
+        if self in satisfied:
+            return True
+        return False if final else None
+
+    def matches_leaf(self, leaf):
+        if not is_number(leaf):
+            return False
+        if self.minimum is not None and (leaf < self.minimum or (leaf == self.minimum and not self.min_inclusive)):
+            return False
+        if self.maximum is not None and (leaf > self.maximum or (leaf == self.maximum and not self.max_inclusive)):
+            return False
+        return True
+
+    def __repr__(self):
+        return f"Range({self.key!r}, {self.minimum!r}, {self.maximum!r}, min_inclusive={self.min_inclusive!r}, " \
+               f"max_inclusive={self.max_inclusive!r})"
+
+
+class And(HCAQuery):
+    def __init__(self, *terms):
+        if not terms:
+            raise ValueError("And needs at least one term.")
+        self.terms = list(terms)
+
+    @property
+    def indexable(self):
+        return all(term.indexable for term in self.terms)
+
+    def predicates(self):
+        return [predicate for term in self.terms for predicate in term.predicates()]
+
+    def decide(self, satisfied, final=False):
+        outcome = True
+        for term in self.terms:
+            decided = term.decide(satisfied, final)
+            if decided is False:
+                return False
+            if decided is None:
+                outcome = None
+        return outcome
+
+    def __repr__(self):
+        return f"And({', '.join(map(repr, self.terms))})"
+
+
+class Or(HCAQuery):
+    def __init__(self, *terms):
+        if not terms:
+            raise ValueError("Or needs at least one term.")
+        self.terms = list(terms)
+
+    @property
+    def indexable(self):
+        return all(term.indexable for term in self.terms)
+
+    def predicates(self):
+        return [predicate for term in self.terms for predicate in term.predicates()]
+
+    def decide(self, satisfied, final=False):
+        outcome = False
+        for term in self.terms:
+            decided = term.decide(satisfied, final)
+            if decided is True:
+                return True
+            if decided is None:
+                outcome = None
+        return outcome
+
+    def __repr__(self):
+        return f"Or({', '.join(map(repr, self.terms))})"
+
+
+class Not(HCAQuery):
+    def __init__(self, term):
+        self.term = term
+
+    @property
+    def indexable(self):
+        return self.term.indexable
+
+    def predicates(self):
+        return self.term.predicates()
+
+    def decide(self, satisfied, final=False):
+        decided = self.term.decide(satisfied, final)
+        return None if decided is None else not decided
+
+    def __repr__(self):
+        return f"Not({self.term!r})"
+
+
+def compile_search(search_dict, search_type="union", match_type="full"):
+    # the dictionary form of HCAParser.search: one Match per value, a list of values gives one Match each. every
+    # value is wrapped so that it is compared as a whole, as the dictionary search always has. Range values keep
+    # their bounds and take the key of the dictionary
+    if search_type not in ["intersection", "union"]:
+        raise ValueError("The argument search_type must be either of intersection or union.")
+    terms = [sub_search.with_key(key) if isinstance(sub_search, Range) else Match(key, [sub_search], match_type)
+             for key, value in search_dict.items()
+             for sub_search in (value if isinstance(value, list) else [value])]
+    if not terms:
+        return None
+    return Or(*terms) if search_type == "union" else And(*terms)
+
+
+class HCAQueryMatcher:
+    # evaluates a query against project trees in one traversal each. the predicates are grouped by key, so a leaf
+    # is only compared with the predicates of its own key, and the traversal stops once the query is decided
+    def __init__(self, query):
+        self.query = query
+        self.predicates = query.predicates()
+        self.by_key = {}
+        for predicate in self.predicates:
+            self.by_key.setdefault(predicate.key, []).append(predicate)
+
+    def satisfied(self, tree, decide=True):
+        # returns the satisfied predicates and the outcome of the query, None when the traversal was not stopped
+        # early (decide=False always walks the whole tree)
+        satisfied = set()
+        remaining = len(self.predicates)
+        # (tree, key) pairs, with the same key inheritance as iterate_hca_metadata_leaves
+        stack = [(tree, None)]
+        while stack:
+            node, key = stack.pop()
+            if isinstance(node, dict):
+                stack.extend((sub_value, sub_key) for sub_key, sub_value in node.items())
+            elif isinstance(node, list):
+                stack.extend((element, key) for element in node)
+            elif key in self.by_key:
+                for predicate in self.by_key[key]:
+                    if predicate not in satisfied and predicate.matches_leaf(node):
+                        satisfied.add(predicate)
+                        remaining -= 1
+                        if decide:
+                            outcome = self.query.decide(satisfied)
+                            if outcome is not None:
+                                return satisfied, outcome
+                        if not remaining:
+                            return satisfied, None
+        return satisfied, None
+
+    def matches(self, tree):
+        satisfied, outcome = self.satisfied(tree)
+        return outcome if outcome is not None else self.query.decide(satisfied, final=True)
@@ -0,0 +1,146 @@
+from collections.abc import Mapping
+import hashlib
+import json
+import sys
+from operator import itemgetter
+from pascrd.index import HCAMetadataIndex
+
+
+class HCACatalogDiff:
+    def __init__(self, old, new, added, removed, changed):
+        self.old = old
+        self.new = new
+        self.added = added
+        self.removed = removed
+        self.changed = changed
+
+    def __repr__(self):
+        return f"HCACatalogDiff({self.old!r} -> {self.new!r}, added={len(self.added)}, " \
+               f"removed={len(self.removed)}, changed={len(self.changed)})"
+
+
+class HCASnapshot(Mapping):
+    # the projects of one catalog in an HCASnapshotStore. the trees are shared with the other catalogs and must not
+    # be modified
+    def __init__(self, store, catalog):
+        self.store = store
+        self.catalog = catalog
+
+    @property
+    def roots(self):
+        return self.store.catalogs[self.catalog]
+
+    def digest(self, project_key):
+        return self.roots[project_key]
+
+    def __getitem__(self, project_key):
+        return self.store.nodes[self.roots[project_key]]
+
+    def __iter__(self):
+        return iter(self.roots)
+
+    def __len__(self):
+        return len(self.roots)
+
+    def __contains__(self, project_key):
+        return project_key in self.roots
+
+
+class HCASnapshotStore:
+    # several catalogs (dcp22, dcp23, ...) held in memory at once. every dict and list of the project trees is
+    # content-addressed by the sha256 of a canonical form in which its children are replaced by their own digests,
+    # so a project or sub-tree that is identical across catalogs or projects is kept once. strings are interned
+    def __init__(self):
+        # digest -> the one copy of that sub-tree
+        self.nodes = {}
+        # sha256 of the canonical JSON of a project -> digest of its tree
+        self.projects = {}
+        # catalog -> project id -> digest of the project tree, in the order the projects were added
+        self.catalogs = {}
+        self.indexes = {}
+
+    def add_catalog(self, catalog, project_metadata):
+        # project_metadata is any mapping of project id -> tree, an HCAParser's project_metadata for instance. a
+        # catalog that is added again is replaced
+        self.catalogs[catalog] = {sys.intern(project_key): self._intern_project(project_values) for
+                                  project_key, project_values in project_metadata.items()}
+        self.indexes.pop(catalog, None)
+        return self[catalog]
+
+    def remove_catalog(self, catalog):
+        del self.catalogs[catalog]
+        self.indexes.pop(catalog, None)
+        # drop the sub-trees only the removed catalog referred to
+        nodes, self.nodes = self.nodes, {}
+        for roots in self.catalogs.values():
+            for digest in roots.values():
+                if digest not in self.nodes:
+                    self._intern(nodes[digest])
+        self.projects = {canonical: digest for canonical, digest in self.projects.items() if digest in self.nodes}
+
+    def __getitem__(self, catalog):
+        if catalog not in self.catalogs:
+            raise KeyError(catalog)
+        return HCASnapshot(self, catalog)
+
+    def __contains__(self, catalog):
+        return catalog in self.catalogs
+
+    def __iter__(self):
+        return iter(self.catalogs)
+
+    def diff(self, old, new):
+        # compares the project digests only, no tree is walked
+        old_roots, new_roots = self.catalogs[old], self.catalogs[new]
+        return HCACatalogDiff(old, new, [project_key for project_key in new_roots if project_key not in old_roots],
+                              [project_key for project_key in old_roots if project_key not in new_roots],
+                              [project_key for project_key, digest in new_roots.items() if
+                               project_key in old_roots and old_roots[project_key] != digest])
+
+    def search_index(self, catalog):
+        # built on first use and kept until the catalog is replaced or removed
+        if catalog not in self.indexes:
+            self.indexes[catalog] = HCAMetadataIndex(self[catalog])
+        return self.indexes[catalog]
+
+    def search(self, catalog, query):
+        # query is a pascrd.query query, the project ids are returned in catalog order
+        search_index = self.search_index(catalog)
+        return search_index.ordered(search_index.evaluate(query))
+
+    def stats(self):
+        roots = [digest for project_roots in self.catalogs.values() for digest in project_roots.values()]
+        return {'catalogs': len(self.catalogs), 'projects': len(roots), 'distinct_projects': len(set(roots)),
+                'nodes': len(self.nodes)}
+
+    def _intern_project(self, project_values):
+        # an unchanged project is recognised from the digest of its canonical JSON alone, only new projects are
+        # split into sub-trees
+        canonical = hashlib.sha256(json.dumps(project_values, sort_keys=True, separators=(',', ':'))
+                                   .encode('utf-8')).hexdigest()
+        if canonical not in self.projects:
+            self.projects[canonical] = self._intern(project_values)[0][1]
+        return self.projects[canonical]
+
+    def _intern(self, node):
+        # returns (token, shared copy of node). scalars are their own token, a dict or list is represented by its
+        # digest in the canonical form of its parent. the canonical form is the repr of the tokens, with dict items
+        # sorted by key, which keeps 1, 1.0, True and "1" apart
+        if isinstance(node, dict):
+            items = [(sys.intern(key) if isinstance(key, str) else key, self._intern(value))
+                     for key, value in node.items()]
+            canonical = repr(sorted(((key, token) for key, (token, _) in items), key=itemgetter(0)))
+            digest = hashlib.sha256(b'{' + canonical.encode('utf-8', 'surrogatepass')).hexdigest()
+            if digest not in self.nodes:
+                self.nodes[digest] = {key: value for key, (_, value) in items}
+            return ('#', digest), self.nodes[digest]
+        if isinstance(node, list):
+            elements = [self._intern(element) for element in node]
+            canonical = repr([token for token, _ in elements])
+            digest = hashlib.sha256(b'[' + canonical.encode('utf-8', 'surrogatepass')).hexdigest()
+            if digest not in self.nodes:
+                self.nodes[digest] = [value for _, value in elements]
+            return ('#', digest), self.nodes[digest]
+        if isinstance(node, str):
+            node = sys.intern(node)
+        return node, node
@@ -0,0 +1,171 @@
+from collections.abc import Mapping, MutableMapping
+import json
+import pathlib
+import sqlite3
+import zlib
+from pascrd.index import HCASearchOptions
+from pascrd.metrics import NULL_INSTRUMENTATION
+from pascrd.utils import freeze_search_option
+
+
+def encode_record(value):
+    return zlib.compress(json.dumps(value, separators=(',', ':')).encode('utf-8'))
+
+
+def decode_record(data):
+    return json.loads(zlib.decompress(data).decode('utf-8'))
+
+
+class HCAMetadataStore(MutableMapping):
+    # one compressed JSON record per project in a SQLite file. records are decoded on first access and kept
+    # afterwards, so opening a store costs the same regardless of catalog size
+    def __init__(self, path, readonly=False, instrumentation=None):
+        self.path = path
+        self.readonly = readonly
+        self.instrumentation = instrumentation if instrumentation is not None else NULL_INSTRUMENTATION
+        if readonly:
+            self.connection = sqlite3.connect(f'{pathlib.Path(path).resolve().as_uri()}?mode=ro', uri=True,
+                                              check_same_thread=False)
+        else:
+            self.connection = sqlite3.connect(path, check_same_thread=False)
+            self.connection.execute('CREATE TABLE IF NOT EXISTS projects (project_key TEXT PRIMARY KEY, '
+                                    'position INTEGER NOT NULL, data BLOB NOT NULL)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS search_options (field TEXT PRIMARY KEY, '
+                                    'position INTEGER NOT NULL, data BLOB NOT NULL)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS fingerprints (project_key TEXT NOT NULL, '
+                                    'catalog TEXT NOT NULL, etag TEXT, last_modified TEXT, digest TEXT, '
+                                    'PRIMARY KEY (project_key, catalog))')
+            self.connection.commit()
+        self.decoded = {}
+
+    def __getitem__(self, project_key):
+        if self.instrumentation.enabled:
+            self.instrumentation.event('store.record', cache='hit' if project_key in self.decoded else 'miss')
+        if project_key not in self.decoded:
+            row = self.connection.execute('SELECT data FROM projects WHERE project_key = ?',
+                                          (project_key,)).fetchone()
+            if row is None:
+                raise KeyError(project_key)
+            self.decoded[project_key] = decode_record(row[0])
+        return self.decoded[project_key]
+
+    def __setitem__(self, project_key, project_values):
+        # a rewritten record no longer matches the fingerprints recorded for it against any catalog, the caller
+        # records the fingerprint of the catalog the new record came from
+        with self.connection:
+            self.connection.execute('INSERT INTO projects (project_key, position, data) VALUES '
+                                    '(?, (SELECT COALESCE(MAX(position) + 1, 0) FROM projects), ?) '
+                                    'ON CONFLICT(project_key) DO UPDATE SET data = excluded.data',
+                                    (project_key, encode_record(project_values)))
+            self.connection.execute('DELETE FROM fingerprints WHERE project_key = ?', (project_key,))
+        self.decoded[project_key] = project_values
+
+    def __delitem__(self, project_key):
+        with self.connection:
+            deleted = self.connection.execute('DELETE FROM projects WHERE project_key = ?', (project_key,))
+            self.connection.execute('DELETE FROM fingerprints WHERE project_key = ?', (project_key,))
+        self.decoded.pop(project_key, None)
+        if not deleted.rowcount:
+            raise KeyError(project_key)
+
+    def __iter__(self):
+        for row in self.connection.execute('SELECT project_key FROM projects ORDER BY position').fetchall():
+            yield row[0]
+
+    def __len__(self):
+        return self.connection.execute('SELECT COUNT(*) FROM projects').fetchone()[0]
+
+    def __contains__(self, project_key):
+        if project_key in self.decoded:
+            return True
+        return self.connection.execute('SELECT 1 FROM projects WHERE project_key = ?',
+                                       (project_key,)).fetchone() is not None
+
+    def replace(self, project_metadata, search_options=None):
+        with self.connection:
+            self.connection.execute('DELETE FROM projects')
+            self.connection.executemany('INSERT INTO projects (project_key, position, data) VALUES (?, ?, ?)',
+                                        ((project_key, position, encode_record(project_values)) for
+                                         position, (project_key, project_values) in
+                                         enumerate(project_metadata.items())))
+            self.connection.execute('DELETE FROM fingerprints')
+        self.replace_search_options(search_options)
+        self.decoded = {}
+
+    def replace_search_options(self, search_options):
+        # options with counts are kept as {'values': [...], 'counts': [...]}, plain lists of values as they are
+        with self.connection:
+            self.connection.execute('DELETE FROM search_options')
+            if search_options is not None:
+                self.connection.executemany('INSERT INTO search_options (field, position, data) VALUES (?, ?, ?)',
+                                            ((json.dumps(field), position, encode_record(
+                                                options if isinstance(options, list) else
+                                                {'values': list(options), 'counts': list(options.values())}))
+                                             for position, (field, options) in
+                                             enumerate(search_options.items())))
+
+    def fingerprints(self, catalog):
+        return {row[0]: {'etag': row[1], 'last_modified': row[2], 'digest': row[3]} for row in
+                self.connection.execute('SELECT project_key, etag, last_modified, digest FROM fingerprints '
+                                        'WHERE catalog = ?', (catalog,))}
+
+    def update_fingerprints(self, catalog, fingerprints):
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO fingerprints (project_key, catalog, etag, '
+                                        'last_modified, digest) VALUES (?, ?, ?, ?, ?)',
+                                        ((project_key, catalog, fingerprint.get('etag'),
+                                          fingerprint.get('last_modified'), fingerprint.get('digest')) for
+                                         project_key, fingerprint in fingerprints.items()))
+
+    def search_options(self):
+        if not self.connection.execute('SELECT 1 FROM search_options LIMIT 1').fetchone():
+            return None
+        return HCAStoredSearchOptions(self.connection)
+
+    def close(self):
+        self.connection.close()
+
+
+class HCAStoredSearchOptions(Mapping):
+    # the same {value: count} mapping per field as HCASearchOptions, decoded field by field. stores written
+    # without counts give None for every count
+    def __init__(self, connection):
+        self.connection = connection
+        self.decoded = {}
+
+    def __getitem__(self, field):
+        if field not in self.decoded:
+            row = self.connection.execute('SELECT data FROM search_options WHERE field = ?',
+                                          (json.dumps(field),)).fetchone()
+            if row is None:
+                raise KeyError(field)
+            options = decode_record(row[0])
+            if isinstance(options, list):
+                self.decoded[field] = dict.fromkeys(map(freeze_search_option, options))
+            else:
+                self.decoded[field] = dict(zip(map(freeze_search_option, options['values']), options['counts']))
+        return self.decoded[field]
+
+    @property
+    def counted(self):
+        return all(count is not None for field in self for count in self[field].values())
+
+    def most_common(self, field, number=None):
+        if not self.counted:
+            raise ValueError("The search options of this store were written without counts.")
+        return sorted(self[field].items(), key=lambda elem: -elem[1])[:number]
+
+    def __iter__(self):
+        for row in self.connection.execute('SELECT field FROM search_options ORDER BY position').fetchall():
+            yield json.loads(row[0])
+
+    def __len__(self):
+        return self.connection.execute('SELECT COUNT(*) FROM search_options').fetchone()[0]
+
+
+def convert_hca_json_to_store(json_path, store_path):
+    with open(json_path) as metadata_json:
+        project_metadata = json.load(metadata_json)
+    store = HCAMetadataStore(store_path)
+    store.replace(project_metadata, HCASearchOptions(project_metadata))
+    return store
@@ -1,9 +1,14 @@
 
-from tqdm import tqdm
+import hashlib
 import os
 import requests
-from requests.adapters import HTTPAdapter
-from urllib3.util.retry import Retry
+from pascrd.download import DownloadScheduler, download_to_path
+
+
+def default_cache_directory():
+    if os.environ.get('PASCRD_CACHE_DIR'):
+        return os.environ['PASCRD_CACHE_DIR']
+    return os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache')), 'pascrd')
 
 
 def search_through_hca_metadata_for_value(tree, current_key=None, key=None, value=None, project_key=None,
@@ -17,12 +22,10 @@ def search_through_hca_metadata_for_value(tree, current_key=None, key=None, valu
             search_condition_top = tree == value
     elif search_type == "partial":
         if isinstance(tree, list):
-            search_condition_list = any(value.lower() in s for s in filter(None, tree) if isinstance(s, str)) or \
-                                    any(value.capitalize() in s for s in filter(None, tree) if isinstance(s, str)) or \
-                                    any(value.upper() in s for s in filter(None, tree) if isinstance(s, str))
+            search_condition_list = any(value.casefold() in s.casefold() for s in filter(None, tree)
+                                        if isinstance(s, str))
         elif not isinstance(tree, list) and not isinstance(tree, dict):
-            search_condition_top = tree is not None and tree is not False and isinstance(tree, str) and \
-                                   (value.lower() in tree or value.capitalize() in tree or value.upper() in tree)
+            search_condition_top = isinstance(tree, str) and value.casefold() in tree.casefold()
 
     if not isinstance(tree, list) and not isinstance(tree, dict) and key == current_key and search_condition_top:
         yield project_key
@@ -41,6 +44,19 @@ def search_through_hca_metadata_for_value(tree, current_key=None, key=None, valu
             yield from search_through_hca_metadata_for_value(element, current_key, key, value, project_key, search_type)
 
 
+def iterate_hca_metadata_leaves(tree, current_key=None):
+    # follows the same key inheritance as search_through_hca_metadata_for_value: dict entries take their own
+    # key, list elements inherit the key of the list that holds them
+    if isinstance(tree, dict):
+        for sub_key, sub_value in tree.items():
+            yield from iterate_hca_metadata_leaves(sub_value, sub_key)
+    elif isinstance(tree, list):
+        for element in tree:
+            yield from iterate_hca_metadata_leaves(element, current_key)
+    else:
+        yield current_key, tree
+
+
 def iterate_matrices_tree(tree, keys=()):
     if isinstance(tree, dict):
         for k, v in tree.items():
@@ -52,7 +68,19 @@ def iterate_matrices_tree(tree, keys=()):
         assert False
 
 
-def bulk_download_files(endpoint_url, save_location, catalog='dcp22'):
+def file_output_path(directory, file_info, output_paths):
+    # the first file of a name keeps it, a different file of the same name planned later is kept apart by a prefix
+    # of its checksum, or of the digest of its url. the path returned is added to output_paths
+    output_path = os.path.join(directory, file_info['name'])
+    if output_path in output_paths:
+        prefix = file_info.get('sha256') or hashlib.sha256(file_info['url'].encode('utf-8')).hexdigest()
+        output_path = os.path.join(directory, f"{prefix[:12]}-{file_info['name']}")
+    output_paths.add(output_path)
+    return output_path
+
+
+def bulk_download_files(endpoint_url, save_location, catalog='dcp22', workers=4, max_bytes_per_second=None,
+                        order="largest", connections=1, instrumentation=None):
     if not os.path.exists(save_location):
         os.mkdir(save_location)
     response = requests.get(endpoint_url, params={'catalog': catalog})
@@ -61,18 +89,29 @@ def bulk_download_files(endpoint_url, save_location, catalog='dcp22'):
     response_json = response.json()
     project = response_json['projects'][0]
 
-    file_urls = set()
+    scheduler = DownloadScheduler(workers=workers, max_bytes_per_second=max_bytes_per_second, order=order,
+                                  connections=connections, instrumentation=instrumentation)
+    file_urls, dest_paths = set(), set()
     for key in ('matrices', 'contributedAnalyses'):
         tree = project[key]
         for path, file_info in iterate_matrices_tree(tree):
             url = file_info['url']
             if url not in file_urls:
-                dest_path = os.path.join(save_location, file_info['name'])
                 print(file_info['name'])
-                if ".h5ad" in file_info['name'] and not os.path.isfile(dest_path):
-                    download_file(url, dest_path)
-                    file_urls.add(url)
-    print('Downloads Complete.')
+                if ".h5ad" not in file_info['name']:
+                    continue
+                dest_path = file_output_path(save_location, file_info, dest_paths)
+                file_urls.add(url)
+                # dest_path only exists once a download has been verified, an interrupted one is resumed
+                if not os.path.isfile(dest_path):
+                    # Work around https://github.com/DataBiosphere/azul/issues/2908
+                    scheduler.add(url.replace('/fetch', ''), dest_path, expected_size=file_info.get('size'),
+                                  sha256=file_info.get('sha256'))
+    failures = scheduler.run()
+    for job, error in failures.items():
+        print(f'Unable to download {job.url} to {job.output_path}: {error}')
+    print('Downloads Complete.' if not failures else f'Downloads Complete, {len(failures)} failed.')
+    return failures
 
 
 def collect_unique_hca_metadata_fields(tree, tree_key=None):
@@ -101,23 +140,30 @@ def collect_unique_hca_metadata_fields(tree, tree_key=None):
         yield {tree_key: tree}
 
 
-def download_file(url, output_path):
-    url = url.replace('/fetch', '')  # Work around https://github.com/DataBiosphere/azul/issues/2908
+def freeze_search_option(value):
+    # lists become tuples so that every option can be kept in a set or as a dict key
+    if isinstance(value, list):
+        return tuple(freeze_search_option(element) for element in value)
+    return value
 
-    session = requests.Session()
-    retry = Retry(connect=3, backoff_factor=0.5)
-    adapter = HTTPAdapter(max_retries=retry)
-    session.mount('http://', adapter)
-    session.mount('https://', adapter)
 
-    response = session.get(url, stream=True)
-    response.raise_for_status()
+def iterate_hca_search_options(tree):
+    # the distinct (field, value) pairs of one project, in order of first appearance
+    return dict.fromkeys((sub_key, freeze_search_option(sub_value)) for project_elem in
+                         collect_unique_hca_metadata_fields(tree) for sub_key, sub_value in project_elem.items())
 
-    total = int(response.headers.get('content-length', 0))
-    print(f'Downloading to: {output_path}', flush=True)
 
-    with open(output_path, 'wb') as f:
-        with tqdm(total=total, unit='B', unit_scale=True, unit_divisor=1024) as bar:
-            for chunk in response.iter_content(chunk_size=1024):
-                size = f.write(chunk)
-                bar.update(size)
+def collect_hca_search_options(project_metadata):
+    search_options = {}
+    for key, value in project_metadata.items():
+        for sub_key, sub_value in iterate_hca_search_options(value):
+            search_options.setdefault(sub_key, {})[sub_value] = None
+    return {sub_key: list(values) for sub_key, values in search_options.items()}
+
+
+def download_file(url, output_path, connections=1, expected_size=None, sha256=None, instrumentation=None):
+    url = url.replace('/fetch', '')  # Work around https://github.com/DataBiosphere/azul/issues/2908
+
+    print(f'Downloading to: {output_path}', flush=True)
+    download_to_path(url, output_path, connections=connections, expected_size=expected_size, sha256=sha256,
+                     instrumentation=instrumentation)
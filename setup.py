@@ -12,7 +12,7 @@ setup(
     author_email="mwatson@lunenfeld.ca",
     packages=find_packages(),
     package_dir={"pascrd": "pascrd"},
-    package_data={'': ['*.json']},
+    package_data={'': ['*.json', '*.sqlite']},
     include_package_data=True,
     description="",
     long_description=open("README.md").read(),
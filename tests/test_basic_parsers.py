@@ -53,7 +53,7 @@ def get_tmp_ts_file(tmp_path):
 @requests_mock.Mocker(kw="mock")
 def test_mock_download_tabula_sapiens(get_tmp_ts_file, **kwargs):
     expected_headers = {'Content-Type': 'text/html', 'Content-Length': '1'}
-    kwargs["mock"].get('http://test.com', headers=expected_headers)
+    kwargs["mock"].get('http://test.com', headers=expected_headers, content=b'0')
     download_tabula_sapiens_dataset("fake_key", "http://test.com", get_tmp_ts_file, chunk_size=1, use_unzip=False)
 
     assert os.path.isfile(os.path.join(get_tmp_ts_file, "fake_key.h5ad.zip"))
@@ -64,7 +64,7 @@ def test_mock_download_tabula_sapiens_zipped(get_tmp_ts_file, **kwargs):
     with pytest.raises(BadZipfile):
         expected_headers = {'Content-Type': 'application/zip', 'Content-Length': '1',
                         'one': 'one', 'two': 'two', 'three': 'three'}
-        kwargs["mock"].get('http://test.com', headers=expected_headers)
+        kwargs["mock"].get('http://test.com', headers=expected_headers, content=b'0')
         download_tabula_sapiens_dataset("fake_key", "http://test.com", get_tmp_ts_file, chunk_size=1, use_unzip=True)
         assert os.path.isfile(os.path.join(get_tmp_ts_file, "fake_key.h5ad.zip"))
 
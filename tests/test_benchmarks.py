@@ -0,0 +1,23 @@
+from benchmarks.catalog import generate_catalog, write_catalog
+from benchmarks.run_benchmarks import compare, run
+from pascrd.api.human_cell_atlas import HCAParser
+
+
+def test_synthetic_catalog(tmp_path):
+    catalog = generate_catalog(50, seed=3)
+    assert catalog == generate_catalog(50, seed=3) and len(catalog) == 50
+    json_path, store_path = write_catalog(str(tmp_path), 50, seed=3)
+    parser = HCAParser(metadata_path=store_path)
+    project_key, project = next(iter(catalog.items()))
+    organ = project['specimens'][0]['organ'][0]
+    assert project_key in parser.search({'organ': organ})
+    assert parser.search({'organ': organ}) == HCAParser(metadata_path=json_path).search({'organ': organ})
+
+
+def test_benchmark_suite():
+    results = run([40], queries=10, construction_repeats=1, fetch_projects=20, latency=0, error_rate=0.02,
+                  download_mb=2, connections=2, bulk_files=2)
+    assert results["catalogs"]["40"]["search"]["queries"] == 10
+    assert results["fetch"]["failed"] == 0 and results["fetch"]["refresh_not_modified"] == 20
+    assert results["downloads"]["bulk_download_files"]["failed"] == 0
+    assert compare(results, results)["catalogs.40.search_options.seconds"] == 1
@@ -0,0 +1,426 @@
+import pytest
+from pascrd.download import DownloadIntegrityError, DownloadScheduler, OrderedRangeHasher, RateLimiter, \
+    copy_response, create_download_session, download_to_path, split_ranges
+from pascrd.api.human_cell_atlas import HCAParser
+from pascrd.api.tabula_sapiens import download_tabula_sapiens_dataset
+from pascrd.utils import bulk_download_files, download_file
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+import requests
+import hashlib
+import json
+import time
+import re
+import os
+
+
+class FileServer:
+    def __init__(self, files, ranges=True, delay=0, truncate=0):
+        self.files = files
+        self.ranges = ranges
+        self.delay = delay
+        # bytes left out at the end of every body, which still announces its full length
+        self.truncate = truncate
+        self.requests = []
+        self.clients = set()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.handler())
+        self.server.daemon_threads = True
+
+    def handler(self):
+        file_server = self
+
+        class RangeRequestHandler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                name = self.path.split('?')[0].lstrip('/')
+                with file_server.lock:
+                    file_server.requests.append((name, self.headers.get('Range')))
+                    file_server.clients.add(self.client_address)
+                    file_server.in_flight += 1
+                    file_server.max_in_flight = max(file_server.max_in_flight, file_server.in_flight)
+                try:
+                    time.sleep(file_server.delay)
+                    self.respond(name)
+                finally:
+                    with file_server.lock:
+                        file_server.in_flight -= 1
+
+            def respond(self, name):
+                if name not in file_server.files:
+                    self.send_error(404)
+                    return
+                data = file_server.files[name]
+                requested = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range') or '')
+                if file_server.ranges and requested and int(requested.group(1)) >= len(data):
+                    self.send_response(416)
+                    self.send_header('Content-Range', f'bytes */{len(data)}')
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                if file_server.ranges and requested:
+                    start = int(requested.group(1))
+                    end = min(int(requested.group(2)) if requested.group(2) else len(data) - 1, len(data) - 1)
+                    self.send_response(206)
+                    self.send_header('Content-Range', f'bytes {start}-{end}/{len(data)}')
+                    body = data[start:end + 1]
+                else:
+                    self.send_response(200)
+                    body = data
+                if file_server.ranges:
+                    self.send_header('Accept-Ranges', 'bytes')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body[:len(body) - file_server.truncate])
+                if file_server.truncate:
+                    self.close_connection = True
+
+        return RangeRequestHandler
+
+    def url(self, name):
+        return f'http://127.0.0.1:{self.server.server_address[1]}/{name}'
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture(scope="module")
+def payload():
+    return os.urandom(3 * 1024 * 1024 + 17)
+
+
+def test_split_ranges():
+    assert split_ranges(10, 3, min_part_size=1) == [(0, 3), (4, 7), (8, 9)]
+    assert split_ranges(10, 4, min_part_size=5) == [(0, 4), (5, 9)]
+    assert split_ranges(10, 4, min_part_size=100) == [(0, 9)]
+    assert split_ranges(0, 4) == []
+
+
+def test_ranged_download(payload, tmp_path):
+    with FileServer({'matrix.h5ad': payload}, delay=0.05) as server:
+        download_to_path(server.url('matrix.h5ad'), str(tmp_path / 'matrix.h5ad'), connections=4,
+                         chunk_size=64 * 1024, min_part_size=512 * 1024)
+        ranged = [header for name, header in server.requests if header != 'bytes=0-0']
+        assert len(ranged) == 4 and server.max_in_flight == 4
+    assert (tmp_path / 'matrix.h5ad').read_bytes() == payload
+
+
+def test_ranged_download_fallback(payload, tmp_path):
+    with FileServer({'matrix.h5ad': payload}, ranges=False) as server:
+        download_file(server.url('matrix.h5ad'), str(tmp_path / 'matrix.h5ad'), connections=4)
+        assert len(server.requests) == 1
+    assert (tmp_path / 'matrix.h5ad').read_bytes() == payload
+
+
+def test_ranged_tabula_sapiens_download(payload, tmp_path):
+    with FileServer({'TS_Blood.h5ad.zip': payload}) as server:
+        download_tabula_sapiens_dataset("Blood", server.url('TS_Blood.h5ad.zip'), str(tmp_path), use_unzip=False,
+                                        connections=2)
+    assert (tmp_path / 'Blood.h5ad.zip').read_bytes() == payload
+
+
+def test_buffered_copy(payload):
+    reads = []
+    with FileServer({'matrix.h5ad': payload}) as server:
+        with create_download_session().get(server.url('matrix.h5ad'), stream=True) as response:
+            received = bytearray()
+            copy_response(response, reads.append, received.extend)
+    assert received == payload
+    # the buffer grows while it fills quickly, so a few reads cover the whole file
+    assert len(reads) < 12 and max(reads) >= 1024 * 1024
+
+
+def test_throttled_progress(payload, tmp_path):
+    class CountingBar:
+        def __init__(self):
+            self.updates = []
+
+        def update(self, size):
+            self.updates.append(size)
+
+    bar = CountingBar()
+    with FileServer({'matrix.h5ad': payload}) as server:
+        download_to_path(server.url('matrix.h5ad'), str(tmp_path / 'matrix.h5ad'), chunk_size=1024, progress=bar)
+    assert sum(bar.updates) == len(payload) and len(bar.updates) < 100
+
+
+def test_resumed_download(payload, tmp_path):
+    output_path = str(tmp_path / 'matrix.h5ad')
+    with open(output_path + '.part', 'wb') as part:
+        part.write(payload[:1000])
+    with FileServer({'matrix.h5ad': payload}) as server:
+        download_file(server.url('matrix.h5ad'), output_path, expected_size=len(payload),
+                      sha256=hashlib.sha256(payload).hexdigest())
+        assert server.requests == [('matrix.h5ad', 'bytes=1000-')]
+    assert (tmp_path / 'matrix.h5ad').read_bytes() == payload
+    assert not os.path.exists(output_path + '.part')
+
+
+def test_truncated_download_is_not_kept(payload, tmp_path):
+    output_path = str(tmp_path / 'matrix.h5ad')
+    with FileServer({'matrix.h5ad': payload[:2000]}) as server:
+        with pytest.raises(DownloadIntegrityError):
+            download_file(server.url('matrix.h5ad'), output_path, expected_size=len(payload))
+        assert not os.path.exists(output_path) and os.path.getsize(output_path + '.part') == 2000
+        server.files['matrix.h5ad'] = payload
+        download_file(server.url('matrix.h5ad'), output_path, expected_size=len(payload))
+        assert server.requests[-1] == ('matrix.h5ad', 'bytes=2000-')
+    assert (tmp_path / 'matrix.h5ad').read_bytes() == payload
+
+
+def test_checksum_mismatch(payload, tmp_path):
+    output_path = str(tmp_path / 'matrix.h5ad')
+    with FileServer({'matrix.h5ad': payload}) as server:
+        with pytest.raises(DownloadIntegrityError):
+            download_file(server.url('matrix.h5ad'), output_path, sha256="0" * 64)
+        with pytest.raises(DownloadIntegrityError):
+            download_file(server.url('matrix.h5ad'), output_path, sha256="0" * 64, connections=4)
+    assert not os.path.exists(output_path) and not os.path.exists(output_path + '.part')
+
+
+def test_resumed_ranged_download(payload, tmp_path):
+    output_path = str(tmp_path / 'matrix.h5ad')
+    with FileServer({'matrix.h5ad': payload}) as server:
+        download_to_path(server.url('matrix.h5ad'), output_path, connections=3, min_part_size=1024 * 1024,
+                         sha256=hashlib.sha256(payload).hexdigest())
+    ranges = split_ranges(len(payload), 3, 1024 * 1024)
+    # simulate an interruption after the first range was written
+    os.rename(output_path, output_path + '.part')
+    with open(output_path + '.part.ranges', 'w') as state:
+        json.dump({'total': len(payload), 'completed': [list(ranges[0])]}, state)
+    with FileServer({'matrix.h5ad': payload}) as server:
+        download_to_path(server.url('matrix.h5ad'), output_path, connections=3, min_part_size=1024 * 1024,
+                         sha256=hashlib.sha256(payload).hexdigest())
+        assert sorted(header for name, header in server.requests) == \
+               sorted(['bytes=0-0'] + [f'bytes={start}-{end}' for start, end in ranges[1:]])
+    assert (tmp_path / 'matrix.h5ad').read_bytes() == payload
+    assert not os.path.exists(output_path + '.part.ranges')
+
+
+def test_scheduler_order_and_workers(tmp_path):
+    files = {f'{size}.h5ad': os.urandom(size) for size in [1000, 50000, 20000, 7000]}
+    with FileServer(files, delay=0.05) as server:
+        scheduler = DownloadScheduler(workers=1, order="largest")
+        for name, data in files.items():
+            scheduler.add(server.url(name), str(tmp_path / name), expected_size=len(data))
+        assert scheduler.run() == {}
+        assert [name for name, header in server.requests] == ['50000.h5ad', '20000.h5ad', '7000.h5ad', '1000.h5ad']
+
+        server.requests = []
+        scheduler = DownloadScheduler(workers=2, order="smallest")
+        for name, data in files.items():
+            scheduler.add(server.url(name), str(tmp_path / ('copy_' + name)), expected_size=len(data))
+        scheduler.add(server.url('missing.h5ad'), str(tmp_path / 'missing.h5ad'))
+        failures = scheduler.run()
+        assert [job.output_path for job in failures] == [str(tmp_path / 'missing.h5ad')]
+        assert server.max_in_flight == 2
+    assert all((tmp_path / ('copy_' + name)).read_bytes() == data for name, data in files.items())
+
+
+def test_scheduler_rejects_duplicate_output_paths(tmp_path):
+    first, second = os.urandom(300000), os.urandom(300000)
+    with FileServer({'first.h5ad': first, 'second.h5ad': second}, delay=0.05) as server:
+        scheduler = DownloadScheduler(workers=2, order=None)
+        scheduler.add(server.url('first.h5ad'), str(tmp_path / 'matrix.h5ad'))
+        duplicate = scheduler.add(server.url('second.h5ad'), str(tmp_path / 'matrix.h5ad'))
+        failures = scheduler.run()
+        assert list(failures) == [duplicate] and isinstance(failures[duplicate], ValueError)
+        assert [name for name, header in server.requests] == ['first.h5ad']
+    assert (tmp_path / 'matrix.h5ad').read_bytes() == first
+
+
+def test_rate_limiter():
+    limiter = RateLimiter(1000000)
+    start = time.monotonic()
+    for _ in range(10):
+        limiter.consume(30000)
+    assert time.monotonic() - start >= 0.25
+
+
+def test_bulk_download_files(payload, tmp_path):
+    small = os.urandom(5000)
+    with FileServer({'matrix.h5ad': payload, 'small.h5ad': small, 'small.loom': small}) as server:
+        def file_info(name, data):
+            return {'name': name, 'url': server.url(name), 'size': len(data),
+                    'sha256': hashlib.sha256(data).hexdigest()}
+        project = {'projects': [{'matrices': {'organ': {'blood': [file_info('matrix.h5ad', payload),
+                                                                  file_info('small.loom', small)]}},
+                                 'contributedAnalyses': {'organ': {'blood': [file_info('small.h5ad', small),
+                                                                             file_info('matrix.h5ad', payload)]}}}]}
+        server.files['project'] = json.dumps(project).encode('utf-8')
+        failures = bulk_download_files(server.url('project'), str(tmp_path / 'out'), workers=2,
+                                       max_bytes_per_second=100 * 1024 * 1024)
+        assert failures == {}
+        assert sorted(name for name, header in server.requests) == ['matrix.h5ad', 'project', 'small.h5ad']
+    assert (tmp_path / 'out' / 'matrix.h5ad').read_bytes() == payload
+    assert (tmp_path / 'out' / 'small.h5ad').read_bytes() == small
+
+
+def test_bulk_download_files_with_the_same_name(payload, tmp_path):
+    small = os.urandom(5000)
+    with FileServer({'matrices/matrix.h5ad': payload, 'analyses/matrix.h5ad': small}) as server:
+        project = {'projects': [{'matrices': {'organ': {'blood': [
+                                     {'name': 'matrix.h5ad', 'url': server.url('matrices/matrix.h5ad'),
+                                      'size': len(payload), 'sha256': hashlib.sha256(payload).hexdigest()}]}},
+                                 'contributedAnalyses': {'organ': {'blood': [
+                                     {'name': 'matrix.h5ad', 'url': server.url('analyses/matrix.h5ad'),
+                                      'size': len(small)}]}}}]}
+        server.files['project'] = json.dumps(project).encode('utf-8')
+        assert bulk_download_files(server.url('project'), str(tmp_path / 'out'), workers=2) == {}
+        # without a checksum the prefix comes from the url
+        prefix = hashlib.sha256(server.url('analyses/matrix.h5ad').encode('utf-8')).hexdigest()[:12]
+    assert (tmp_path / 'out' / 'matrix.h5ad').read_bytes() == payload
+    assert (tmp_path / 'out' / f'{prefix}-matrix.h5ad').read_bytes() == small
+
+
+def test_download_projects(payload, tmp_path):
+    small = os.urandom(5000)
+    with FileServer({'matrix.h5ad': payload, 'small.h5ad': small, 'small.loom': small}) as server:
+        def file_info(name, data, file_format):
+            return {'name': name, 'url': server.url(name), 'size': len(data), 'format': file_format,
+                    'sha256': hashlib.sha256(data).hexdigest()}
+        parser = HCAParser(metadata_path=str(tmp_path / 'missing.json'))
+        parser.project_metadata = {
+            'first': {'projects': [{'matrices': {'organ': {'blood': [file_info('matrix.h5ad', payload, 'h5ad'),
+                                                                     file_info('small.loom', small, 'loom')]}},
+                                    'contributedAnalyses': {}}]},
+            'second': {'projects': [{'matrices': {},
+                                     'contributedAnalyses': {'organ': {'blood': [
+                                         file_info('small.h5ad', small, 'h5ad'),
+                                         file_info('matrix.h5ad', payload, 'h5ad')]}}}]}}
+        plan = list(parser.plan_downloads(['first', 'second'], str(tmp_path / 'out'), file_formats=['.h5ad']))
+        assert [job.output_path for job in plan] == [str(tmp_path / 'out' / 'first' / 'matrix.h5ad'),
+                                                     str(tmp_path / 'out' / 'second' / 'small.h5ad')]
+        assert [job.expected_size for job in parser.plan_downloads(['first', 'second'], str(tmp_path / 'out'),
+                                                                   max_size=10000)] == [5000]
+        with pytest.raises(ValueError):
+            parser.plan_downloads(['first', 'fake'], str(tmp_path / 'out'))
+
+        assert parser.download_projects(['first', 'second'], str(tmp_path / 'out'), file_formats=['h5ad'],
+                                        workers=2) == {}
+        assert sorted(name for name, header in server.requests) == ['matrix.h5ad', 'small.h5ad']
+        assert list(parser.plan_downloads(['first', 'second'], str(tmp_path / 'out'), file_formats=['h5ad'])) == []
+    assert (tmp_path / 'out' / 'first' / 'matrix.h5ad').read_bytes() == payload
+    assert (tmp_path / 'out' / 'second' / 'small.h5ad').read_bytes() == small
+
+
+def test_download_projects_with_the_same_file_name(payload, tmp_path):
+    small = os.urandom(5000)
+    with FileServer({'blood/matrix.h5ad': payload, 'lung/matrix.h5ad': small}) as server:
+        def file_info(name, data):
+            return {'name': 'matrix.h5ad', 'url': server.url(name), 'size': len(data), 'format': 'h5ad',
+                    'sha256': hashlib.sha256(data).hexdigest()}
+        parser = HCAParser(metadata_path=str(tmp_path / 'missing.json'))
+        parser.project_metadata = {'first': {'projects': [{'matrices': {'organ': {
+            'blood': [file_info('blood/matrix.h5ad', payload)], 'lung': [file_info('lung/matrix.h5ad', small)]}}}]}}
+        plan = list(parser.plan_downloads(['first'], str(tmp_path / 'out')))
+        assert [job.output_path for job in plan] == [
+            str(tmp_path / 'out' / 'first' / 'matrix.h5ad'),
+            str(tmp_path / 'out' / 'first' / f'{hashlib.sha256(small).hexdigest()[:12]}-matrix.h5ad')]
+        assert parser.download_projects(['first'], str(tmp_path / 'out')) == {}
+    assert (tmp_path / 'out' / 'first' / 'matrix.h5ad').read_bytes() == payload
+    assert (tmp_path / 'out' / 'first' / f'{hashlib.sha256(small).hexdigest()[:12]}-matrix.h5ad').read_bytes() == \
+        small
+
+
+def test_truncated_body_is_rejected(payload, tmp_path):
+    with FileServer({'matrix.h5ad': payload}, truncate=1000) as server:
+        for connections in [1, 4]:
+            output_path = str(tmp_path / f'matrix_{connections}.h5ad')
+            with pytest.raises(requests.exceptions.ChunkedEncodingError):
+                download_to_path(server.url('matrix.h5ad'), output_path, connections=connections,
+                                 min_part_size=1024 * 1024)
+            assert not os.path.isfile(output_path)
+
+
+def test_identity_body_is_read_in_place(payload, tmp_path, monkeypatch):
+    # no bytes object is created per read, the body goes straight into the download buffer
+    def no_read(*args, **kwargs):
+        raise AssertionError("the body should not be read through urllib3")
+    monkeypatch.setattr('urllib3.response.HTTPResponse.read', no_read)
+    with FileServer({'matrix.h5ad': payload}) as server:
+        download_to_path(server.url('matrix.h5ad'), str(tmp_path / 'matrix.h5ad'))
+    assert (tmp_path / 'matrix.h5ad').read_bytes() == payload
+
+
+def test_scheduler_reuses_connections(tmp_path):
+    files = {f'{i}.h5ad': os.urandom(200000) for i in range(8)}
+    with FileServer(files) as server:
+        scheduler = DownloadScheduler(workers=1, order=None)
+        for name in files:
+            scheduler.add(server.url(name), str(tmp_path / name))
+        assert scheduler.run() == {}
+        assert len(server.clients) == 1
+
+
+def test_ranged_part_resumed_with_one_connection(payload, tmp_path):
+    # an interrupted ranged attempt leaves a preallocated part full of zeros, a stream must not take it as complete
+    output_path = str(tmp_path / 'matrix.h5ad')
+    ranges = split_ranges(len(payload), 3, 1024 * 1024)
+    with open(output_path + '.part', 'wb') as part:
+        part.write(payload[:ranges[0][1] + 1])
+        part.truncate(len(payload))
+    with open(output_path + '.part.ranges', 'w') as state:
+        json.dump({'total': len(payload), 'ranges': [list(elem) for elem in ranges],
+                   'completed': [list(ranges[0])]}, state)
+    with FileServer({'matrix.h5ad': payload}) as server:
+        download_to_path(server.url('matrix.h5ad'), output_path, connections=1)
+        assert sorted(header for name, header in server.requests) == \
+               sorted(['bytes=0-0'] + [f'bytes={start}-{end}' for start, end in ranges[1:]])
+    assert (tmp_path / 'matrix.h5ad').read_bytes() == payload
+
+    # without range support the part is discarded and streamed again
+    with open(output_path + '.part', 'wb') as part:
+        part.truncate(len(payload))
+    with open(output_path + '.part.ranges', 'w') as state:
+        json.dump({'total': len(payload), 'ranges': [[0, len(payload) - 1]], 'completed': []}, state)
+    os.remove(output_path)
+    with FileServer({'matrix.h5ad': payload}, ranges=False) as server:
+        download_to_path(server.url('matrix.h5ad'), output_path, connections=1)
+    assert (tmp_path / 'matrix.h5ad').read_bytes() == payload
+
+
+def test_complete_part_without_checksum_is_fetched_again(payload, tmp_path):
+    output_path = str(tmp_path / 'matrix.h5ad')
+    with open(output_path + '.part', 'wb') as part:
+        part.write(bytes(len(payload)))
+    with FileServer({'matrix.h5ad': payload}) as server:
+        download_to_path(server.url('matrix.h5ad'), output_path)
+        assert server.requests == [('matrix.h5ad', f'bytes={len(payload)}-'), ('matrix.h5ad', None)]
+    assert (tmp_path / 'matrix.h5ad').read_bytes() == payload
+
+    # with a checksum the complete part is verified instead
+    os.rename(output_path, output_path + '.part')
+    with FileServer({'matrix.h5ad': payload}) as server:
+        download_to_path(server.url('matrix.h5ad'), output_path, sha256=hashlib.sha256(payload).hexdigest())
+        assert server.requests == [('matrix.h5ad', f'bytes={len(payload)}-')]
+    assert (tmp_path / 'matrix.h5ad').read_bytes() == payload
+
+
+def test_ordered_range_hasher(payload, tmp_path):
+    part_path = str(tmp_path / 'matrix.part')
+    with open(part_path, 'wb') as part:
+        part.write(payload)
+    ranges = split_ranges(len(payload), 3, 1024 * 1024)
+    range_hasher = OrderedRangeHasher(hashlib.sha256(), part_path, ranges, completed=[ranges[1]])
+    assert range_hasher.position == 0
+    # the first range is hashed as it arrives, the second was already on disk and the third got ahead
+    range_hasher.wrote(ranges[2][0], payload[ranges[2][0]:ranges[2][0] + 10])
+    for offset in range(0, ranges[0][1] + 1, 100000):
+        range_hasher.wrote(0, payload[offset:min(offset + 100000, ranges[0][1] + 1)])
+    range_hasher.complete(*ranges[0])
+    assert range_hasher.position == ranges[1][1] + 1
+    range_hasher.wrote(ranges[2][0], payload[ranges[2][0] + 10:])
+    range_hasher.complete(*ranges[2])
+    assert range_hasher.hasher.hexdigest() == hashlib.sha256(payload).hexdigest()
@@ -0,0 +1,100 @@
+import pytest
+from pascrd.extract import StreamingZipExtractor, extract_archives, is_h5ad_member
+from pascrd.api.tabula_sapiens import download_tabula_sapiens_dataset, download_tabula_sapiens_datasets
+from tests.test_download import FileServer
+import requests
+import zipfile
+import io
+import os
+
+
+class UnseekableBuffer(io.RawIOBase):
+    # zipfile writes data descriptors instead of sizes in the local headers when it cannot seek back
+    def __init__(self):
+        self.data = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.data += b
+        return len(b)
+
+
+def make_archive(members, seekable=True, force_zip64=False):
+    buffer = io.BytesIO() if seekable else UnseekableBuffer()
+    with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_DEFLATED) as zip_ref:
+        for name, data in members.items():
+            with zip_ref.open(name, 'w', force_zip64=force_zip64) as member:
+                member.write(data)
+    return bytes(buffer.getvalue() if seekable else buffer.data)
+
+
+@pytest.fixture(scope="module")
+def members():
+    return {'TS_Blood.h5ad': os.urandom(200000) + b'0' * 300000, 'README.txt': b'Tabula Sapiens' * 100}
+
+
+@pytest.mark.parametrize("seekable,force_zip64", [(True, False), (False, False), (False, True)])
+def test_streaming_extractor(members, tmp_path, seekable, force_zip64):
+    archive = make_archive(members, seekable, force_zip64)
+    extractor = StreamingZipExtractor(str(tmp_path), select=is_h5ad_member)
+    for start in range(0, len(archive), 4099):
+        extractor.feed(archive[start:start + 4099])
+    assert extractor.close() == [str(tmp_path / 'TS_Blood.h5ad')]
+    assert (tmp_path / 'TS_Blood.h5ad').read_bytes() == members['TS_Blood.h5ad']
+    assert sorted(os.listdir(tmp_path)) == ['TS_Blood.h5ad']
+
+
+def test_streaming_extractor_truncated(members, tmp_path):
+    archive = make_archive(members)
+    extractor = StreamingZipExtractor(str(tmp_path))
+    extractor.feed(archive[:len(archive) // 2])
+    with pytest.raises(zipfile.BadZipFile):
+        extractor.close()
+    assert os.listdir(tmp_path) == []
+
+
+def test_streaming_tabula_sapiens_download(members, tmp_path):
+    archive = make_archive(members)
+    os.mkdir(tmp_path / 'kept')
+    with FileServer({'TS_Blood.h5ad.zip': archive}) as server:
+        download_tabula_sapiens_dataset("Blood", server.url('TS_Blood.h5ad.zip'), str(tmp_path / 'kept'),
+                                        stream_extract=True)
+        download_tabula_sapiens_dataset("Blood", server.url('TS_Blood.h5ad.zip'), str(tmp_path), stream_extract=True,
+                                        keep_archive=False)
+        requests = len(server.requests)
+        # the extracted member is found again without downloading the archive
+        assert download_tabula_sapiens_dataset("Blood", server.url('TS_Blood.h5ad.zip'), str(tmp_path),
+                                               stream_extract=True, keep_archive=False) == \
+               [str(tmp_path / 'TS_Blood.h5ad')]
+        assert len(server.requests) == requests
+    assert sorted(os.listdir(tmp_path / 'kept')) == ['Blood.h5ad.zip', 'TS_Blood.h5ad']
+    assert (tmp_path / 'kept' / 'Blood.h5ad.zip').read_bytes() == archive
+    assert (tmp_path / 'TS_Blood.h5ad').read_bytes() == members['TS_Blood.h5ad']
+    assert not (tmp_path / 'Blood.h5ad.zip').exists()
+
+
+def test_failed_streaming_download_leaves_no_member(members, tmp_path):
+    archive = make_archive(members)
+    with FileServer({'TS_Blood.h5ad.zip': archive}, truncate=len(archive) // 2) as server:
+        with pytest.raises(requests.exceptions.ChunkedEncodingError):
+            download_tabula_sapiens_dataset("Blood", server.url('TS_Blood.h5ad.zip'), str(tmp_path),
+                                            stream_extract=True, keep_archive=False)
+    assert os.listdir(tmp_path) == []
+
+
+def test_parallel_extraction(members, tmp_path):
+    organs = ['Blood', 'Lung', 'Heart']
+    archives = {organ: make_archive({f'TS_{organ}.h5ad': members['TS_Blood.h5ad'] + organ.encode()})
+                for organ in organs}
+    with FileServer({f'{organ}.zip': archive for organ, archive in archives.items()}) as server:
+        download_tabula_sapiens_datasets({organ: server.url(f'{organ}.zip') for organ in organs}, str(tmp_path),
+                                         workers=2, processes=2, keep_archive=False)
+    assert sorted(os.listdir(tmp_path)) == sorted(f'TS_{organ}.h5ad' for organ in organs)
+    assert (tmp_path / 'TS_Lung.h5ad').read_bytes() == members['TS_Blood.h5ad'] + b'Lung'
+
+    for organ, archive in archives.items():
+        (tmp_path / f'{organ}.h5ad.zip').write_bytes(archive)
+    extract_archives([str(tmp_path / f'{organ}.h5ad.zip') for organ in organs], str(tmp_path / 'out'), processes=2)
+    assert sorted(os.listdir(tmp_path / 'out')) == sorted(f'TS_{organ}.h5ad' for organ in organs)
@@ -0,0 +1,145 @@
+import pytest
+from pascrd.api.tabula_sapiens import TabulaSapiensParser
+from pascrd.api.figshare import collect_figshare_download_links, figshare_article_id, figshare_article_version, \
+    list_article_files, tabula_sapiens_dataset_key
+import asyncio
+import threading
+from aiohttp import web
+
+ORGANS = ['Bladder', 'Blood', 'Bone_Marrow', 'Eye', 'Fat', 'Heart', 'Kidney', 'Large_Intestine', 'Liver', 'Lung',
+          'Lymph_Node', 'Mammary', 'Muscle', 'Pancreas', 'Prostate', 'Salivary_Gland', 'Skin', 'Small_Intestine',
+          'Spleen', 'Thymus', 'Tongue', 'Trachea', 'Uterus', 'Vasculature', 'Single_Cell', 'Immune', 'Epithelial',
+          'Endothelial', 'Stromal', 'All']
+
+
+class FigshareStandIn:
+    def __init__(self, article_id, files, versions=None):
+        self.article_id = article_id
+        self.files = files
+        # version -> files of that version
+        self.versions = versions or {}
+        self.pages = []
+        self.loop = asyncio.new_event_loop()
+        self.runner = None
+        self.port = None
+
+    async def article_files(self, request):
+        if request.match_info['article_id'] != self.article_id:
+            raise web.HTTPNotFound()
+        page, page_size = int(request.query['page']), int(request.query['page_size'])
+        self.pages.append(page)
+        return web.json_response(self.files[(page - 1) * page_size:page * page_size])
+
+    async def article_version(self, request):
+        if request.match_info['article_id'] != self.article_id or \
+                int(request.match_info['version']) not in self.versions:
+            raise web.HTTPNotFound()
+        return web.json_response({'id': int(self.article_id), 'version': int(request.match_info['version']),
+                                  'files': self.versions[int(request.match_info['version'])]})
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get('/v2/articles/{article_id}/files', self.article_files)
+        app.router.add_get('/v2/articles/{article_id}/versions/{version}', self.article_version)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        self.port = self.runner.addresses[0][1]
+
+    def __enter__(self):
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+        asyncio.run_coroutine_threadsafe(self.start(), self.loop).result()
+        return self
+
+    def __exit__(self, *args):
+        asyncio.run_coroutine_threadsafe(self.runner.cleanup(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    @property
+    def api_url(self):
+        return f'http://127.0.0.1:{self.port}/v2'
+
+
+def figshare_files():
+    return [{'id': 34701958 + i, 'name': f'TS_{organ}.h5ad.zip', 'size': 1000 + i, 'is_link_only': False,
+             'download_url': f'https://ndownloader.figshare.com/files/{34701958 + i}',
+             'supplied_md5': '', 'computed_md5': f'{i:032x}'} for i, organ in enumerate(ORGANS)]
+
+
+def test_figshare_article_id():
+    assert figshare_article_id('https://figshare.com/articles/dataset/Tabula_Sapiens_release_1_0/14267219') == \
+           '14267219'
+    assert figshare_article_id('https://figshare.com/articles/dataset/Tabula_Sapiens_release_1_0/14267219/4/') == \
+           '14267219'
+    assert figshare_article_version('https://figshare.com/articles/dataset/Tabula_Sapiens_release_1_0/14267219/4/') \
+           == ('14267219', '4')
+    assert figshare_article_version('https://figshare.com/articles/dataset/Tabula_Sapiens_release_1_0/14267219') \
+           == ('14267219', None)
+    with pytest.raises(ValueError):
+        figshare_article_id('https://figshare.com/articles/dataset/Tabula_Sapiens_release_1_0')
+
+
+def test_tabula_sapiens_dataset_key():
+    # the same key for the file names of the API and the titles of the rendered page
+    assert tabula_sapiens_dataset_key('TS_Bone_Marrow.h5ad.zip') == 'Bone_Marrow'
+    assert tabula_sapiens_dataset_key('Download TS_lymph_node.h5ad.zip') == 'Lymph_Node'
+
+
+def test_versioned_article():
+    files = figshare_files()
+    with FigshareStandIn('14267219', files, versions={4: files[:3]}) as server:
+        download_links, dataset_files, file_number = collect_figshare_download_links(
+            'https://figshare.com/articles/dataset/Tabula_Sapiens_release_1_0/14267219/4', server.api_url)
+        assert list(download_links) == ['Bladder', 'Blood', 'Bone_Marrow'] and file_number == 3
+        assert server.pages == []
+        assert len(collect_figshare_download_links(
+            'https://figshare.com/articles/dataset/Tabula_Sapiens_release_1_0/14267219', server.api_url)[0]) == 30
+
+
+def test_api_backend(tmp_path):
+    files = figshare_files()
+    with FigshareStandIn('14267219', files) as server:
+        parser = TabulaSapiensParser(backend="api", api_url=server.api_url, cache_directory=str(tmp_path))
+        assert parser.driver is None
+        assert parser.collect_datasets() == parser.download_links
+    assert parser.file_number == len(parser.download_links) == 30
+    assert parser.download_links['Bone_Marrow'] == 'https://ndownloader.figshare.com/files/34701960'
+    assert parser.dataset_files['All']['size'] == 1029
+
+
+def test_list_article_files_pages():
+    files = figshare_files()
+    with FigshareStandIn('14267219', files) as server:
+        assert asyncio.run(list_article_files('14267219', server.api_url, page_size=7, concurrency=3)) == files
+        # 30 files over pages of 7 end on page 5, which is part of the second batch of 3
+        assert sorted(server.pages) == list(range(1, 7))
+
+
+def test_download_link_manifest(tmp_path, monkeypatch):
+    files = figshare_files()
+    with FigshareStandIn('14267219', files) as server:
+        TabulaSapiensParser(backend="api", api_url=server.api_url, cache_directory=str(tmp_path)).collect_datasets()
+        requested = len(server.pages)
+
+        # a fresh manifest is used by either backend without starting a browser or calling the API
+        def no_browser(*args, **kwargs):
+            raise AssertionError("the browser should not be started")
+        monkeypatch.setattr('pascrd.api.tabula_sapiens.webdriver.Chrome', no_browser)
+        parser = TabulaSapiensParser(cache_directory=str(tmp_path))
+        assert parser.collect_datasets()['Blood'] == 'https://ndownloader.figshare.com/files/34701959'
+        assert parser.driver is None and parser.file_number == 30
+        assert len(server.pages) == requested
+
+        files[1]['download_url'] = 'https://ndownloader.figshare.com/files/1'
+        for parser in [TabulaSapiensParser(backend="api", api_url=server.api_url, cache_directory=str(tmp_path),
+                                           force_refresh=True),
+                       TabulaSapiensParser(backend="api", api_url=server.api_url, cache_directory=str(tmp_path),
+                                           manifest_ttl=0)]:
+            assert parser.collect_datasets()['Blood'] == 'https://ndownloader.figshare.com/files/1'
+        assert len(server.pages) == 3 * requested
+
+
+def test_invalid_backend():
+    with pytest.raises(ValueError):
+        TabulaSapiensParser(backend="fake")
@@ -0,0 +1,218 @@
+import pytest
+from pascrd.api import human_cell_atlas
+from pascrd.api.human_cell_atlas import HCAParser
+from pascrd.index import HCASearchOptions
+from pascrd.store import HCAMetadataStore
+from pascrd.fetch import parse_retry_after, retry_delay
+import asyncio
+import functools
+import threading
+import hashlib
+import json
+import os
+from aiohttp import web
+
+
+class AzulStandIn:
+    def __init__(self, projects, delay=0):
+        self.projects = projects
+        self.requests = []
+        self.delay = delay
+        # project_key -> statuses to answer with before the project is served
+        self.failures = {}
+        # catalog -> projects served for that catalog instead of projects
+        self.catalogs = {}
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.loop = asyncio.new_event_loop()
+        self.runner = None
+        self.port = None
+
+    async def project(self, request):
+        project_key = request.match_info['project_key']
+        self.requests.append((project_key, request.query.get('catalog'), request.headers.get('If-None-Match')))
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.delay)
+        finally:
+            self.in_flight -= 1
+        if self.failures.get(project_key):
+            return web.Response(status=self.failures[project_key].pop(0), headers={'Retry-After': '0'})
+        projects = self.catalogs.get(request.query.get('catalog'), self.projects)
+        if project_key not in projects:
+            raise web.HTTPNotFound()
+        body = json.dumps(projects[project_key]).encode('utf-8')
+        etag = '"' + hashlib.md5(body).hexdigest() + '"'
+        if request.headers.get('If-None-Match') == etag:
+            return web.Response(status=304, headers={'ETag': etag})
+        return web.Response(body=body, content_type='application/json', headers={'ETag': etag})
+
+    async def listing(self, request):
+        size, offset = int(request.query.get('size', 100)), int(request.query.get('offset', 0))
+        self.requests.append(('page', offset))
+        await asyncio.sleep(self.delay)
+        project_keys = list(self.projects)
+        hits = [{'entryId': project_key, 'projects': [{'projectTitle': self.projects[project_key]['projects'][0]
+                 ['projectTitle']}]} for project_key in project_keys[offset:offset + size]]
+        next_url = f'{self.directory}?size={size}&offset={offset + size}&catalog={request.query.get("catalog")}' \
+            if offset + size < len(project_keys) else None
+        return web.json_response({'hits': hits, 'pagination': {'next': next_url, 'total': len(project_keys)}})
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get('/index/projects/', self.listing)
+        app.router.add_get('/index/projects/{project_key}', self.project)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        self.port = self.runner.addresses[0][1]
+
+    def __enter__(self):
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+        asyncio.run_coroutine_threadsafe(self.start(), self.loop).result()
+        return self
+
+    def __exit__(self, *args):
+        asyncio.run_coroutine_threadsafe(self.runner.cleanup(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    @property
+    def directory(self):
+        return f'http://127.0.0.1:{self.port}/index/projects/'
+
+
+@pytest.fixture(scope="function")
+def sample_projects():
+    with open(os.path.join(os.path.dirname(__file__), 'data', 'hca_sample.json')) as sample_json:
+        return json.load(sample_json)
+
+
+def test_incremental_refresh(sample_projects, tmp_path):
+    with AzulStandIn(dict(sample_projects)) as server:
+        parser = HCAParser(repo_directory=server.directory, cache_directory=str(tmp_path))
+        parser.project_identifiers = {project_key: project_key for project_key in sample_projects}
+        parser.collect_project_metadata(catalog="dcp24", incremental=True)
+        assert parser.metadata_path == str(tmp_path / "hca.sqlite")
+        assert parser.changed_projects == set(sample_projects)
+        assert parser.search({"organ": "nose"}) == ["3c4d5e6f-0000-4000-8000-000000000003"]
+
+        changed = "3c4d5e6f-0000-4000-8000-000000000003"
+        server.projects[changed] = dict(server.projects[changed], entryId="changed")
+        server.requests = []
+        parser.collect_project_metadata(catalog="dcp24", incremental=True)
+        assert parser.changed_projects == {changed}
+        assert all(etag is not None for project_key, catalog, etag in server.requests)
+        assert parser.search({"entryId": "changed"}) == [changed]
+        assert parser.search_options["entryId"]["changed"] == 1 and changed not in parser.search_options["entryId"]
+
+        # fingerprints recorded against one catalog are not sent for another
+        server.requests = []
+        parser.collect_project_metadata(catalog="dcp23", incremental=True)
+        assert all(etag is None and catalog == "dcp23" for project_key, catalog, etag in server.requests)
+        assert parser.changed_projects == set()
+
+    reopened = HCAParser(cache_directory=str(tmp_path))
+    assert isinstance(reopened.project_metadata, HCAMetadataStore)
+    assert list(reopened.project_metadata) == list(sample_projects)
+    assert reopened.search({"entryId": "changed"}) == [changed]
+    assert dict(reopened.search_options) == dict(HCASearchOptions(reopened.project_metadata))
+
+
+def test_incremental_refresh_across_catalogs(sample_projects, tmp_path):
+    project_key = "3c4d5e6f-0000-4000-8000-000000000003"
+    with AzulStandIn(dict(sample_projects)) as server:
+        server.catalogs["dcp23"] = dict(sample_projects, **{project_key: dict(sample_projects[project_key],
+                                                                                entryId="dcp23")})
+        parser = HCAParser(repo_directory=server.directory, cache_directory=str(tmp_path))
+        parser.project_identifiers = {key: key for key in sample_projects}
+        parser.collect_project_metadata(catalog="dcp24", incremental=True)
+        parser.collect_project_metadata(catalog="dcp23", incremental=True)
+        assert parser.changed_projects == {project_key}
+        assert parser.project_metadata[project_key]["entryId"] == "dcp23"
+
+        # the dcp24 fingerprint of the rewritten project no longer describes the stored record and is not sent
+        server.requests = []
+        parser.collect_project_metadata(catalog="dcp24", incremental=True)
+        assert parser.changed_projects == {project_key}
+        assert parser.project_metadata[project_key] == sample_projects[project_key]
+        assert [etag for key, catalog, etag in server.requests if key == project_key] == [None]
+        assert all(etag is not None for key, catalog, etag in server.requests if key != project_key)
+
+    assert HCAParser(cache_directory=str(tmp_path)).project_metadata[project_key] == sample_projects[project_key]
+
+
+def test_incremental_refresh_requires_store(tmp_path):
+    parser = HCAParser(metadata_path=str(tmp_path / "hca.json"))
+    with pytest.raises(ValueError):
+        parser.collect_project_metadata(incremental=True)
+
+
+def test_bounded_concurrency_and_retries(sample_projects, tmp_path):
+    with AzulStandIn(dict(sample_projects), delay=0.05) as server:
+        parser = HCAParser(repo_directory=server.directory, cache_directory=str(tmp_path), max_concurrency=2,
+                           session_retries=2, session_backoff=0)
+        parser.project_identifiers = {project_key: project_key for project_key in sample_projects}
+        parser.project_identifiers["Missing project"] = "missing"
+        flaky, failing = list(sample_projects)[:2]
+        server.failures = {flaky: [503, 429], failing: [503, 503, 503]}
+        report = parser.collect_project_metadata(write_local=False)
+        assert server.max_in_flight <= 2
+        assert not report.complete
+        assert report.failed[failing] == {'url': parser.get_project_json_url(failing), 'cause': 'HTTP 503',
+                                          'status': 503, 'attempts': 3}
+        assert report.failed["missing"]["status"] == 404 and report.failed["missing"]["attempts"] == 1
+        assert flaky in parser.project_metadata and failing not in parser.project_metadata
+        assert sorted(report.fetched) == sorted(set(sample_projects) - {failing})
+
+
+def test_pool_wait_is_not_a_timeout(sample_projects, tmp_path):
+    # with a single connection each request waits for the previous ones, which must not count against its timeout
+    with AzulStandIn(dict(sample_projects), delay=0.3) as server:
+        parser = HCAParser(repo_directory=server.directory, cache_directory=str(tmp_path), max_concurrency=5,
+                           per_host_limit=1, request_timeout=0.5, session_retries=0)
+        parser.project_identifiers = {project_key: project_key for project_key in sample_projects}
+        report = parser.collect_project_metadata(write_local=False)
+        assert report.complete and sorted(report.fetched) == sorted(sample_projects)
+        assert server.max_in_flight == 1
+    assert HCAParser(metadata_path=str(tmp_path / "hca.sqlite"), max_concurrency=4).per_host_limit == 4
+
+
+def test_retry_delay():
+    assert retry_delay(0, 0.5, 60) == 0.5
+    assert retry_delay(3, 0.5, 60) == 4
+    assert retry_delay(10, 0.5, 60) == 60
+    assert retry_delay(2, 0.5, 60, parse_retry_after("7")) == 7
+    assert parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT") == 0
+    assert parse_retry_after("soon") is None
+
+
+def test_pipelined_discovery(sample_projects, tmp_path, monkeypatch):
+    with AzulStandIn(dict(sample_projects), delay=0.05) as server:
+        parser = HCAParser(repo_directory=server.directory, cache_directory=str(tmp_path))
+
+        async def consume():
+            found = []
+            async for project_id, metadata in parser.stream_project_metadata(catalog="dcp24"):
+                found.append((project_id, metadata))
+            return found
+
+        found = asyncio.run(consume())
+        assert sorted(project_id for project_id, metadata in found) == sorted(sample_projects)
+        assert all(metadata == sample_projects[project_id] for project_id, metadata in found)
+        assert parser.project_identifiers["Human blood atlas"] == "a004b150-1c36-4af6-9bbd-070c06dbc17d"
+
+    # with one project per page the first project is requested before discovery has finished
+    with AzulStandIn(dict(sample_projects), delay=0.05) as server:
+        parser = HCAParser(repo_directory=server.directory, cache_directory=str(tmp_path))
+        monkeypatch.setattr(human_cell_atlas, "iterate_project_identifiers",
+                            functools.partial(human_cell_atlas.iterate_project_identifiers, page_size=1))
+        report = parser.collect_project_metadata(discover=True)
+        assert report.complete and len(parser.project_metadata) == len(sample_projects)
+        pages = [i for i, elem in enumerate(server.requests) if elem[0] == 'page']
+        first_project = next(i for i, elem in enumerate(server.requests) if elem[0] != 'page')
+        assert len(pages) == len(sample_projects) and first_project < pages[-1]
+        assert HCAParser(cache_directory=str(tmp_path)).search({"organ": "nose"}) == \
+               ["3c4d5e6f-0000-4000-8000-000000000003"]
+
@@ -0,0 +1,62 @@
+from pascrd.api.human_cell_atlas import HCAParser
+from pascrd.download import download_to_path
+from pascrd.metrics import CallbackInstrumentation, Histogram, MetricsCollector
+from tests.test_download import FileServer
+from tests.test_hca_fetch import AzulStandIn
+import logging
+import json
+import os
+
+
+def test_histogram():
+    histogram = Histogram()
+    for value in [0.001, 0.002, 0.004, 0.1, 0]:
+        histogram.observe(value)
+    summary = histogram.summary()
+    assert summary['count'] == 5 and summary['max'] == 0.1 and summary['min'] == 0
+    assert 0.002 <= summary['p50'] <= 0.002 * 2 ** 0.25
+    assert Histogram().summary() == {'count': 0}
+
+
+def test_fetch_and_search_metrics(tmp_path):
+    with open(os.path.join(os.path.dirname(__file__), 'data', 'hca_sample.json')) as sample_json:
+        sample_projects = json.load(sample_json)
+    handlers = list(logging.getLogger().handlers)
+    metrics = MetricsCollector()
+    with AzulStandIn(dict(sample_projects)) as server:
+        parser = HCAParser(repo_directory=server.directory, cache_directory=str(tmp_path), session_backoff=0,
+                           instrumentation=metrics)
+        parser.project_identifiers = {project_key: project_key for project_key in sample_projects}
+        server.failures = {list(sample_projects)[0]: [503]}
+        parser.collect_project_metadata(incremental=True)
+        parser.collect_project_metadata(incremental=True)
+    assert logging.getLogger().handlers == handlers
+    counters = metrics.summary()['counters']
+    assert counters['fetch.project.cache=changed'] == counters['fetch.project.cache=not_modified'] == 5
+    assert counters['fetch.retry.cause=HTTP 503'] == 1 and counters['fetch.request'] == 11
+    assert metrics.summary()['histograms']['fetch.project.bytes']['sum'] == \
+           sum(len(json.dumps(project)) for project in sample_projects.values())
+
+    metrics.reset()
+    parser.search({"organ": ["blood", "nose"], "disease": {"unhashable": True}})
+    parser.search({"organ": "bloo"}, match_type="partial")
+    counters = metrics.summary()['counters']
+    assert counters['search.query'] == 2 and counters['search.index'] == 3 and counters['search.scan'] == 1
+    assert counters['search.partial_build'] == 1
+
+
+def test_download_metrics(tmp_path):
+    payload = os.urandom(300000)
+    events = []
+    with open(tmp_path / 'matrix.h5ad.part', 'wb') as part:
+        part.write(payload[:1000])
+    with FileServer({'matrix.h5ad': payload}) as server:
+        instrumentation = CallbackInstrumentation(lambda name, fields: events.append((name, fields)))
+        download_to_path(server.url('matrix.h5ad'), str(tmp_path / 'matrix.h5ad'), instrumentation=instrumentation)
+        try:
+            download_to_path(server.url('missing'), str(tmp_path / 'missing'), instrumentation=instrumentation)
+        except Exception:
+            pass
+    (name, fields), (failure, failure_fields) = events
+    assert name == 'download.file' and fields['bytes'] == len(payload) - 1000 and fields['resumed_bytes'] == 1000
+    assert failure == 'download.failure' and failure_fields == {'cause': 'HTTPError'}
@@ -0,0 +1,207 @@
+import pytest
+from pascrd.api.human_cell_atlas import HCAParser
+from pascrd.index import HCAMetadataIndex, HCANumericColumn, HCAPartialMatchIndex, HCASearchOptions
+from pascrd.query import And, HCAQueryMatcher, Match, Not, Or, Range
+from pascrd.store import HCAMetadataStore, convert_hca_json_to_store
+from pascrd.utils import collect_hca_search_options, search_through_hca_metadata_for_value
+import os
+
+
+@pytest.fixture(scope="function")
+def sample_parser():
+    return HCAParser(metadata_path=os.path.join(os.path.dirname(__file__), 'data', 'hca_sample.json'))
+
+
+def scan(parser, key, value, match_type="full"):
+    found = []
+    for project_key, project_values in parser.project_metadata.items():
+        for elem in search_through_hca_metadata_for_value(project_values, key=key, value=value,
+                                                          project_key=project_key, search_type=match_type):
+            if elem not in found:
+                found.append(elem)
+    return found
+
+
+def test_index_matches_scan(sample_parser):
+    for key, value in [("organ", "blood"), ("genusSpecies", "Homo sapiens"), ("institution", "Broad Institute"),
+                       ("donorCount", 12), ("disease", "normal"), ("doi", None), ("organ", "fake")]:
+        assert sample_parser.search_index.ordered(sample_parser.search_index.lookup(key, value)) == \
+               scan(sample_parser, key, value)
+    for key, value in [("organ", "BRAI"), ("genusSpecies", "mus"), ("disease", "esophagu")]:
+        assert sample_parser.search_index.ordered(sample_parser.search_index.lookup(key, value, "partial")) == \
+               scan(sample_parser, key, value, "partial")
+
+
+def test_index_search_union_and_intersection(sample_parser):
+    union = sample_parser.search({"institution": "Broad Institute", "organ": "brain"})
+    assert union == ["a004b150-1c36-4af6-9bbd-070c06dbc17d", "3c4d5e6f-0000-4000-8000-000000000003",
+                     "1a2b3c4d-0000-4000-8000-000000000001"]
+    assert sample_parser.search({"genusSpecies": "Homo sapiens", "organ": ["blood", "nose"]},
+                                search_type="intersection") == []
+    assert sample_parser.search({"genusSpecies": "Homo sapiens", "organ": "nose"},
+                                search_type="intersection") == ["3c4d5e6f-0000-4000-8000-000000000003"]
+    assert sample_parser.search({}) == []
+
+
+def test_index_replace_project(sample_parser):
+    index = HCAMetadataIndex(dict(sample_parser.project_metadata))
+    first = next(iter(sample_parser.project_metadata))
+    index.add_project(first, {"samples": [{"organ": ["heart"]}]})
+    assert index.lookup("organ", "blood") == set()
+    assert index.ordered(index.lookup("organ", "heart") | index.lookup("organ", "nose"))[0] == first
+    index.remove_project(first)
+    assert "organ" in index.fields and "heart" not in index.fields["organ"]
+
+
+def test_index_rebuilt_after_collect(sample_parser, tmp_path, monkeypatch):
+    async def fake_main(query_dict, verbose=True, discover=False):
+        for identifier in query_dict.values():
+            sample_parser.project_metadata[identifier] = {"samples": [{"organ": ["heart"]}]}
+
+    monkeypatch.setattr(sample_parser, "main", fake_main)
+    sample_parser.project_identifiers = {"Heart atlas": "heart-project"}
+    sample_parser.local_path = str(tmp_path / "hca.json")
+    sample_parser.collect_project_metadata()
+    assert sample_parser.search({"organ": "heart"}) == ["heart-project"]
+    assert sample_parser.search({"organ": "blood"}) == []
+
+
+def test_partial_match_mixed_case(sample_parser):
+    # "CD4 T-Cell" and "CD4 T-cell" are only found together once matching is case-insensitive
+    assert sample_parser.search({"selectedCellType": "cd4 t-cell"}, match_type="partial") == \
+           ["a004b150-1c36-4af6-9bbd-070c06dbc17d", "4d5e6f70-0000-4000-8000-000000000004"]
+    assert sample_parser.search({"selectedCellType": "cd4 t-cell"}, match_type="partial") == \
+           scan(sample_parser, "selectedCellType", "cd4 t-cell", "partial")
+    assert sample_parser.search({"organ": "no"}, match_type="partial") == \
+           ["3c4d5e6f-0000-4000-8000-000000000003"]
+    assert sample_parser.search({"organ": "xyzzy"}, match_type="partial") == []
+
+
+def test_partial_match_index_candidates():
+    engine = HCAPartialMatchIndex(["Barrett esophagus", "esophagus", "Blood", None, 12])
+    assert engine.values == ["Barrett esophagus", "esophagus", "Blood"]
+    assert sorted(engine.find("ESOPHAG")) == ["Barrett esophagus", "esophagus"]
+    assert engine.find("lo") == ["Blood"]
+    assert engine.find("phagus b") == []
+
+
+def test_metadata_store_round_trip(sample_parser, tmp_path):
+    store_path = str(tmp_path / "hca.sqlite")
+    convert_hca_json_to_store(os.path.join(os.path.dirname(__file__), 'data', 'hca_sample.json'), store_path).close()
+    parser = HCAParser(metadata_path=store_path)
+    assert isinstance(parser.project_metadata, HCAMetadataStore)
+    assert parser.project_metadata.decoded == {}
+    assert list(parser.project_metadata) == list(sample_parser.project_metadata)
+    first = next(iter(sample_parser.project_metadata))
+    assert parser.project_metadata[first] == sample_parser.project_metadata[first]
+    assert len(parser.project_metadata.decoded) == 1
+    assert "fake" not in parser.project_metadata
+    assert "blood" in parser.search_options["organ"]
+    assert list(parser.search_options) == list(sample_parser.search_options)
+    assert parser.search({"genusSpecies": "Homo sapiens", "organ": "nose"}, search_type="intersection") == \
+           sample_parser.search({"genusSpecies": "Homo sapiens", "organ": "nose"}, search_type="intersection")
+
+
+def test_metadata_store_updates(tmp_path):
+    store = HCAMetadataStore(str(tmp_path / "hca.sqlite"))
+    store["b"] = {"organ": "blood"}
+    store["a"] = {"organ": "brain"}
+    store["b"] = {"organ": "heart"}
+    assert list(store) == ["b", "a"]
+    del store["b"]
+    with pytest.raises(KeyError):
+        del store["b"]
+    assert HCAMetadataStore(str(tmp_path / "hca.sqlite"), readonly=True)["a"] == {"organ": "brain"}
+
+
+def test_query_matches_brute_force(sample_parser):
+    blood, brain = Match("organ", "blood"), Match("organ", "brain")
+    human = Match("genusSpecies", "Homo sapiens")
+    queries = [blood | brain, human & ~blood, Match("organ", ["blood", "nose"]) & human,
+               ~(blood | Match("institution", "Broad Institute")), Match("disease", "esophagu", "partial") | brain,
+               And(human, Or(blood, Match("donorCount", [12, 13])), Not(Match("selectedCellType", "CD4 T-cell")))]
+    for query in queries:
+        matcher = HCAQueryMatcher(query)
+        expected = [project_key for project_key, project_values in sample_parser.project_metadata.items()
+                    if matcher.matches(project_values)]
+        assert sample_parser.search(query) == expected
+    assert sample_parser.search(blood | brain) == sample_parser.search({"organ": ["blood", "brain"]})
+
+
+def test_query_unhashable_terms(sample_parser):
+    # unhashable values never equal a leaf, they are answered by one shared traversal instead of the postings
+    query = Match("organ", [["blood"]]) | Match("organ", "brain")
+    assert not query.indexable
+    assert sample_parser.search(query) == sample_parser.search({"organ": "brain"})
+    assert sample_parser.search({"organ": [["blood"], "brain"]}) == sample_parser.search({"organ": "brain"})
+    assert sample_parser.search(Match("organ", [["blood"]]) & Match("organ", "brain")) == []
+    assert sample_parser.search({"organ": ["brain"], "doi": {"a": 1}}, search_type="intersection") == []
+
+
+def test_query_matcher_early_exit():
+    matcher = HCAQueryMatcher(Match("organ", "blood") | Match("organ", "brain"))
+    satisfied, outcome = matcher.satisfied({"samples": [{"organ": ["brain", "blood"]}]})
+    assert outcome is True and len(satisfied) == 1
+    satisfied, outcome = matcher.satisfied({"samples": [{"organ": ["brain", "blood"]}]}, decide=False)
+    assert outcome is None and len(satisfied) == 2
+    assert not HCAQueryMatcher(~Match("organ", "blood")).matches({"organ": "blood"})
+    with pytest.raises(ValueError):
+        Match("organ", "blood", "fuzzy")
+
+
+def test_range_queries(sample_parser):
+    def brute_force(query):
+        matcher = HCAQueryMatcher(query)
+        return [project_key for project_key, project_values in sample_parser.project_metadata.items()
+                if matcher.matches(project_values)]
+
+    for query in [Range("estimatedCellCount", minimum=100000, min_inclusive=False), Range("donorCount", 5, 20),
+                  Range("donorCount", 5, 20, max_inclusive=False), Range("donorCount", maximum=4),
+                  Range("donorCount", 6, 9) | Match("organ", "brain"),
+                  Range("estimatedCellCount", 40000, 200000) & ~Range("donorCount", minimum=10)]:
+        assert sample_parser.search(query) == brute_force(query)
+    assert sample_parser.search(Range("donorCount", 5, 20)) == \
+           sample_parser.search({"donorCount": Range(minimum=5, maximum=20)})
+    assert sample_parser.search({"donorCount": Range(minimum=5, maximum=20), "organ": "blood"},
+                                search_type="intersection") == \
+           sample_parser.search(Range("donorCount", 5, 20) & Match("organ", "blood"))
+    with pytest.raises(ValueError):
+        sample_parser.search({"organ": Range("donorCount", minimum=5)})
+    with pytest.raises(ValueError):
+        Range("donorCount")
+
+
+def test_numeric_column():
+    column = HCANumericColumn({3: {"a"}, 1.5: {"b", "c"}, True: {"d"}, "7": {"e"}, 10: {"c"}, None: {"f"}})
+    assert list(column.values) == [1.5, 1.5, 3, 10]
+    assert column.find(1.5, 3) == {"a", "b", "c"}
+    assert column.find(1.5, 3, min_inclusive=False) == {"a"}
+    assert column.find(maximum=10, max_inclusive=False) == {"a", "b", "c"}
+    assert column.find(minimum=11) == set()
+
+
+def test_search_options_counts(sample_parser):
+    options = sample_parser.search_options
+    assert isinstance(options, HCASearchOptions)
+    assert {field: list(values) for field, values in options.items()} == \
+           collect_hca_search_options(sample_parser.project_metadata)
+    assert options["genusSpecies"]["Homo sapiens"] == len(sample_parser.search({"genusSpecies": "Homo sapiens"}))
+    assert options.most_common("genusSpecies", 1) == [("Homo sapiens", options["genusSpecies"]["Homo sapiens"])]
+
+    first, project_values = next(iter(sample_parser.project_metadata.items()))
+    options.remove_project(project_values)
+    options.add_project({"samples": [{"organ": ["heart", "blood"]}]})
+    remaining = dict(sample_parser.project_metadata, **{first: {"samples": [{"organ": ["heart", "blood"]}]}})
+    assert dict(options) == dict(HCASearchOptions(remaining))
+
+
+def test_stored_search_options(tmp_path):
+    store = HCAMetadataStore(str(tmp_path / "hca.sqlite"))
+    store.replace({"a": {"organ": ["blood", "brain"]}, "b": {"organ": "blood"}},
+                  HCASearchOptions({"a": {"organ": ["blood", "brain"]}, "b": {"organ": "blood"}}))
+    assert store.search_options()["organ"] == {"blood": 2, "brain": 1}
+    assert store.search_options().most_common("organ") == [("blood", 2), ("brain", 1)]
+    # stores written before the counts were kept
+    store.replace_search_options({"organ": ["blood", "brain"]})
+    assert store.search_options()["organ"] == {"blood": None, "brain": None}
+    assert not store.search_options().counted
@@ -0,0 +1,76 @@
+import pytest
+from pascrd.query import Match, Range
+from pascrd.snapshots import HCASnapshotStore
+import copy
+import json
+import os
+
+
+@pytest.fixture(scope="function")
+def sample_projects():
+    with open(os.path.join(os.path.dirname(__file__), 'data', 'hca_sample.json')) as sample_json:
+        return json.load(sample_json)
+
+
+@pytest.fixture(scope="function")
+def releases(sample_projects):
+    # the next release changes one project, drops one and adds one
+    project_keys = list(sample_projects)
+    newer = copy.deepcopy(sample_projects)
+    newer[project_keys[1]]["projects"][0]["projectTitle"] = "Renamed"
+    del newer[project_keys[2]]
+    newer["new-project"] = copy.deepcopy(sample_projects[project_keys[0]])
+    return sample_projects, newer
+
+
+def test_snapshot_store_shares_trees(releases):
+    older, newer = releases
+    store = HCASnapshotStore()
+    store.add_catalog("dcp23", older)
+    nodes = len(store.nodes)
+    store.add_catalog("dcp24", newer)
+    assert store["dcp23"] == older and store["dcp24"] == newer
+    assert list(store["dcp24"]) == list(newer)
+    assert store.stats() == {'catalogs': 2, 'projects': 10, 'distinct_projects': 6, 'nodes': len(store.nodes)}
+    # the changed project only adds the nodes on the path to its new title
+    assert len(store.nodes) - nodes < 10
+    first = next(iter(older))
+    assert store["dcp23"][first] is store["dcp24"][first] is store["dcp24"]["new-project"]
+    changed = list(older)[1]
+    assert store["dcp23"][changed]["projects"][0]["matrices"] is store["dcp24"][changed]["projects"][0]["matrices"]
+
+
+def test_snapshot_diff_and_search(releases):
+    older, newer = releases
+    store = HCASnapshotStore()
+    store.add_catalog("dcp23", older)
+    store.add_catalog("dcp24", newer)
+    diff = store.diff("dcp23", "dcp24")
+    assert diff.added == ["new-project"]
+    assert diff.removed == [list(older)[2]]
+    assert diff.changed == [list(older)[1]]
+    assert store.diff("dcp24", "dcp24").changed == []
+    assert store.search("dcp24", Match("projectTitle", "Renamed")) == [list(older)[1]]
+    assert store.search("dcp23", Match("projectTitle", "Renamed")) == []
+    assert store.search("dcp24", Range("donorCount", minimum=0)) != store.search("dcp23", Range("donorCount", minimum=0))
+
+
+def test_snapshot_remove_catalog(releases):
+    older, newer = releases
+    store = HCASnapshotStore()
+    store.add_catalog("dcp24", newer)
+    nodes = len(store.nodes)
+    store.add_catalog("dcp23", older)
+    store.remove_catalog("dcp23")
+    assert len(store.nodes) == nodes and "dcp23" not in store
+    assert store["dcp24"] == newer
+    with pytest.raises(KeyError):
+        store["dcp23"]
+
+
+def test_snapshot_scalars_stay_distinct():
+    store = HCASnapshotStore()
+    store.add_catalog("a", {"one": {"value": 1}, "true": {"value": True}, "text": {"value": "1"},
+                            "float": {"value": 1.0}})
+    assert store.stats()['distinct_projects'] == 4
+    assert store["a"]["true"]["value"] is True